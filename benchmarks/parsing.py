@@ -0,0 +1,65 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of trusted construction against validation of predictions.
+
+Parses stand-in multiclass prediction responses with `Prediction.parse_frame`,
+building the objects without validation (the default) and with full pydantic
+validation (`validate=True`, i.e. `NBO_VALIDATE_PREDICTIONS`).
+
+Run with:
+    python -m benchmarks.parsing --rows 1000 10000 100000
+"""
+
+from __future__ import annotations
+
+import argparse
+import time
+from typing import Optional, Sequence
+
+import pandas as pd
+
+from nbo.schema import Prediction
+from tests.standins import STANDIN_TARGET, parser_frame
+
+
+def best_of(repeat: int, df: pd.DataFrame, validate: bool) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        Prediction.parse_frame(df, STANDIN_TARGET, validate=validate)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.parsing")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--explanations", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3, help="Best of N runs")
+    args = parser.parse_args(argv)
+
+    print(f"{'rows':>9} {'construct':>11} {'validate':>11} {'speed-up':>9}")
+    for n_rows in args.rows:
+        df = parser_frame(n_rows, args.explanations)
+        constructed = best_of(args.repeat, df, validate=False)
+        validated = best_of(args.repeat, df, validate=True)
+        print(
+            f"{n_rows:>9,} {constructed:>10.3f}s {validated:>10.3f}s "
+            f"{validated / constructed:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Throughput and latency of the HTTP service against stand-in deployments.
+
+Serves the stand-in DataRobot API with both deployments (see
+`tests.standins`), starts `uvicorn nbo.service:app` against it in a separate
+process, then sends `--requests` single-record `/emails` requests with
+`--concurrency` of them in flight, and one `/emails/batch` request of
+`--batch-size` records. Reports requests per second, latency percentiles and
+the time to the first streamed email.
+
+Run with:
+    python -m benchmarks.service --requests 400 --concurrency 64 --batch-size 1000
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional, Sequence
+
+import httpx
+import yaml
+
+from tests.standins import (
+    STANDIN_APP_SETTINGS,
+    STANDIN_GENERATIVE_DEPLOYMENT_ID,
+    llm_standin,
+    prediction_standin,
+    serve,
+)
+
+
+def record(index: int) -> dict[str, Any]:
+    return {
+        "customer_id": f"C{index}",
+        "age": 20 + index % 60,
+        "plan": "basic",
+        "notes": "asked about 5G",
+    }
+
+
+def summarize(name: str, latencies: list[float], elapsed: float) -> None:
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name}: {len(latencies)} requests in {elapsed:.2f}s "
+        f"({len(latencies) / elapsed:.0f} req/s), "
+        f"p50 {percentiles[49] * 1000:.0f}ms, p95 {percentiles[94] * 1000:.0f}ms, "
+        f"p99 {percentiles[98] * 1000:.0f}ms"
+    )
+
+
+async def single_requests(base_url: str, requests: int, concurrency: int) -> None:
+    latencies: list[float] = []
+    in_flight = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url,
+        timeout=300,
+        limits=httpx.Limits(max_connections=concurrency),
+    ) as client:
+
+        async def send(index: int) -> None:
+            async with in_flight:
+                start = time.perf_counter()
+                response = await client.post("/emails", json={"record": record(index)})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(index) for index in range(requests)))
+        summarize(
+            f"/emails, concurrency {concurrency}",
+            latencies,
+            time.perf_counter() - start,
+        )
+
+
+async def batch_request(base_url: str, batch_size: int) -> None:
+    # Offset the records so their prompts differ from the single requests'
+    records = [record(index) for index in range(10**6, 10**6 + batch_size)]
+    first_line: Optional[float] = None
+    lines = errors = 0
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        start = time.perf_counter()
+        async with client.stream(
+            "POST", "/emails/batch", json={"records": records}
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                if first_line is None:
+                    first_line = time.perf_counter() - start
+                lines += 1
+                errors += '"error"' in line
+        elapsed = time.perf_counter() - start
+    print(
+        f"/emails/batch: {lines} records in {elapsed:.2f}s "
+        f"({lines / elapsed:.0f} records/s, {errors} errors), first email after "
+        f"{(first_line or 0) * 1000:.0f}ms"
+    )
+
+
+def wait_until_healthy(base_url: str, service: subprocess.Popen[bytes]) -> None:
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if service.poll() is not None:
+            raise RuntimeError("The service exited during startup")
+        try:
+            httpx.get(f"{base_url}/health").raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise RuntimeError("The service did not start within 60s")
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.service")
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument(
+        "--prediction-latency",
+        type=float,
+        default=0.02,
+        help="Seconds the stand-in PredAI deployment takes per request",
+    )
+    parser.add_argument(
+        "--llm-latency",
+        type=float,
+        default=0.05,
+        help="Seconds the stand-in generative deployment takes per completion",
+    )
+    parser.add_argument("--port", type=int, default=8090, help="Service port")
+    args = parser.parse_args(argv)
+
+    datarobot = prediction_standin(
+        args.prediction_latency, generative=llm_standin(args.llm_latency)
+    )
+    with serve(datarobot) as datarobot_url, tempfile.TemporaryDirectory() as tmp:
+        settings_path = Path(tmp) / "app_settings.yaml"
+        settings_path.write_text(yaml.safe_dump(STANDIN_APP_SETTINGS))
+        service_url = f"http://127.0.0.1:{args.port}"
+        service = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "nbo.service:app"]
+            + ["--port", str(args.port), "--log-level", "warning"],
+            env={
+                **os.environ,
+                "DATAROBOT_ENDPOINT": f"{datarobot_url}/api/v2",
+                "DATAROBOT_API_TOKEN": "standin",
+                "PRED_AI_DEPLOYMENT_ID": "standin-predai",
+                "GENERATIVE_DEPLOYMENT_ID": STANDIN_GENERATIVE_DEPLOYMENT_ID,
+                "NBO_APP_SETTINGS_PATH": str(settings_path),
+            },
+        )
+        try:
+            wait_until_healthy(service_url, service)
+            asyncio.run(single_requests(service_url, args.requests, args.concurrency))
+            asyncio.run(batch_request(service_url, args.batch_size))
+        finally:
+            service.terminate()
+            service.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmark of the Arrow prediction response path against the pandas one.
+
+The pandas path reads the CSV response into an object-dtype frame and
+validates a `Prediction` per `to_dict(orient="records")` row, as responses
+were parsed before the Arrow transport. The Arrow path reads it with
+`read_prediction_csv` and parses it column by column with
+`Prediction.parse_frame`.
+
+Run with:
+    python -m benchmarks.transport --rows 10000 100000 1000000
+"""
+
+from __future__ import annotations
+
+import argparse
+import io
+import time
+from typing import Callable, Optional, Sequence
+
+import pandas as pd
+
+from nbo.schema import Prediction
+from nbo.transport import read_prediction_csv
+from tests.standins import STANDIN_TARGET, prediction_frame, strip_response_suffixes
+
+
+def pandas_path(content: bytes) -> tuple[pd.DataFrame, Callable[[], object]]:
+    df = strip_response_suffixes(pd.read_csv(io.BytesIO(content)))
+    return df, lambda: [
+        Prediction.parse_dict({str(k): v for k, v in row.items()}, STANDIN_TARGET)
+        for row in df.to_dict(orient="records")
+    ]
+
+
+def arrow_path(content: bytes) -> tuple[pd.DataFrame, Callable[[], object]]:
+    df = strip_response_suffixes(read_prediction_csv(content, STANDIN_TARGET))
+    return df, lambda: Prediction.parse_frame(df, STANDIN_TARGET)
+
+
+def timed(
+    path: Callable[[bytes], tuple[pd.DataFrame, Callable[[], object]]],
+    content: bytes,
+) -> tuple[float, float]:
+    """Seconds spent reading and parsing the response"""
+    start = time.perf_counter()
+    _, parse = path(content)
+    read = time.perf_counter() - start
+    start = time.perf_counter()
+    parse()
+    return read, time.perf_counter() - start
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.transport")
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--explanations", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    print(f"{'rows':>9} {'path':>6} {'read':>8} {'parse':>8} {'total':>8}")
+    for n_rows in args.rows:
+        content = (
+            prediction_frame(n_rows, args.explanations).to_csv(index=False).encode()
+        )
+        totals = {}
+        for name, path in (("pandas", pandas_path), ("arrow", arrow_path)):
+            read, parse = timed(path, content)
+            totals[name] = read + parse
+            print(
+                f"{n_rows:>9,} {name:>6} {read:>7.2f}s {parse:>7.2f}s "
+                f"{read + parse:>7.2f}s"
+            )
+        print(
+            f"{'':>9} {len(content) / 1e6:.0f}MB response, arrow "
+            f"{totals['pandas'] / totals['arrow']:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -16,30 +16,39 @@ from __future__ import annotations
 
 import logging
 import sys
+import uuid
+from functools import partial
 
 import datarobot as dr
 import pandas as pd
 import streamlit as st
 from helpers import (
     app_settings,
-    batch_email_responses,
     color_texts,
     custom_metric_ids,
     display_metrics,
+    estimate_upload_cost,
     format_metrics_for_datarobot,
     generative_deployment_id,
     get_llm_response,
     make_important_features_list,
     pred_ai_deployment_id,
-    set_outcome_details,
+    run_batch_job,
 )
 from streamlit_theme import st_theme
 
 sys.path.append("..")
 from nbo.custom_metrics import metrics_manager
 from nbo.i18n import gettext
-from nbo.predict import make_pred_ai_deployment_predictions
+from nbo.jobs import JobStatus, get_job_executor, make_job_id
+from nbo.pipeline import no_action_message, set_outcome_details
+from nbo.predict import (
+    is_llm_unavailable,
+    is_prediction_unavailable,
+    make_pred_ai_deployment_predictions,
+)
 from nbo.resources import DatasetId
+from nbo.telemetry import runtime_metrics
 from nbo.urls import get_deployment_url, get_project_url
 
 logger = logging.getLogger(__name__)
@@ -98,6 +107,103 @@ def feedback_buttons_fragment() -> None:
         )
 
 
+def job_owner() -> str:
+    """Owner of the batch jobs submitted here: the signed-in user, or else this
+    browser session. Each owner only sees their own jobs."""
+    email = st.user.get("email")
+    if email:
+        return f"user:{email}"
+    return f"session:{st.session_state.session_id}"
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def load_job_result(job_id: str, finished_at: str) -> pd.DataFrame:
+    """Result table of a finished job.
+
+    A resubmitted job finishes again under the same id, so results are cached
+    by the time the job finished as well.
+    """
+    return get_job_executor().result(job_id)
+
+
+@st.fragment(run_every=3)
+def batch_jobs_fragment() -> None:
+    """Poll the background job table, rerunning the app when a job finishes"""
+    jobs = get_job_executor().list_jobs(owner=job_owner())
+    finished_jobs = {
+        job.id: job.updated_at.isoformat()
+        for job in jobs
+        if job.status == JobStatus.SUCCEEDED
+    }
+    if finished_jobs != st.session_state.finished_jobs:
+        first_poll = st.session_state.finished_jobs is None
+        st.session_state.finished_jobs = finished_jobs
+        if not first_poll:
+            # Redraw the results section, which does not poll
+            st.rerun()
+    if not jobs:
+        return
+
+    st.subheader(gettext("Batch Jobs"))
+    st.dataframe(
+        pd.DataFrame(
+            [
+                {
+                    "Job": job.id,
+                    "File": job.name,
+                    "Status": job.status.value,
+                    "Progress": f"{job.completed}/{job.total}",
+                    "Submitted": job.created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                    "Error": job.error,
+                }
+                for job in jobs
+            ]
+        ),
+        hide_index=True,
+    )
+
+
+@st.fragment
+def batch_job_results_fragment() -> None:
+    """Offer the results of finished jobs, loaded once per job run"""
+    finished_jobs = st.session_state.finished_jobs
+    if not finished_jobs:
+        return
+    finished_job_ids = list(finished_jobs)
+    selected_job_id = st.selectbox(
+        gettext("Show results of job:"),
+        finished_job_ids,
+        index=(
+            finished_job_ids.index(st.session_state.selected_job_id)
+            if st.session_state.selected_job_id in finished_job_ids
+            else 0
+        ),
+    )
+    emails = load_job_result(str(selected_job_id), finished_jobs[selected_job_id])
+    if app_settings.no_text_gen_label is not None:
+        no_action_label = set_outcome_details(app_settings.outcome_details)[
+            app_settings.no_text_gen_label
+        ].label
+        st.caption(
+            gettext(
+                "{skipped} of {count} records were predicted as "
+                "'{no_action_label}' and did not need an LLM call."
+            ).format(
+                skipped=int((emails["label"] == no_action_label).sum()),
+                count=len(emails),
+                no_action_label=no_action_label,
+            )
+        )
+    st.dataframe(emails)
+    download = st.download_button(
+        "Download Results",
+        data=emails.to_csv(index=False),
+        file_name=f"emails_{selected_job_id}.csv",
+    )
+    if download:
+        st.success(gettext("Your download should start automatically."))
+
+
 def main() -> None:
     # Initialize DataRobot client and objects
 
@@ -126,11 +232,12 @@ def main() -> None:
         st.session_state.predicted_probability = ""
     if "unique_uuid" not in st.session_state:
         st.session_state.unique_uuid = ""
-    if "bulk_generated" not in st.session_state:
-        st.session_state.bulk_generated = False
-        st.session_state.bulk_prediction_results = (
-            pd.DataFrame().to_csv().encode("utf-8")
-        )
+    if "selected_job_id" not in st.session_state:
+        st.session_state.selected_job_id = None
+    if "finished_jobs" not in st.session_state:
+        st.session_state.finished_jobs = None
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid.uuid4())
 
     # Create the sidebar section
     with st.sidebar:
@@ -198,6 +305,12 @@ def main() -> None:
             ).format(deployment_url=get_deployment_url(generative_deployment_id))
         )
 
+        with st.expander(gettext("Runtime Metrics")):
+            st.dataframe(
+                pd.Series(runtime_metrics.snapshot(), name="value"),
+                use_container_width=True,
+            )
+
     # Create our shared title container
     title_container = st.container(key="datarobot-logo")
 
@@ -280,10 +393,24 @@ def main() -> None:
                 )
 
                 # Make a prediction using DataRobot's deployment API
-                predictions = make_pred_ai_deployment_predictions(
-                    prediction_row,
-                    max_explanations=number_of_explanations,  # Number of explanations you want (if applicable)
-                )
+                try:
+                    predictions = make_pred_ai_deployment_predictions(
+                        prediction_row,
+                        max_explanations=number_of_explanations,  # Number of explanations you want (if applicable)
+                        # Only this view highlights the text feature
+                        text_explanation_feature=app_settings.text_explanation_feature,
+                    )
+                except Exception as e:
+                    if not is_prediction_unavailable(e):
+                        raise
+                    logger.warning(f"Prediction for {selected_record} failed: {e}")
+                    st.error(
+                        gettext(
+                            "The prediction service is currently unavailable. "
+                            "Please try again in a minute."
+                        )
+                    )
+                    return
                 prediction = predictions[0]
                 # Extract the predicted label and its probability
                 predicted_label = prediction.predicted_label
@@ -367,12 +494,7 @@ def main() -> None:
                     # Add a bit of space for better layout
                     st.write("\n\n")
                     if predicted_label == app_settings.no_text_gen_label:
-                        generated_email = gettext(
-                            "Our model predicted that you are better off not "
-                            + "targeting {selected_record} with any email "
-                            + "offer. The best next step is to not take any "
-                            + "action."
-                        ).format(selected_record=selected_record)
+                        generated_email = no_action_message(selected_record)
 
                         st.error(generated_email)
                         return
@@ -382,13 +504,26 @@ def main() -> None:
                             f"Incorporating {st.session_state.numberOfExplanations} prediction explanations into the prompt"
                         )
                         # Generate the email content based on the prediction
-                        generation = get_llm_response(
-                            prediction,
-                            selected_record=selected_record,
-                            number_of_explanations=st.session_state.numberOfExplanations,
-                            tone=st.session_state.tone,
-                            verbosity=st.session_state.verbosity,
-                        )
+                        try:
+                            generation = get_llm_response(
+                                prediction,
+                                selected_record=selected_record,
+                                number_of_explanations=st.session_state.numberOfExplanations,
+                                tone=st.session_state.tone,
+                                verbosity=st.session_state.verbosity,
+                            )
+                        except Exception as e:
+                            # Only reached when there is no template to fall back to
+                            if not is_llm_unavailable(e):
+                                raise
+                            logger.warning(f"Email for {selected_record} failed: {e}")
+                            st.error(
+                                gettext(
+                                    "The email service is currently unavailable. "
+                                    "Please try again in a minute."
+                                )
+                            )
+                            return
                         st.session_state.unique_uuid = generation.association_id
 
                         # Update session state for the widget key before creating it
@@ -402,6 +537,24 @@ def main() -> None:
                             label_visibility="collapsed",
                             key="generated_email",
                         )
+                        if generation.source == "template":
+                            # No LLM call to score or attach feedback to
+                            st.warning(
+                                gettext(
+                                    "The email service is unavailable or too slow, "
+                                    "so this email was built from a template."
+                                )
+                            )
+                            return
+                        if generation.source == "cache":
+                            # Shared cache hit or served while the LLM is unavailable
+                            st.info(
+                                gettext(
+                                    "This email was generated earlier for this "
+                                    "customer with the same settings."
+                                )
+                            )
+                            return
 
                     with post_email_container:
                         feedback_buttons_fragment()
@@ -437,63 +590,121 @@ def main() -> None:
             label_visibility="visible",
         )
         st.session_state.csv = csv
+        budget = st.number_input(
+            gettext("Spending cap for the batch (0 for no cap):"),
+            min_value=0.0,
+            value=0.0,
+            step=1.0,
+            format="%.2f",
+            help=gettext(
+                "Jobs whose estimated LLM cost exceeds the cap are refused, and "
+                "running jobs stop once their actual cost reaches it."
+            ),
+        )
+        sweep = st.checkbox(
+            gettext("Compare all tones and verbosities"),
+            help=gettext(
+                "Draft one email per tone and verbosity combination for every "
+                "record, scoring the upload only once."
+            ),
+        )
+        templates_only = st.checkbox(
+            gettext("Template emails only (no LLM)"),
+            help=gettext(
+                "Build every email from a template of the prediction and its "
+                "explanations instead of the LLM. Fast and free, for very large "
+                "batches."
+            ),
+        )
         st.empty()
         st.write("\n\n")
-        run_button, download_button = st.columns([1, 1])
+        estimate_button, run_button = st.columns([1, 1])
+        estimate = estimate_button.button(gettext("Estimate Cost"))
         run = run_button.button(gettext("Generate Emails"))
-        if run and csv is not None:
-            st.write("\n\n")
-            st.session_state.bulk_generated = True
+        if (run or estimate) and csv is None:
+            st.error(gettext("Please upload a csv file to generate emails."))
+        elif (run or estimate) and csv is not None:
             scoring_data = pd.read_csv(csv)
-            count = len(scoring_data)
-            record_id = app_settings.record_identifier["column_name"]
-            status_bar = st.empty()
-
-            with st.spinner(
-                gettext("Analyzing {count} records...").format(count=count)
-            ):
-                predictions = make_pred_ai_deployment_predictions(
-                    df=scoring_data,
-                    max_explanations=st.session_state.numberOfExplanations,
+            # The same upload with the same settings maps to the same job of this
+            # owner, so running it again resumes from its checkpoint: rows that
+            # failed or fell back to templates are retried, the rest are reused
+            job_id = (
+                make_job_id(
+                    job_owner(),
+                    csv.getvalue(),
+                    st.session_state.numberOfExplanations,
+                    "sweep",
+                    app_settings.tones,
+                    app_settings.verbosity,
+                    *(["templates"] if templates_only else []),
                 )
-
-                status_bar.success(
-                    gettext("Predictions have been made! Generating emails...")
+                if sweep
+                else make_job_id(
+                    job_owner(),
+                    csv.getvalue(),
+                    st.session_state.numberOfExplanations,
+                    st.session_state.tone,
+                    st.session_state.verbosity,
+                    *(["templates"] if templates_only else []),
                 )
-
-            # st.session_state.bulk_prediction_results = predictions
-
-            with st.spinner(
-                gettext("Generating emails for {count} records...").format(count=count)
-            ):
-                emails = batch_email_responses(
-                    record_ids=scoring_data[record_id].to_list(),
-                    predictions=predictions,
-                    number_of_explanations=st.session_state.numberOfExplanations,
-                    tone=st.session_state.tone,
-                    verbosity=st.session_state.verbosity,
-                )
-
-            st.session_state.bulk_prediction_results = emails.to_csv(index=False)
-            status_bar.success(
-                gettext(
-                    "Finished! All {count} emails have been drafted and results have been saved."
-                ).format(count=count)
             )
+            if estimate and templates_only:
+                st.info(
+                    gettext("Template emails do not call the LLM and cost nothing.")
+                )
+            elif estimate:
+                with st.spinner(
+                    gettext("Analyzing {count} records...").format(
+                        count=len(scoring_data)
+                    )
+                ):
+                    cost_estimate = estimate_upload_cost(
+                        scoring_data,
+                        number_of_explanations=st.session_state.numberOfExplanations,
+                        tone=st.session_state.tone,
+                        verbosity=st.session_state.verbosity,
+                        job_id=job_id,
+                        sweep=sweep,
+                    )
+                st.info(
+                    gettext(
+                        "Estimated cost: **${total_cost:.4f}** for {llm_calls} LLM calls "
+                        "({input_tokens:,} input tokens, about {output_tokens:,} output "
+                        "tokens)."
+                    ).format(
+                        total_cost=cost_estimate.total_cost,
+                        llm_calls=cost_estimate.llm_calls,
+                        input_tokens=cost_estimate.input_tokens,
+                        output_tokens=cost_estimate.output_tokens,
+                    )
+                )
+            if run:
+                job = get_job_executor().submit(
+                    job_id,
+                    name=csv.name,
+                    owner=job_owner(),
+                    fn=partial(
+                        run_batch_job,
+                        scoring_data,
+                        number_of_explanations=st.session_state.numberOfExplanations,
+                        tone=st.session_state.tone,
+                        verbosity=st.session_state.verbosity,
+                        job_id=job_id,
+                        budget=budget or None,
+                        sweep=sweep,
+                        templates_only=templates_only,
+                    ),
+                )
+                st.session_state.selected_job_id = job.id
+                st.toast(
+                    gettext(
+                        "Job {job_id} submitted for {count} records. You can leave this "
+                        "page; the job keeps running in the background."
+                    ).format(job_id=job.id, count=len(scoring_data)),
+                )
 
-            st.dataframe(emails)
-        elif run:
-            status_bar.error(gettext("Please upload a csv file to generate emails."))  # type: ignore[used-before-def]
-
-        download = download_button.download_button(
-            "Download Results",
-            data=st.session_state.bulk_prediction_results,
-            file_name="emails.csv",
-            disabled=not st.session_state.bulk_generated,
-        )
-
-        if download:
-            st.success(gettext("Your download should start automatically."))
+        batch_jobs_fragment()
+        batch_job_results_fragment()
 
     with outcome_information:
         st.empty()
@@ -14,57 +14,50 @@
 from __future__ import annotations
 
 import itertools
-import subprocess
 import sys
-from typing import Any, Dict, List
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
 
 import pandas as pd
 import streamlit as st
-import yaml
 from pydantic import ValidationError
 
 sys.path.append("..")  # Adds the parent directory to the system path
+from nbo.cache import cache_key
+from nbo.costs import CostEstimate
 from nbo.custom_metrics import CUSTOM_METRICS, CustomMetric
-from nbo.predict import make_generative_deployment_predictions
-from nbo.resources import (
-    CustomMetricIds,
-    GenerativeDeployment,
-    PredAIDeployment,
+from nbo.pipeline import (
+    batch_email_responses,
+    create_llm_request,
+    create_prompt,
+    estimate_batch_cost,
+    estimate_sweep_cost,
+    load_app_settings,
+    render_template_email,
+    sweep_email_responses,
+    sweep_variants,
 )
+from nbo.predict import (
+    LLMConcurrencySettings,
+    get_generative_deployment_id,
+    get_pred_ai_deployment_id,
+    make_generative_deployment_predictions,
+    make_pred_ai_deployment_predictions,
+)
+from nbo.resources import CustomMetricIds
 from nbo.schema import (
     QUALITATIVE_STRENGTHS,
-    AppDataScienceSettings,
     Explanation,
     Generation,
-    LLMRequest,
-    OutcomeDetail,
     Prediction,
 )
 
-
-def get_stack_suffix() -> str:
-    try:
-        return (
-            "."
-            + subprocess.check_output(
-                ["pulumi", "stack", "--show-name", "--non-interactive"],
-                text=True,
-                stderr=subprocess.STDOUT,
-            ).strip()
-        )
-    except Exception:
-        pass
-    return ""
-
+app_settings = load_app_settings()
 
 try:
-    with open(f"app_settings{get_stack_suffix()}.yaml") as f:
-        app_settings = AppDataScienceSettings(**yaml.safe_load(f))
-
     custom_metric_ids = CustomMetricIds().custom_metric_ids
-    pred_ai_deployment_id = PredAIDeployment().id
-    generative_deployment_id = GenerativeDeployment().id
-except (FileNotFoundError, ValidationError) as e:
+except ValidationError as e:
     raise ValueError(
         (
             "Unable to read App settings. If running locally, verify you have selected "
@@ -73,16 +66,9 @@ except (FileNotFoundError, ValidationError) as e:
         )
     ) from e
 
-
-def set_outcome_details(
-    outcome_detail_list: List[OutcomeDetail],
-) -> Dict[str, OutcomeDetail]:
-    """Convert outcome details into a dictionary"""
-
-    return {
-        outcome_detail.prediction: outcome_detail
-        for outcome_detail in outcome_detail_list
-    }
+# Resolved once here so the app fails fast on a missing stack; nbo.predict reuses them
+pred_ai_deployment_id = get_pred_ai_deployment_id()
+generative_deployment_id = get_generative_deployment_id()
 
 
 def get_important_text_features(
@@ -162,11 +148,11 @@ def make_important_features_list(
             if isinstance(prediction_explanation.feature_value, (int, float))
             else prediction_explanation.feature_value
         )
+        # Check the feature first so only its n-grams get parsed
         if (
-            prediction_explanation.per_n_gram_text_explanation
+            prediction_explanation.feature_name == app_settings.text_explanation_feature
+            and prediction_explanation.per_n_gram_text_explanation
             and len(prediction_explanation.per_n_gram_text_explanation) > 0
-            and prediction_explanation.feature_name
-            == app_settings.text_explanation_feature
         ):
             text_explanations = get_important_text_features(
                 prediction_explanation.per_n_gram_text_explanation,
@@ -206,52 +192,6 @@ def make_important_features_list(
     return "\n\n".join(rsp), text_explanations  # type: ignore[return-value]
 
 
-def create_prompt(
-    prediction_data: Prediction,
-    selected_record: str,
-    number_of_explanations: int,
-    tone: str,
-    verbosity: str,
-) -> str:
-    email_prompt = app_settings.email_prompt
-    target_description = app_settings.target_probability_description
-
-    outcome_details = st.session_state.outcome_details
-
-    predicted_label = prediction_data.predicted_label
-    customer_predicted_label = outcome_details[predicted_label].label
-    outcome_description = outcome_details[predicted_label].description
-    prediction_explanations = prediction_data.explanations
-    prediction_explanations = [
-        pe for pe in prediction_explanations if abs(pe.strength) > 0
-    ]
-    rsp_list = []
-    for pe in prediction_explanations[:number_of_explanations]:
-        if pe.qualitative_strength not in QUALITATIVE_STRENGTHS:
-            pe.qualitative_strength = Explanation.create_qualitative_strength(
-                pe.strength
-            )
-        feature = pe.feature_name.replace("_", " ")
-        featureValue = (
-            float(pe.feature_value)
-            if isinstance(pe.feature_value, (int, float))
-            else pe.feature_value
-        )
-        explanation = f"-{feature} of {featureValue} {QUALITATIVE_STRENGTHS[pe.qualitative_strength]['label']} {target_description}"
-        rsp_list.append(explanation)
-    rsp = "\n\n".join(rsp_list)
-    prompt = email_prompt.format(
-        prediction_label=customer_predicted_label,
-        selected_record=selected_record,
-        outcome_description=outcome_description,
-        tone=tone,
-        verbosity=verbosity,
-        rsp=rsp,
-    )
-
-    return prompt
-
-
 def get_llm_response(
     prediction: Prediction,
     selected_record: str,
@@ -266,15 +206,19 @@ def get_llm_response(
         number_of_explanations=number_of_explanations,
         tone=tone,
         verbosity=verbosity,
+        app_settings=app_settings,
     )
 
-    # Get output
-    request = LLMRequest(
+    # Get output, or the template email if the LLM is unavailable
+    request = create_llm_request(
         prompt=prompt,
         number_of_explanations=number_of_explanations,
         tone=tone,
         verbosity=verbosity,
-        system_prompt=app_settings.system_prompt,
+        app_settings=app_settings,
+        fallback_content=render_template_email(
+            prediction, selected_record, number_of_explanations, app_settings
+        ),
     )
     generations = make_generative_deployment_predictions(
         [request],
@@ -283,51 +227,129 @@ def get_llm_response(
     return generations[0]
 
 
-def batch_email_responses(
-    record_ids: List[str],
-    predictions: List[Prediction],
+# Predictions of recent uploads, shared by all sessions and jobs in the process
+MAX_CACHED_UPLOADS = 8
+_upload_predictions: OrderedDict[str, tuple[List[str], List[Prediction]]] = (
+    OrderedDict()
+)
+_upload_predictions_lock = threading.Lock()
+
+
+def _upload_key(scoring_data: pd.DataFrame, number_of_explanations: int) -> str:
+    """Hash of the upload's contents, explanation count and PredAI deployment"""
+    return cache_key(
+        pd.util.hash_pandas_object(scoring_data, index=False).to_numpy().tobytes(),
+        list(map(str, scoring_data.columns)),
+        number_of_explanations,
+        pred_ai_deployment_id,
+    )
+
+
+def score_upload(
+    scoring_data: pd.DataFrame, number_of_explanations: int
+) -> tuple[List[str], List[Prediction]]:
+    """Score an uploaded batch and return its record ids and predictions.
+
+    Predictions only depend on the rows and the number of explanations, so
+    they are cached by those and reused when only the tone or verbosity
+    changes, or when a cost estimate is followed by a run.
+    """
+    key = _upload_key(scoring_data, number_of_explanations)
+    with _upload_predictions_lock:
+        if key in _upload_predictions:
+            _upload_predictions.move_to_end(key)
+            return _upload_predictions[key]
+    predictions = make_pred_ai_deployment_predictions(
+        df=scoring_data,
+        max_explanations=number_of_explanations,
+    )
+    record_ids = (
+        scoring_data[app_settings.record_identifier["column_name"]]
+        .astype(str)
+        .to_list()
+    )
+    with _upload_predictions_lock:
+        _upload_predictions[key] = record_ids, predictions
+        while len(_upload_predictions) > MAX_CACHED_UPLOADS:
+            _upload_predictions.popitem(last=False)
+    return record_ids, predictions
+
+
+def estimate_upload_cost(
+    scoring_data: pd.DataFrame,
     number_of_explanations: int,
     tone: str,
     verbosity: str,
-) -> pd.DataFrame:
-    prompts = []
-    for selected_record, prediction in zip(record_ids, predictions):
-        prompt = create_prompt(
-            prediction_data=prediction,
-            selected_record=selected_record,
+    job_id: str,
+    sweep: bool = False,
+) -> CostEstimate:
+    """Score an uploaded batch and estimate the cost of drafting its emails.
+
+    With `sweep`, the estimate covers every tone and verbosity combination.
+    """
+    record_ids, predictions = score_upload(scoring_data, number_of_explanations)
+    if sweep:
+        return estimate_sweep_cost(
+            record_ids=record_ids,
+            predictions=predictions,
             number_of_explanations=number_of_explanations,
-            tone=tone,
-            verbosity=verbosity,
+            variants=sweep_variants(app_settings),
+            app_settings=app_settings,
+            job_id=job_id,
         )
-        prompts.append(prompt)
-    llm_request_data = [
-        LLMRequest(
-            prompt=prompt,
+    return estimate_batch_cost(
+        record_ids=record_ids,
+        predictions=predictions,
+        number_of_explanations=number_of_explanations,
+        tone=tone,
+        verbosity=verbosity,
+        app_settings=app_settings,
+        job_id=job_id,
+    )
+
+
+def run_batch_job(
+    scoring_data: pd.DataFrame,
+    on_progress: Callable[[int, int], None],
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    job_id: str,
+    budget: Optional[float] = None,
+    sweep: bool = False,
+    templates_only: bool = False,
+) -> pd.DataFrame:
+    """Score an upload and draft its emails; runs on a background job thread.
+
+    With `sweep`, every tone and verbosity combination is drafted from the
+    same predictions and `tone` and `verbosity` are ignored. With
+    `templates_only`, emails are rendered from templates without the LLM.
+    """
+    record_ids, predictions = score_upload(scoring_data, number_of_explanations)
+    if sweep:
+        return sweep_email_responses(
+            record_ids=record_ids,
+            predictions=predictions,
             number_of_explanations=number_of_explanations,
-            tone=tone,
-            verbosity=verbosity,
-            system_prompt=app_settings.system_prompt,
+            app_settings=app_settings,
+            job_id=job_id,
+            on_progress=on_progress,
+            max_workers=LLMConcurrencySettings().max_concurrency,
+            budget=budget,
+            templates_only=templates_only,
         )
-        for prompt in prompts
-    ]
-    generations = make_generative_deployment_predictions(
-        llm_request_data,
-    )
-    emails = [generation.content for generation in generations]
-
-    outcome_details = st.session_state.outcome_details
-    predicted_labels = []
-    for prediction in predictions:
-        predicted_label = prediction.predicted_label
-        customer_predicted_label = outcome_details[predicted_label].label
-        predicted_labels.append(customer_predicted_label)
-
-    return pd.DataFrame(
-        {
-            "record_id": record_ids,
-            "label": predicted_labels,
-            "email": emails,
-        }
+    return batch_email_responses(
+        record_ids=record_ids,
+        predictions=predictions,
+        number_of_explanations=number_of_explanations,
+        tone=tone,
+        verbosity=verbosity,
+        app_settings=app_settings,
+        job_id=job_id,
+        on_progress=on_progress,
+        max_workers=LLMConcurrencySettings().max_concurrency,
+        budget=budget,
+        templates_only=templates_only,
     )
 
 
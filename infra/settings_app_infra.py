@@ -96,8 +96,16 @@ def get_app_files(
             (str(nbo_path / "__init__.py"), "nbo/__init__.py"),
             (str(nbo_path / "schema.py"), "nbo/schema.py"),
             (str(nbo_path / "i18n.py"), "nbo/i18n.py"),
+            (str(nbo_path / "cache.py"), "nbo/cache.py"),
+            (str(nbo_path / "concurrency.py"), "nbo/concurrency.py"),
+            (str(nbo_path / "costs.py"), "nbo/costs.py"),
+            (str(nbo_path / "jobs.py"), "nbo/jobs.py"),
+            (str(nbo_path / "pipeline.py"), "nbo/pipeline.py"),
+            (str(nbo_path / "policy.py"), "nbo/policy.py"),
             (str(nbo_path / "predict.py"), "nbo/predict.py"),
             (str(nbo_path / "resources.py"), "nbo/resources.py"),
+            (str(nbo_path / "telemetry.py"), "nbo/telemetry.py"),
+            (str(nbo_path / "transport.py"), "nbo/transport.py"),
             (str(nbo_path / "credentials.py"), "nbo/credentials.py"),
             (str(nbo_path / "urls.py"), "nbo/urls.py"),
             (str(nbo_path / "custom_metrics.py"), "nbo/custom_metrics.py"),
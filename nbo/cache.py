@@ -0,0 +1,436 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Generic, Iterator, Optional, TypeVar, cast
+
+import redis
+from pydantic import AliasChoices, Field
+from pydantic_settings import BaseSettings
+
+from nbo.telemetry import runtime_metrics
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+
+shared_cache_url_env_name: str = "NBO_SHARED_CACHE_URL"
+shared_cache_ttl_env_name: str = "NBO_SHARED_CACHE_TTL_SECONDS"
+shared_cache_max_entries_env_name: str = "NBO_SHARED_CACHE_MAX_ENTRIES"
+
+
+class SharedCacheSettings(BaseSettings):
+    """Result cache shared by app replicas, disabled unless `url` is set.
+
+    `url` is `sqlite:///<path>` for a SQLite file on a shared volume or
+    `redis://<host>:<port>/<db>` (or `rediss://`) for a Redis-compatible server.
+    """
+
+    url: Optional[str] = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + shared_cache_url_env_name,
+            shared_cache_url_env_name,
+        ),
+        default=None,
+    )
+    ttl_seconds: float = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + shared_cache_ttl_env_name,
+            shared_cache_ttl_env_name,
+        ),
+        default=24 * 60 * 60,
+        gt=0,
+    )
+    max_entries: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + shared_cache_max_entries_env_name,
+            shared_cache_max_entries_env_name,
+        ),
+        default=100_000,
+        ge=1,
+    )
+
+
+def cache_key(*parts: Any) -> str:
+    """Stable hash of JSON-serializable parts"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode()
+        digest.update(part)
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class LRUCache(Generic[V]):
+    """Thread-safe in-memory mapping that evicts the least recently used entry.
+
+    Entries set with `ttl_seconds` are treated as missing once they expire.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[V, Optional[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[V]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: V, ttl_seconds: Optional[float] = None) -> None:
+        expires_at = None if ttl_seconds is None else time.monotonic() + ttl_seconds
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+@dataclass
+class _Flight:
+    done: threading.Event = field(default_factory=threading.Event)
+    result: Any = None
+    error: Optional[BaseException] = None
+
+
+class SingleFlight(Generic[V]):
+    """Share one in-flight call among concurrent callers with the same key.
+
+    The first caller of `do` for a key runs the call; callers arriving while
+    it runs wait for it and get the same result, or the same exception. The
+    key is forgotten as soon as the call finishes, so this coalesces
+    duplicate concurrent work without caching anything. Waiting callers are
+    counted as `{name}.coalesced`.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, call: Callable[[], V]) -> V:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            runtime_metrics.increment(f"{self.name}.coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return cast(V, flight.result)
+        try:
+            flight.result = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return cast(V, flight.result)
+
+
+class SharedCache(ABC):
+    """Byte values with a time to live, shared by processes and replicas"""
+
+    tier: str
+    ttl_seconds: float
+
+    @abstractmethod
+    def get_many(self, keys: list[str]) -> list[Optional[bytes]]:
+        """Values of `keys`, None for missing or expired keys"""
+
+    @abstractmethod
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        """Store `items`, evicting expired and, if full, the oldest entries"""
+
+
+class SQLiteCache(SharedCache):
+    """Shared cache in a SQLite file, e.g. on a volume mounted by every replica.
+
+    The default rollback journal is kept because WAL mode does not work on
+    network file systems. Every `prune_every` writes of this process, expired
+    entries are dropped and, once there are more than `max_entries`, the
+    oldest ones are deleted, so most writes do not scan the table while
+    holding the database's write lock.
+    """
+
+    tier = "sqlite"
+    # Stay below SQLite's limit on the number of query parameters
+    _batch_size = 500
+
+    def __init__(
+        self,
+        db_path: Path,
+        ttl_seconds: float,
+        max_entries: int,
+        prune_every: int = 100,
+    ):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    stored_at REAL NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (stored_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get_many(self, keys: list[str]) -> list[Optional[bytes]]:
+        found: Dict[str, bytes] = {}
+        with self._connect() as conn:
+            for start in range(0, len(keys), self._batch_size):
+                batch = keys[start : start + self._batch_size]
+                rows = conn.execute(
+                    f"SELECT key, value FROM cache WHERE expires_at > ? "
+                    f"AND key IN ({', '.join('?' * len(batch))})",
+                    (time.time(), *batch),
+                )
+                found.update(rows)
+        return [found.get(key) for key in keys]
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        now = time.time()
+        with self._writes_lock:
+            self._writes += 1
+            prune = self._writes % self.prune_every == 0
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO cache (key, value, stored_at, expires_at) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (key, value, now, now + self.ttl_seconds)
+                    for key, value in items.items()
+                ],
+            )
+            if not prune:
+                return
+            conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+            (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY stored_at LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+
+class RedisCache(SharedCache):
+    """Shared cache on a server speaking the Redis protocol.
+
+    Entries expire after `ttl_seconds`; the number of entries is bounded by the
+    server's `maxmemory` eviction policy (e.g. `allkeys-lru`), not here.
+    """
+
+    tier = "redis"
+    _batch_size = 1000
+
+    def __init__(self, url: str, ttl_seconds: float, prefix: str = "nbo:"):
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        # RESP2, which Redis-compatible servers without RESP3 (HELLO 3) accept
+        self._client = redis.Redis.from_url(url, socket_timeout=5, protocol=2)
+
+    def get_many(self, keys: list[str]) -> list[Optional[bytes]]:
+        values: list[Optional[bytes]] = []
+        for start in range(0, len(keys), self._batch_size):
+            batch = keys[start : start + self._batch_size]
+            values += cast(
+                list[Optional[bytes]],
+                self._client.mget([self.prefix + key for key in batch]),
+            )
+        return values
+
+    def set_many(self, items: Dict[str, bytes]) -> None:
+        with self._client.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(self.prefix + key, value, px=int(self.ttl_seconds * 1000))
+            pipe.execute()
+
+
+def open_shared_cache(settings: SharedCacheSettings) -> Optional[SharedCache]:
+    """The shared cache configured by `NBO_SHARED_CACHE_URL`, if any"""
+    url = settings.url
+    if not url:
+        return None
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(
+            Path(url.removeprefix("sqlite:///")),
+            settings.ttl_seconds,
+            settings.max_entries,
+        )
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url, settings.ttl_seconds)
+    raise ValueError(
+        f"Unsupported {shared_cache_url_env_name} {url!r}: "
+        "expected sqlite:///<path> or redis://<host>:<port>/<db>"
+    )
+
+
+_shared_cache: Optional[SharedCache] = None
+_shared_cache_opened = False
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_cache() -> Optional[SharedCache]:
+    """The process's shared cache, opened on first use.
+
+    A cache that cannot be opened (bad URL, unwritable volume) is logged and
+    the process runs without the shared tier.
+    """
+    global _shared_cache, _shared_cache_opened
+    with _shared_cache_lock:
+        if not _shared_cache_opened:
+            _shared_cache_opened = True
+            settings = SharedCacheSettings()
+            try:
+                _shared_cache = open_shared_cache(settings)
+            except (ValueError, redis.RedisError, sqlite3.Error, OSError) as e:
+                runtime_metrics.increment("cache.shared.open_errors")
+                logger.error(
+                    f"Could not open the shared cache {settings.url!r}: {e}; "
+                    "running without it"
+                )
+        return _shared_cache
+
+
+class ResultCache(Generic[V]):
+    """In-memory LRU tier in front of an optional shared tier.
+
+    The shared tier is returned by `open_shared`, called on first use. Values
+    found only in the shared tier are copied into memory, and with a shared
+    tier memory entries expire after its TTL too, so replicas stop serving a
+    result once it has expired from the shared tier. Errors of the shared
+    tier and entries that cannot be decoded are logged and treated as misses,
+    so an unreachable or incompatible cache never fails a request. Hits and
+    misses are counted per tier as `{name}.cache.<tier>.hits` and `.misses`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int,
+        encode: Callable[[V], bytes],
+        decode: Callable[[bytes], V],
+        open_shared: Optional[Callable[[], Optional[SharedCache]]] = None,
+    ):
+        self.name = name
+        self.memory: LRUCache[V] = LRUCache(max_entries)
+        self._open_shared = open_shared
+        self._encode = encode
+        self._decode = decode
+
+    @property
+    def shared(self) -> Optional[SharedCache]:
+        return self._open_shared() if self._open_shared is not None else None
+
+    def _count(self, tier: str, hits: int, misses: int) -> None:
+        if hits:
+            runtime_metrics.increment(f"{self.name}.cache.{tier}.hits", hits)
+        if misses:
+            runtime_metrics.increment(f"{self.name}.cache.{tier}.misses", misses)
+
+    def get_many(self, keys: list[str]) -> list[Optional[V]]:
+        values = [self.memory.get(key) for key in keys]
+        missing = [index for index, value in enumerate(values) if value is None]
+        self._count("memory", len(keys) - len(missing), len(missing))
+        shared = self.shared
+        if not missing or shared is None:
+            return values
+        try:
+            shared_values = shared.get_many([keys[index] for index in missing])
+        except (redis.RedisError, sqlite3.Error, OSError) as e:
+            runtime_metrics.increment(f"{self.name}.cache.{shared.tier}.errors")
+            logger.warning(f"Could not read the {shared.tier} cache: {e}")
+            return values
+        hits = 0
+        for index, raw in zip(missing, shared_values):
+            if raw is None:
+                continue
+            try:
+                value = self._decode(raw)
+            except (ValueError, KeyError, TypeError) as e:
+                # Corrupt, or written by a replica with a different schema
+                runtime_metrics.increment(
+                    f"{self.name}.cache.{shared.tier}.decode_errors"
+                )
+                logger.warning(f"Ignoring undecodable {shared.tier} cache entry: {e}")
+                continue
+            self.memory.set(keys[index], value, shared.ttl_seconds)
+            values[index] = value
+            hits += 1
+        self._count(shared.tier, hits, len(missing) - hits)
+        return values
+
+    def set_many(self, items: Dict[str, V]) -> None:
+        shared = self.shared
+        ttl_seconds = shared.ttl_seconds if shared is not None else None
+        for key, value in items.items():
+            self.memory.set(key, value, ttl_seconds)
+        if shared is None or not items:
+            return
+        try:
+            shared.set_many({key: self._encode(value) for key, value in items.items()})
+        except (redis.RedisError, sqlite3.Error, OSError) as e:
+            runtime_metrics.increment(f"{self.name}.cache.{shared.tier}.errors")
+            logger.warning(f"Could not write the {shared.tier} cache: {e}")
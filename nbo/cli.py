@@ -0,0 +1,325 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Score a file and draft emails for every record without the Streamlit app.
+
+Example
+-------
+    python -m nbo.cli scoring.csv emails.parquet --concurrency 16 --chunk-size 500
+
+Each chunk runs as a checkpointed job (see `nbo.jobs`), so rerunning the same
+command after a failure only generates the emails that are still missing.
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+from typing import Optional, Sequence
+
+import pandas as pd
+
+from nbo.costs import (
+    BudgetExceededError,
+    CostEstimate,
+    SpendTracker,
+    check_budget,
+    estimate_cost,
+)
+from nbo.jobs import make_job_id
+from nbo.pipeline import (
+    batch_email_responses,
+    create_batch_llm_requests,
+    load_app_settings,
+    pending_llm_requests,
+    sweep_email_responses,
+    sweep_variants,
+    variant_column,
+)
+from nbo.predict import (
+    LLMConcurrencySettings,
+    configure_llm_concurrency,
+    make_pred_ai_deployment_predictions,
+)
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = ("csv", "parquet", "jsonl")
+
+
+def read_input(path: Path) -> pd.DataFrame:
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def write_output(df: pd.DataFrame, path: Path, output_format: str) -> None:
+    if output_format == "parquet":
+        df.to_parquet(path, index=False)
+    elif output_format == "jsonl":
+        df.to_json(path, orient="records", lines=True, force_ascii=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m nbo.cli",
+        description="Score records with the PredAI deployment and draft an email "
+        "for each one with the generative deployment.",
+    )
+    parser.add_argument("input", type=Path, help="CSV or Parquet file to score")
+    parser.add_argument("output", type=Path, help="File to write the emails to")
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=OUTPUT_FORMATS,
+        help="Output format (default: inferred from the output file extension)",
+    )
+    parser.add_argument(
+        "--settings",
+        type=Path,
+        help="App settings YAML (default: app_settings.<stack>.yaml)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=LLMConcurrencySettings().max_concurrency,
+        help="Maximum number of concurrent LLM requests",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of records scored per prediction request",
+    )
+    parser.add_argument(
+        "--number-of-explanations",
+        type=int,
+        help="Prediction explanations passed to the prompt "
+        "(default: from the app settings)",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        help="Refuse to start, or stop early, if the LLM cost would exceed this "
+        "amount (in the currency of the model spec prices)",
+    )
+    parser.add_argument(
+        "--estimate-only",
+        action="store_true",
+        help="Score the records and print the estimated LLM cost without "
+        "generating any email",
+    )
+    parser.add_argument("--tone", help="Email tone (default: first configured tone)")
+    parser.add_argument(
+        "--verbosity", help="Email verbosity (default: first configured verbosity)"
+    )
+    parser.add_argument(
+        "--records-per-call",
+        type=int,
+        default=1,
+        help="Pack this many records into each LLM call and split the emails "
+        "from its JSON output; records that cannot be parsed are retried one "
+        "per call",
+    )
+    parser.add_argument(
+        "--templates-only",
+        action="store_true",
+        help="Render every email from a template built from the prediction "
+        "explanations, without calling the LLM (no cost)",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Draft one email per record for every configured tone and verbosity "
+        "combination and write them side by side, one column per combination",
+    )
+    args = parser.parse_args(argv)
+
+    if args.output_format is None:
+        suffix = args.output.suffix.lstrip(".")
+        args.output_format = suffix if suffix in OUTPUT_FORMATS else "csv"
+    if args.concurrency < 1 or args.chunk_size < 1 or args.records_per_call < 1:
+        parser.error(
+            "--concurrency, --chunk-size and --records-per-call must be positive"
+        )
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    args = parse_args(argv)
+    app_settings = load_app_settings(args.settings)
+
+    number_of_explanations = (
+        args.number_of_explanations
+        if args.number_of_explanations is not None
+        else app_settings.default_number_of_explanations
+    )
+    tone = args.tone or app_settings.tones[0]
+    verbosity = args.verbosity or app_settings.verbosity[0]
+    if tone not in app_settings.tones or verbosity not in app_settings.verbosity:
+        logger.error(
+            f"Tone must be one of {app_settings.tones} and verbosity one of "
+            f"{app_settings.verbosity}"
+        )
+        return 2
+
+    if args.sweep and (args.tone or args.verbosity):
+        logger.error("--sweep drafts every tone and verbosity; drop --tone/--verbosity")
+        return 2
+    variants = sweep_variants(app_settings) if args.sweep else [(tone, verbosity)]
+
+    configure_llm_concurrency(args.concurrency)
+
+    scoring_data = read_input(args.input)
+    record_id = app_settings.record_identifier["column_name"]
+    scoring_data[record_id] = scoring_data[record_id].astype(str)
+    total = len(scoring_data)
+    logger.info(f"Scoring {total} records from {args.input}")
+
+    scored = []
+    for start in range(0, total, args.chunk_size):
+        chunk = scoring_data.iloc[start : start + args.chunk_size].reset_index(
+            drop=True
+        )
+        predictions = make_pred_ai_deployment_predictions(
+            df=chunk, max_explanations=number_of_explanations
+        )
+        job_id = make_job_id(
+            pd.util.hash_pandas_object(chunk, index=False).to_numpy().tobytes(),
+            number_of_explanations,
+            *(["sweep", variants] if args.sweep else [tone, verbosity]),
+        )
+        scored.append((chunk[record_id].to_list(), predictions, job_id))
+        logger.info(f"Scored {min(start + args.chunk_size, total)} of {total} records")
+
+    # Pre-flight: one token count over every prompt that still has to be
+    # generated, only to enforce a budget or when asked for
+    estimate: Optional[CostEstimate] = None
+    if args.templates_only:
+        estimate = CostEstimate(
+            llm_calls=0, input_tokens=0, output_tokens=0, input_cost=0, output_cost=0
+        )
+    elif args.estimate_only or args.budget is not None:
+        estimate = estimate_cost(
+            [
+                llm_request
+                for record_ids, predictions, job_id in scored
+                for llm_request in pending_llm_requests(
+                    [
+                        llm_request
+                        for variant_tone, variant_verbosity in variants
+                        for llm_request in create_batch_llm_requests(
+                            record_ids,
+                            predictions,
+                            number_of_explanations,
+                            variant_tone,
+                            variant_verbosity,
+                            app_settings,
+                        ).values()
+                    ],
+                    job_id,
+                )
+            ],
+            app_settings,
+            args.records_per_call,
+        )
+    if estimate is not None:
+        logger.info(
+            f"Estimated cost of {estimate.llm_calls} LLM calls: "
+            f"${estimate.total_cost:.4f} ({estimate.input_tokens} input and "
+            f"~{estimate.output_tokens} output tokens)"
+        )
+    if args.estimate_only:
+        return 0
+
+    spend = (
+        SpendTracker(app_settings.model_spec, args.budget)
+        if args.budget is not None
+        else None
+    )
+    results = []
+    drafted = 0
+    try:
+        if estimate is not None:
+            check_budget(estimate, args.budget)
+        for record_ids, predictions, job_id in scored:
+            results.append(
+                sweep_email_responses(
+                    record_ids=record_ids,
+                    predictions=predictions,
+                    number_of_explanations=number_of_explanations,
+                    app_settings=app_settings,
+                    variants=variants,
+                    job_id=job_id,
+                    max_workers=args.concurrency,
+                    spend=spend,
+                    records_per_call=args.records_per_call,
+                    templates_only=args.templates_only,
+                )
+                if args.sweep
+                else batch_email_responses(
+                    record_ids=record_ids,
+                    predictions=predictions,
+                    number_of_explanations=number_of_explanations,
+                    tone=tone,
+                    verbosity=verbosity,
+                    app_settings=app_settings,
+                    job_id=job_id,
+                    max_workers=args.concurrency,
+                    spend=spend,
+                    records_per_call=args.records_per_call,
+                    templates_only=args.templates_only,
+                )
+            )
+            drafted += len(record_ids)
+            logger.info(f"Drafted {drafted} of {total} emails")
+    except BudgetExceededError as e:
+        logger.error(f"{e}. Completed emails are checkpointed under the job directory.")
+        return 3
+
+    skipped_llm_calls = sum(result.attrs["skipped_llm_calls"] for result in results)
+    template_emails = sum(result.attrs["template_emails"] for result in results)
+    emails = (
+        pd.concat(results, ignore_index=True)
+        if results
+        else pd.DataFrame(
+            columns=[
+                "record_id",
+                "label",
+                *(
+                    [variant_column(*variant) for variant in variants]
+                    if args.sweep
+                    else ["email", "source"]
+                ),
+            ]
+        )
+    )
+    write_output(emails, args.output, args.output_format)
+    logger.info(
+        f"Wrote {len(emails)} emails to {args.output} "
+        f"({skipped_llm_calls} no-action records skipped the LLM, "
+        f"{template_emails} template emails"
+        + (f", ${spend.spent:.4f} spent)" if spend is not None else ")")
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import datetime as dt
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Iterator, Mapping, Optional
+
+from nbo.policy import SlotTimeoutError
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Return the delay in seconds requested by a `Retry-After` header, if any"""
+    value = headers.get("retry-after") or headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+class AdaptiveConcurrencyLimiter:
+    """Additive-increase/multiplicative-decrease limit on in-flight requests.
+
+    The window grows by one request per window's worth of healthy completions,
+    i.e. roughly +1 per round trip, as long as latency stays within
+    `latency_tolerance` times the best latency seen recently. A throttling
+    signal (429, 5xx, timeout) multiplies the window by `backoff` and, if the
+    server sent `Retry-After`, holds back new requests until then. Requests that
+    were already in flight when the window was cut do not cut it again, so one
+    overload episode shrinks the window once rather than once per failure.
+
+    Parameters
+    ----------
+    max_limit : int
+        Upper bound of the window, i.e. the configured concurrency budget.
+    initial_limit : int, optional
+        Starting window, half of `max_limit` by default.
+    min_limit : int
+        Lower bound of the window.
+    backoff : float
+        Factor applied to the window on a throttling signal.
+    latency_tolerance : float
+        Completions slower than this multiple of the baseline latency do not
+        grow the window.
+    """
+
+    def __init__(
+        self,
+        max_limit: int,
+        initial_limit: Optional[int] = None,
+        min_limit: int = 1,
+        backoff: float = 0.5,
+        latency_tolerance: float = 2.0,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.window = float(
+            initial_limit if initial_limit is not None else max(1, max_limit // 2)
+        )
+        self.in_flight = 0
+        self._baseline_latency: Optional[float] = None
+        self._blocked_until = 0.0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, timeout: Optional[float] = None) -> Iterator[None]:
+        """Wait for room in the window (and any Retry-After), then hold a slot.
+
+        Raises `SlotTimeoutError` if no slot frees up within `timeout` seconds.
+        """
+        give_up_at = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = self._blocked_until - now
+                if wait <= 0 and self.in_flight < int(self.window):
+                    break
+                if give_up_at is not None:
+                    if now >= give_up_at:
+                        raise SlotTimeoutError(
+                            f"No concurrency slot within {timeout:g}s"
+                        )
+                    wait = min(wait, give_up_at - now) if wait > 0 else give_up_at - now
+                self._condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify_all()
+
+    def on_success(self, latency: float) -> None:
+        with self._condition:
+            if self._baseline_latency is None or latency < self._baseline_latency:
+                self._baseline_latency = latency
+            else:
+                # Let the baseline drift up slowly so a permanently slower
+                # deployment does not freeze the window forever
+                self._baseline_latency += 0.01 * (latency - self._baseline_latency)
+            if latency <= self.latency_tolerance * self._baseline_latency:
+                self.window = min(self.max_limit, self.window + 1 / self.window)
+            self._condition.notify_all()
+
+    def on_throttle(self, started: float, retry_after: Optional[float] = None) -> None:
+        """Back off after a request sent at `started` (`time.monotonic()`) was throttled"""
+        with self._condition:
+            now = time.monotonic()
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+            if started < self._last_decrease:
+                return
+            self._last_decrease = now
+            self.window = max(self.min_limit, self.window * self.backoff)
+            logger.warning(
+                f"LLM deployment throttled; concurrency window reduced to "
+                f"{int(self.window)}"
+                + (f", pausing for {retry_after:.1f}s" if retry_after else "")
+            )
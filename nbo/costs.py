@@ -0,0 +1,135 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import sys
+import threading
+from typing import Optional
+
+import tiktoken
+from pydantic import BaseModel
+
+from nbo.predict import packed_prompt
+from nbo.schema import AppDataScienceSettings, Generation, LLMModelSpec, LLMRequest
+
+ENCODING_NAME = "cl100k_base"
+
+
+class CostEstimate(BaseModel):
+    llm_calls: int
+    input_tokens: int
+    output_tokens: int
+    input_cost: float
+    output_cost: float
+
+    @property
+    def total_cost(self) -> float:
+        return self.input_cost + self.output_cost
+
+
+class BudgetExceededError(RuntimeError):
+    """Raised when a batch would cost, or has cost, more than its budget"""
+
+
+def count_tokens(texts: list[str], encoding_name: str = ENCODING_NAME) -> list[int]:
+    """Count the tokens of many texts with a single batched tokenizer call"""
+    encoding = tiktoken.get_encoding(encoding_name)
+    return [len(tokens) for tokens in encoding.encode_batch(texts)]
+
+
+def _price(tokens: int, price_per_1k_tokens: float) -> float:
+    return tokens / 1000 * price_per_1k_tokens
+
+
+def estimate_cost(
+    requests: list[LLMRequest],
+    app_settings: AppDataScienceSettings,
+    records_per_call: int = 1,
+) -> CostEstimate:
+    """Project the LLM cost of a batch before any request is sent.
+
+    Input tokens are counted exactly from the system prompt and prompt of each
+    call; output tokens are projected from the expected length of the
+    request's verbosity level, capped at the request's `max_tokens`, for each
+    of its `variants`. With `records_per_call` > 1, consecutive requests are
+    packed into one call as `make_packed_generative_deployment_predictions`
+    does, sharing one system prompt and ignoring `variants`.
+    """
+    calls = [
+        requests[start : start + records_per_call]
+        for start in range(0, len(requests), records_per_call)
+    ]
+    input_tokens = sum(
+        count_tokens(
+            [call[0].system_prompt for call in calls]
+            + [
+                call[0].prompt if len(call) == 1 else packed_prompt(call)
+                for call in calls
+            ]
+        )
+    )
+    output_tokens = sum(
+        min(
+            app_settings.get_verbosity_profile(
+                llm_request.verbosity
+            ).expected_output_tokens,
+            llm_request.max_tokens or sys.maxsize,
+        )
+        * (llm_request.variants if len(call) == 1 else 1)
+        for call in calls
+        for llm_request in call
+    )
+    model_spec = app_settings.model_spec
+    return CostEstimate(
+        llm_calls=len(calls),
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        input_cost=_price(input_tokens, model_spec.input_price_per_1k_tokens),
+        output_cost=_price(output_tokens, model_spec.output_price_per_1k_tokens),
+    )
+
+
+def check_budget(estimate: CostEstimate, budget: Optional[float]) -> None:
+    if budget is not None and estimate.total_cost > budget:
+        raise BudgetExceededError(
+            f"Estimated cost ${estimate.total_cost:.4f} for {estimate.llm_calls} "
+            f"LLM calls exceeds the budget of ${budget:.4f}"
+        )
+
+
+class SpendTracker:
+    """Running total of the actual cost of the generations of one batch"""
+
+    def __init__(self, model_spec: LLMModelSpec, budget: Optional[float] = None):
+        self.model_spec = model_spec
+        self.budget = budget
+        self.spent = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, llm_request: LLMRequest, generation: Generation) -> None:
+        if generation.source != "llm":
+            return
+        input_tokens, output_tokens = count_tokens(
+            [llm_request.system_prompt + llm_request.prompt, generation.content]
+        )
+        cost = _price(input_tokens, self.model_spec.input_price_per_1k_tokens) + _price(
+            output_tokens, self.model_spec.output_price_per_1k_tokens
+        )
+        with self._lock:
+            self.spent += cost
+
+    @property
+    def exceeded(self) -> bool:
+        return self.budget is not None and self.spent >= self.budget
@@ -0,0 +1,436 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import datetime as dt
+import json
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Iterator, Optional
+
+import pandas as pd
+from pydantic import AliasChoices, BaseModel, Field, ValidationError
+from pydantic_settings import BaseSettings
+
+from nbo.cache import cache_key
+from nbo.costs import BudgetExceededError, SpendTracker
+from nbo.predict import (
+    make_generative_deployment_predictions,
+    make_packed_generative_deployment_predictions,
+    template_generation,
+)
+from nbo.schema import Generation, LLMRequest
+
+logger = logging.getLogger(__name__)
+
+job_dir_env_name: str = "NBO_JOB_DIR"
+max_concurrent_jobs_env_name: str = "NBO_MAX_CONCURRENT_JOBS"
+
+
+class JobSettings(BaseSettings):
+    """Location of batch job checkpoints and size of the background job pool"""
+
+    job_dir: Path = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + job_dir_env_name,
+            job_dir_env_name,
+        ),
+        default=Path(tempfile.gettempdir()) / "nbo_jobs",
+    )
+    max_concurrent_jobs: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + max_concurrent_jobs_env_name,
+            max_concurrent_jobs_env_name,
+        ),
+        default=4,
+        gt=0,
+    )
+
+
+def make_job_id(*parts: Any) -> str:
+    """Derive a stable job id from the batch inputs.
+
+    Submitting the same upload with the same prompt settings yields the same id,
+    so a rerun picks up the checkpoint of the interrupted run. Include the job
+    owner in `parts` so that owners never share a job.
+    """
+    return cache_key(*parts)[:16]
+
+
+class BatchCheckpoint:
+    """Append-only JSONL record of the generations a batch job has completed.
+
+    Each line holds the row index and the generation for that row. A partially
+    written last line (e.g. the process was killed mid-write) is ignored on load.
+    """
+
+    def __init__(self, job_id: str, job_dir: Optional[Path] = None):
+        self.job_id = job_id
+        self.job_dir = job_dir or JobSettings().job_dir
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> Path:
+        return self.job_dir / f"{self.job_id}.jsonl"
+
+    def load(self) -> dict[int, Generation]:
+        """Return completed generations keyed by row index"""
+        completed: dict[int, Generation] = {}
+        if not self.path.exists():
+            return completed
+        with self.path.open(encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    completed[int(row["index"])] = Generation(**row["generation"])
+                except (json.JSONDecodeError, KeyError, ValidationError):
+                    logger.warning(
+                        f"Skipping unreadable checkpoint line in {self.path}"
+                    )
+        return completed
+
+    def load_completed(self, requests: list[LLMRequest]) -> dict[int, Generation]:
+        """Return the checkpointed generations that still match their row's prompt"""
+        return {
+            index: generation
+            for index, generation in self.load().items()
+            if index < len(requests)
+            and generation.prompt_used == requests[index].prompt
+        }
+
+    def save(self, index: int, generation: Generation) -> None:
+        """Persist one completed row"""
+        line = json.dumps({"index": index, "generation": generation.model_dump()})
+        with self._lock:
+            self.job_dir.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+
+    def delete(self) -> None:
+        with self._lock:
+            self.path.unlink(missing_ok=True)
+
+
+def run_generation_job(
+    job_id: str,
+    requests: list[LLMRequest],
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    max_workers: int = 1,
+    spend: Optional[SpendTracker] = None,
+    records_per_call: int = 1,
+    templates_only: bool = False,
+) -> list[Generation]:
+    """Generate a response for every request, checkpointing each row as it finishes.
+
+    Rows already present in the job's checkpoint are reused instead of being sent
+    to the LLM again, so a job that failed or was interrupted only retries the
+    rows it is missing. Template emails are not checkpointed. After the first error no new rows are started; rows
+    already in flight are still checkpointed before the error is re-raised.
+
+    Parameters
+    ----------
+    job_id : str
+        Identifier of the job, see `make_job_id`.
+    requests : list[LLMRequest]
+        One request per batch row, in row order.
+    on_progress : Callable[[int, int], None], optional
+        Called with (completed, total) after each row.
+    max_workers : int
+        Number of rows generated in parallel. In-flight LLM calls are further
+        capped by the process-wide `NBO_LLM_MAX_CONCURRENCY` budget.
+    spend : SpendTracker, optional
+        Accumulates the cost of the rows generated by this run. Once its budget
+        is used up no new rows are started and `BudgetExceededError` is raised.
+        Rows reused from the checkpoint cost nothing.
+    records_per_call : int
+        Rows packed into one completion, see
+        `make_packed_generative_deployment_predictions`. Requests must then
+        share their system prompt.
+    templates_only : bool
+        Render every row with `template_generation` instead of calling the LLM.
+    """
+    checkpoint = BatchCheckpoint(job_id)
+    completed = checkpoint.load_completed(requests)
+    total = len(requests)
+    if completed:
+        logger.info(
+            f"Resuming job {job_id}: {len(completed)} of {total} rows already generated"
+        )
+    if on_progress is not None:
+        on_progress(len(completed), total)
+
+    def generate(indices: list[int]) -> list[Generation]:
+        batch = [requests[index] for index in indices]
+        if templates_only:
+            return [template_generation(llm_request) for llm_request in batch]
+        if len(batch) == 1:
+            return make_generative_deployment_predictions(batch)
+        return make_packed_generative_deployment_predictions(batch)
+
+    remaining = [index for index in range(total) if index not in completed]
+    error: Optional[Exception] = None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(generate, indices): indices
+            for indices in (
+                remaining[start : start + records_per_call]
+                for start in range(0, len(remaining), records_per_call)
+            )
+        }
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            try:
+                generations = future.result()
+            except Exception as e:
+                if error is None:
+                    error = e
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            for index, generation in zip(futures[future], generations):
+                # Templates cost nothing to render again, and a rerun of the
+                # job should try the LLM for them
+                if generation.source != "template":
+                    checkpoint.save(index, generation)
+                completed[index] = generation
+                if spend is not None:
+                    spend.record(requests[index], generation)
+            if on_progress is not None:
+                on_progress(len(completed), total)
+            if spend is not None and spend.exceeded and error is None:
+                error = BudgetExceededError(
+                    f"Spent ${spend.spent:.4f} of the ${spend.budget:.4f} budget; "
+                    f"stopped with {len(completed)} of {total} rows generated"
+                )
+                for pending in futures:
+                    pending.cancel()
+
+    if error is not None:
+        raise error
+    return [completed[index] for index in range(total)]
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class JobRecord(BaseModel):
+    id: str
+    name: str
+    status: JobStatus
+    owner: Optional[str] = None
+    completed: int = 0
+    total: int = 0
+    error: Optional[str] = None
+    created_at: dt.datetime
+    updated_at: dt.datetime
+
+
+JobFunction = Callable[[Callable[[int, int], None]], pd.DataFrame]
+
+
+class JobExecutor:
+    """Runs batch jobs on a thread pool, independent of any Streamlit session.
+
+    Job state lives in a small SQLite table next to the checkpoints, so results
+    outlive the session (and the process) that submitted them. Each job records
+    its owner, the session or user that submitted it, and `list_jobs` can be
+    limited to one owner. Jobs left queued or running by a previous
+    process are marked failed on startup; resubmitting them resumes from their
+    checkpoint.
+    """
+
+    # Seconds between progress writes to the job table
+    progress_interval = 1.0
+
+    def __init__(self, job_dir: Optional[Path] = None, max_workers: int = 4):
+        self.job_dir = job_dir or JobSettings().job_dir
+        self.job_dir.mkdir(parents=True, exist_ok=True)
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="nbo-job"
+        )
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    completed INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    owner TEXT
+                )
+                """
+            )
+            # Tables created before jobs had owners
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created_at)"
+            )
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ? WHERE status IN (?, ?)",
+                (
+                    JobStatus.FAILED.value,
+                    "Interrupted by an application restart",
+                    JobStatus.QUEUED.value,
+                    JobStatus.RUNNING.value,
+                ),
+            )
+
+    @property
+    def db_path(self) -> Path:
+        return self.job_dir / "jobs.sqlite"
+
+    def result_path(self, job_id: str) -> Path:
+        return self.job_dir / f"{job_id}.csv"
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _update(self, job_id: str, **fields: Any) -> None:
+        fields["updated_at"] = dt.datetime.now().isoformat()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                (*fields.values(), job_id),
+            )
+
+    def submit(
+        self, job_id: str, name: str, fn: JobFunction, owner: Optional[str] = None
+    ) -> JobRecord:
+        """Queue `fn` as job `job_id` of `owner` unless it is already queued or
+        running.
+
+        `fn` receives a progress callback taking (completed, total) and returns
+        the result table, which is stored as CSV under the job directory. A job
+        that already finished runs again: it resumes from its checkpoint, so
+        only rows that are missing or were rendered from a template are
+        generated again.
+        """
+        with self._lock:
+            existing = self.get(job_id)
+            if existing is not None and existing.status in (
+                JobStatus.QUEUED,
+                JobStatus.RUNNING,
+            ):
+                return existing
+            now = dt.datetime.now().isoformat()
+            with self._connect() as conn:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO jobs
+                        (id, name, status, completed, total, error, created_at,
+                         updated_at, owner)
+                    VALUES (?, ?, ?, 0, 0, NULL, ?, ?, ?)
+                    """,
+                    (job_id, name, JobStatus.QUEUED.value, now, now, owner),
+                )
+            self._pool.submit(self._run, job_id, fn)
+        record = self.get(job_id)
+        assert record is not None
+        return record
+
+    def _run(self, job_id: str, fn: JobFunction) -> None:
+        self._update(job_id, status=JobStatus.RUNNING.value)
+
+        # Writing every row would commit to SQLite once per completed email, on
+        # the thread handling completions; write at most every
+        # `progress_interval` seconds and always the final count
+        progress = {"completed": 0, "total": 0}
+        progress_lock = threading.Lock()
+        last_write = 0.0
+
+        def on_progress(completed: int, total: int) -> None:
+            nonlocal last_write
+            with progress_lock:
+                progress.update(completed=completed, total=total)
+                now = time.monotonic()
+                if completed < total and now - last_write < self.progress_interval:
+                    return
+                last_write = now
+                self._update(job_id, **progress)
+
+        try:
+            result = fn(on_progress)
+            result.to_csv(self.result_path(job_id), index=False)
+        except Exception as e:
+            logger.exception(f"Batch job {job_id} failed")
+            self._update(
+                job_id, status=JobStatus.FAILED.value, error=str(e), **progress
+            )
+        else:
+            self._update(job_id, status=JobStatus.SUCCEEDED.value, **progress)
+
+    def get(self, job_id: str) -> Optional[JobRecord]:
+        jobs = self._select("WHERE id = ?", (job_id,))
+        return jobs[0] if jobs else None
+
+    def list_jobs(
+        self, owner: Optional[str] = None, limit: int = 50
+    ) -> list[JobRecord]:
+        """Most recent jobs first, only those of `owner` if given"""
+        if owner is None:
+            return self._select("ORDER BY created_at DESC LIMIT ?", (limit,))
+        return self._select(
+            "WHERE owner = ? ORDER BY created_at DESC LIMIT ?", (owner, limit)
+        )
+
+    def _select(self, clause: str, params: tuple[Any, ...]) -> list[JobRecord]:
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(f"SELECT * FROM jobs {clause}", params).fetchall()
+        return [JobRecord(**dict(row)) for row in rows]
+
+    def result(self, job_id: str) -> pd.DataFrame:
+        return pd.read_csv(self.result_path(job_id))
+
+
+_executor: Optional[JobExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_job_executor() -> JobExecutor:
+    """Return the process-wide job executor, shared by all Streamlit sessions"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            settings = JobSettings()
+            _executor = JobExecutor(settings.job_dir, settings.max_concurrent_jobs)
+        return _executor
@@ -0,0 +1,619 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import itertools
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+import yaml
+from pydantic import ValidationError
+
+from nbo.costs import CostEstimate, SpendTracker, check_budget, estimate_cost
+from nbo.i18n import gettext
+from nbo.jobs import BatchCheckpoint, run_generation_job
+from nbo.predict import (
+    make_generative_deployment_predictions,
+    make_packed_generative_deployment_predictions,
+    template_generation,
+)
+from nbo.schema import (
+    QUALITATIVE_STRENGTHS,
+    AppDataScienceSettings,
+    Explanation,
+    Generation,
+    LLMRequest,
+    OutcomeDetail,
+    Prediction,
+)
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def get_stack_suffix() -> str:
+    try:
+        return (
+            "."
+            + subprocess.check_output(
+                ["pulumi", "stack", "--show-name", "--non-interactive"],
+                text=True,
+                stderr=subprocess.STDOUT,
+            ).strip()
+        )
+    except Exception:
+        pass
+    return ""
+
+
+def load_app_settings(path: Optional[Path] = None) -> AppDataScienceSettings:
+    """Load the app settings written by the model training notebook.
+
+    Without an explicit path, `app_settings.<stack>.yaml` is looked up in the
+    working directory and then in `frontend/`.
+    """
+    if path is None:
+        file_name = f"app_settings{get_stack_suffix()}.yaml"
+        candidates = [Path(file_name), PROJECT_ROOT / "frontend" / file_name]
+        path = next((c for c in candidates if c.exists()), candidates[0])
+    try:
+        with open(path) as f:
+            return AppDataScienceSettings(**yaml.safe_load(f))
+    except (FileNotFoundError, ValidationError) as e:
+        raise ValueError(
+            (
+                "Unable to read App settings. If running locally, verify you have selected "
+                "the correct stack and that it is active using `pulumi stack output`. "
+                "If running in DataRobot, verify your runtime parameters have been set correctly."
+            )
+        ) from e
+
+
+def set_outcome_details(
+    outcome_detail_list: List[OutcomeDetail],
+) -> Dict[str, OutcomeDetail]:
+    """Convert outcome details into a dictionary"""
+
+    return {
+        outcome_detail.prediction: outcome_detail
+        for outcome_detail in outcome_detail_list
+    }
+
+
+def no_action_message(selected_record: str) -> str:
+    """Message shown instead of an email when the model recommends no action"""
+    return gettext(
+        "Our model predicted that you are better off not "
+        + "targeting {selected_record} with any email "
+        + "offer. The best next step is to not take any "
+        + "action."
+    ).format(selected_record=selected_record)
+
+
+def explanation_sentences(
+    prediction_data: Prediction,
+    number_of_explanations: int,
+    app_settings: AppDataScienceSettings,
+) -> List[str]:
+    """Describe the strongest non-zero explanations, e.g. "age of 42 is increasing ..." """
+    target_description = app_settings.target_probability_description
+    prediction_explanations = [
+        pe for pe in prediction_data.explanations if abs(pe.strength) > 0
+    ]
+    sentences = []
+    for pe in prediction_explanations[:number_of_explanations]:
+        if pe.qualitative_strength not in QUALITATIVE_STRENGTHS:
+            pe.qualitative_strength = Explanation.create_qualitative_strength(
+                pe.strength
+            )
+        feature = pe.feature_name.replace("_", " ")
+        featureValue = (
+            float(pe.feature_value)
+            if isinstance(pe.feature_value, (int, float))
+            else pe.feature_value
+        )
+        sentences.append(
+            f"{feature} of {featureValue} {QUALITATIVE_STRENGTHS[pe.qualitative_strength]['label']} {target_description}"
+        )
+    return sentences
+
+
+def create_prompt(
+    prediction_data: Prediction,
+    selected_record: str,
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+) -> str:
+    email_prompt = app_settings.email_prompt
+
+    outcome_details = set_outcome_details(app_settings.outcome_details)
+
+    predicted_label = prediction_data.predicted_label
+    customer_predicted_label = outcome_details[predicted_label].label
+    outcome_description = outcome_details[predicted_label].description
+    rsp = "\n\n".join(
+        f"-{sentence}"
+        for sentence in explanation_sentences(
+            prediction_data, number_of_explanations, app_settings
+        )
+    )
+    prompt = email_prompt.format(
+        prediction_label=customer_predicted_label,
+        selected_record=selected_record,
+        outcome_description=outcome_description,
+        tone=tone,
+        verbosity=verbosity,
+        rsp=rsp,
+    )
+
+    return prompt
+
+
+def render_template_email(
+    prediction_data: Prediction,
+    selected_record: str,
+    number_of_explanations: int,
+    app_settings: AppDataScienceSettings,
+) -> str:
+    """Deterministic email skeleton built from the outcome and explanations.
+
+    Used instead of the LLM when it is unavailable or too slow, and for
+    template-only batches.
+    """
+    outcome_detail = set_outcome_details(app_settings.outcome_details)[
+        prediction_data.predicted_label
+    ]
+    lines = [
+        gettext("Subject: {label}").format(label=outcome_detail.label),
+        "",
+        gettext("Dear {selected_record},").format(selected_record=selected_record),
+        "",
+        outcome_detail.description,
+    ]
+    reasons = explanation_sentences(
+        prediction_data, number_of_explanations, app_settings
+    )
+    if reasons:
+        lines += ["", gettext("Why we think this is a good fit:")]
+        lines += [f"- {reason}" for reason in reasons]
+    lines += ["", gettext("Kind regards")]
+    return "\n".join(lines)
+
+
+def create_llm_request(
+    prompt: str,
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+    record_id: Optional[str] = None,
+    fallback_content: Optional[str] = None,
+) -> LLMRequest:
+    verbosity_profile = app_settings.get_verbosity_profile(verbosity)
+    return LLMRequest(
+        prompt=prompt,
+        number_of_explanations=number_of_explanations,
+        tone=tone,
+        verbosity=verbosity,
+        system_prompt=app_settings.system_prompt,
+        record_id=record_id,
+        max_tokens=verbosity_profile.max_output_tokens,
+        deadline=verbosity_profile.timeout_seconds,
+        fallback_content=fallback_content,
+    )
+
+
+def create_batch_llm_requests(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+) -> Dict[int, LLMRequest]:
+    """Build the LLM request of every record that needs an email, keyed by position.
+
+    Records predicted as `app_settings.no_text_gen_label` are left out.
+    """
+    return {
+        index: create_llm_request(
+            prompt=create_prompt(
+                prediction_data=prediction,
+                selected_record=selected_record,
+                number_of_explanations=number_of_explanations,
+                tone=tone,
+                verbosity=verbosity,
+                app_settings=app_settings,
+            ),
+            number_of_explanations=number_of_explanations,
+            tone=tone,
+            verbosity=verbosity,
+            app_settings=app_settings,
+            record_id=selected_record,
+            fallback_content=render_template_email(
+                prediction, selected_record, number_of_explanations, app_settings
+            ),
+        )
+        for index, (selected_record, prediction) in enumerate(
+            zip(record_ids, predictions)
+        )
+        if prediction.predicted_label != app_settings.no_text_gen_label
+    }
+
+
+def pending_llm_requests(
+    llm_requests: List[LLMRequest], job_id: Optional[str]
+) -> List[LLMRequest]:
+    """Leave out the requests already checkpointed by an earlier run of the job"""
+    if job_id is None:
+        return llm_requests
+    completed = BatchCheckpoint(job_id).load_completed(llm_requests)
+    return [
+        llm_request
+        for index, llm_request in enumerate(llm_requests)
+        if index not in completed
+    ]
+
+
+def sweep_variants(
+    app_settings: AppDataScienceSettings,
+    tones: Optional[List[str]] = None,
+    verbosities: Optional[List[str]] = None,
+) -> List[Tuple[str, str]]:
+    """Every (tone, verbosity) combination, by default of all configured values"""
+    return list(
+        itertools.product(
+            tones or app_settings.tones, verbosities or app_settings.verbosity
+        )
+    )
+
+
+def variant_column(tone: str, verbosity: str) -> str:
+    """Name of the email column of one variant in a sweep result"""
+    return f"email ({tone}, {verbosity})"
+
+
+def _create_variant_llm_requests(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    variants: List[Tuple[str, str]],
+    app_settings: AppDataScienceSettings,
+) -> List[Dict[int, LLMRequest]]:
+    return [
+        create_batch_llm_requests(
+            record_ids,
+            predictions,
+            number_of_explanations,
+            tone,
+            verbosity,
+            app_settings,
+        )
+        for tone, verbosity in variants
+    ]
+
+
+def _flatten(variant_requests: List[Dict[int, LLMRequest]]) -> List[LLMRequest]:
+    return [
+        llm_request
+        for llm_requests in variant_requests
+        for llm_request in llm_requests.values()
+    ]
+
+
+def estimate_batch_cost(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+    job_id: Optional[str] = None,
+    records_per_call: int = 1,
+) -> CostEstimate:
+    """Estimate the LLM cost of `batch_email_responses` without calling the LLM"""
+    return estimate_sweep_cost(
+        record_ids,
+        predictions,
+        number_of_explanations,
+        [(tone, verbosity)],
+        app_settings,
+        job_id,
+        records_per_call,
+    )
+
+
+def estimate_sweep_cost(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    variants: List[Tuple[str, str]],
+    app_settings: AppDataScienceSettings,
+    job_id: Optional[str] = None,
+    records_per_call: int = 1,
+) -> CostEstimate:
+    """Estimate the LLM cost of `sweep_email_responses` without calling the LLM"""
+    variant_requests = _create_variant_llm_requests(
+        record_ids, predictions, number_of_explanations, variants, app_settings
+    )
+    return estimate_cost(
+        pending_llm_requests(_flatten(variant_requests), job_id),
+        app_settings,
+        records_per_call,
+    )
+
+
+def _generate(
+    llm_requests: List[LLMRequest],
+    job_id: Optional[str],
+    on_progress: Optional[Callable[[int, int], None]],
+    max_workers: int,
+    spend: Optional[SpendTracker],
+    records_per_call: int,
+    templates_only: bool = False,
+) -> List[Generation]:
+    if not llm_requests:
+        return []
+    if job_id is not None:
+        return run_generation_job(
+            job_id,
+            llm_requests,
+            on_progress=on_progress,
+            max_workers=max_workers,
+            spend=spend,
+            records_per_call=records_per_call,
+            templates_only=templates_only,
+        )
+    if templates_only:
+        generations = [template_generation(llm_request) for llm_request in llm_requests]
+        if on_progress is not None:
+            on_progress(len(generations), len(generations))
+        return generations
+    if max_workers == 1 and records_per_call == 1:
+        return make_generative_deployment_predictions(llm_requests)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return [
+            generation
+            for generations in pool.map(
+                make_packed_generative_deployment_predictions,
+                (
+                    llm_requests[start : start + records_per_call]
+                    for start in range(0, len(llm_requests), records_per_call)
+                ),
+            )
+            for generation in generations
+        ]
+
+
+def _draft_emails(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    variants: List[Tuple[str, str]],
+    app_settings: AppDataScienceSettings,
+    job_id: Optional[str],
+    on_progress: Optional[Callable[[int, int], None]],
+    max_workers: int,
+    budget: Optional[float],
+    spend: Optional[SpendTracker],
+    records_per_call: int,
+    templates_only: bool,
+) -> Tuple[List[List[str]], List[List[str]], int]:
+    """Emails and their sources of every record for each variant, and the
+    number of skipped calls"""
+    variant_requests = _create_variant_llm_requests(
+        record_ids, predictions, number_of_explanations, variants, app_settings
+    )
+    skipped_llm_calls = len(record_ids) - len(variant_requests[0])
+    if skipped_llm_calls:
+        logger.info(
+            f"Skipped {skipped_llm_calls} of {len(record_ids)} LLM calls for records "
+            f"predicted as '{app_settings.no_text_gen_label}'"
+        )
+
+    llm_request_data = _flatten(variant_requests)
+    if templates_only:
+        logger.info(f"Rendering {len(llm_request_data)} template emails without LLM")
+    elif spend is None and budget is not None:
+        spend = SpendTracker(app_settings.model_spec, budget)
+        # Tokenizing every prompt is only worth it to enforce a budget. Callers
+        # passing their own `spend` check the estimate of all their batches
+        # up front.
+        estimate = estimate_cost(
+            pending_llm_requests(llm_request_data, job_id),
+            app_settings,
+            records_per_call,
+        )
+        logger.info(
+            f"Estimated cost of {estimate.llm_calls} LLM calls: "
+            f"${estimate.total_cost:.4f} ({estimate.input_tokens} input and "
+            f"~{estimate.output_tokens} output tokens)"
+        )
+        check_budget(estimate, budget)
+
+    generations = _generate(
+        llm_request_data,
+        job_id,
+        on_progress,
+        max_workers,
+        spend,
+        records_per_call,
+        templates_only,
+    )
+    return _split_variants(record_ids, variant_requests, generations, skipped_llm_calls)
+
+
+def _split_variants(
+    record_ids: List[str],
+    variant_requests: List[Dict[int, LLMRequest]],
+    generations: List[Generation],
+    skipped_llm_calls: int,
+) -> Tuple[List[List[str]], List[List[str]], int]:
+    """Place the flattened generations back into per-variant record lists"""
+    template_emails = sum(generation.source == "template" for generation in generations)
+    if template_emails:
+        logger.info(f"{template_emails} of {len(generations)} emails are templates")
+    remaining = iter(generations)
+    variant_emails = []
+    variant_sources = []
+    for llm_requests in variant_requests:
+        emails = [no_action_message(selected_record) for selected_record in record_ids]
+        sources = ["no_action"] * len(record_ids)
+        for index in llm_requests:
+            generation = next(remaining)
+            emails[index] = generation.content
+            sources[index] = generation.source
+        variant_emails.append(emails)
+        variant_sources.append(sources)
+    return variant_emails, variant_sources, skipped_llm_calls
+
+
+def _predicted_labels(
+    predictions: List[Prediction], app_settings: AppDataScienceSettings
+) -> List[str]:
+    outcome_details = set_outcome_details(app_settings.outcome_details)
+    return [
+        outcome_details[prediction.predicted_label].label for prediction in predictions
+    ]
+
+
+def batch_email_responses(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+    job_id: Optional[str] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    max_workers: int = 1,
+    budget: Optional[float] = None,
+    spend: Optional[SpendTracker] = None,
+    records_per_call: int = 1,
+    templates_only: bool = False,
+) -> pd.DataFrame:
+    """Draft an email for every record.
+
+    Records predicted as `app_settings.no_text_gen_label` get the no-action
+    message without an LLM call; the number of skipped calls is logged and kept
+    in the `skipped_llm_calls` entry of the returned frame's `attrs`.
+
+    When a `job_id` is given, completed emails are checkpointed as they finish and
+    a rerun of the same job only generates the emails that are still missing.
+
+    With a `budget` (in the currency of `app_settings.model_spec`), the batch is
+    refused up front with `BudgetExceededError` if its estimated cost exceeds the
+    budget, and a checkpointed job stops early once its actual spend reaches it.
+    Pass a `spend` tracker instead to share one budget across several calls;
+    the caller then checks the estimated cost of all of them up front with
+    `check_budget`, as it is not estimated again here.
+
+    With `records_per_call` > 1, that many records are packed into each
+    completion and split back from its JSON output, falling back to one call
+    per record for records that cannot be parsed.
+
+    Emails that fell back to the template because the LLM was unavailable, or
+    all emails with `templates_only`, are marked "template" in the `source`
+    column ("llm" or "no_action" otherwise). `templates_only` never calls the
+    LLM and ignores the budget.
+    """
+    (emails,), (sources,), skipped_llm_calls = _draft_emails(
+        record_ids,
+        predictions,
+        number_of_explanations,
+        [(tone, verbosity)],
+        app_settings,
+        job_id,
+        on_progress,
+        max_workers,
+        budget,
+        spend,
+        records_per_call,
+        templates_only,
+    )
+    result = pd.DataFrame(
+        {
+            "record_id": record_ids,
+            "label": _predicted_labels(predictions, app_settings),
+            "email": emails,
+            "source": sources,
+        }
+    )
+    result.attrs["skipped_llm_calls"] = skipped_llm_calls
+    result.attrs["template_emails"] = sources.count("template")
+    return result
+
+
+def sweep_email_responses(
+    record_ids: List[str],
+    predictions: List[Prediction],
+    number_of_explanations: int,
+    app_settings: AppDataScienceSettings,
+    variants: Optional[List[Tuple[str, str]]] = None,
+    job_id: Optional[str] = None,
+    on_progress: Optional[Callable[[int, int], None]] = None,
+    max_workers: int = 1,
+    budget: Optional[float] = None,
+    spend: Optional[SpendTracker] = None,
+    records_per_call: int = 1,
+    templates_only: bool = False,
+) -> pd.DataFrame:
+    """Draft an email for every record in each (tone, verbosity) variant.
+
+    The prompts of all variants are built from the same predictions and
+    generated as one batch, so they share one worker pool, checkpoint, cost
+    estimate and budget. The result has one row per record and one
+    `variant_column(tone, verbosity)` column per variant, by default for every
+    combination of the configured tones and verbosities. See
+    `batch_email_responses` for the other parameters.
+    """
+    if variants is None:
+        variants = sweep_variants(app_settings)
+    variant_emails, variant_sources, skipped_llm_calls = _draft_emails(
+        record_ids,
+        predictions,
+        number_of_explanations,
+        variants,
+        app_settings,
+        job_id,
+        on_progress,
+        max_workers,
+        budget,
+        spend,
+        records_per_call,
+        templates_only,
+    )
+    result = pd.DataFrame(
+        {
+            "record_id": record_ids,
+            "label": _predicted_labels(predictions, app_settings),
+            **{
+                variant_column(tone, verbosity): emails
+                for (tone, verbosity), emails in zip(variants, variant_emails)
+            },
+        }
+    )
+    result.attrs["skipped_llm_calls"] = skipped_llm_calls * len(variants)
+    result.attrs["template_emails"] = sum(
+        source == "template" for sources in variant_sources for source in sources
+    )
+    return result
@@ -0,0 +1,284 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Optional, TypeVar
+
+from nbo.telemetry import runtime_metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hedged attempts run here so the caller can stop waiting for a slow primary
+_hedge_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="nbo-hedge")
+
+
+class DeadlineExceededError(TimeoutError):
+    """Raised when a call and its retries do not finish within the deadline"""
+
+
+class SlotTimeoutError(DeadlineExceededError):
+    """Raised when a call never started because no local concurrency slot freed
+    up before its deadline"""
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a deployment whose circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Fail fast after consecutive failed calls to one deployment.
+
+    After `failure_threshold` consecutive failures the breaker opens and calls
+    are rejected with `CircuitOpenError` without reaching the deployment. Once
+    `reset_timeout` seconds have passed it lets one probe call through
+    (half-open): success closes it, failure opens it for another
+    `reset_timeout`. Transitions are logged, and the state is exposed as the
+    `<name>.breaker.state` gauge (0 closed, 1 half-open, 2 open) next to the
+    `<name>.breaker.opened` and `<name>.breaker.rejected` counters.
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half-open"
+    OPEN = "open"
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        runtime_metrics.register_gauge(
+            f"{name}.breaker.state", lambda: self._STATE_VALUES[self.state]
+        )
+
+    def before_call(self) -> None:
+        """Raise `CircuitOpenError` unless the call may go to the deployment"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if (
+                self.state == self.OPEN
+                and time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = self.HALF_OPEN
+                logger.info(f"{self.name} circuit half-open, sending a probe call")
+                return
+            retry_in = max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+        runtime_metrics.increment(f"{self.name}.breaker.rejected")
+        raise CircuitOpenError(
+            f"{self.name} deployment is unavailable (circuit {self.state}, "
+            f"next probe in {retry_in:.0f}s)"
+        )
+
+    def on_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"{self.name} circuit closed, deployment recovered")
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def on_not_sent(self) -> None:
+        """The call was given up before reaching the deployment.
+
+        It says nothing about the deployment's health, so it is not counted;
+        a probe that was not sent lets the next call probe instead.
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                runtime_metrics.increment(f"{self.name}.breaker.opened")
+                logger.warning(
+                    f"{self.name} circuit open after {self._failures} consecutive "
+                    f"failures; failing fast for {self.reset_timeout:g}s"
+                )
+
+
+class LatencyWindow:
+    """Latencies of the most recent successful attempts"""
+
+    def __init__(self, size: int = 256):
+        self._latencies: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[
+            min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        ]
+
+
+class CallPolicy:
+    """Deadline, retries and hedging around calls to one deployment.
+
+    `call` runs `attempt(timeout)` until it succeeds, passing the time left
+    before the deadline so the HTTP client can bound each attempt. Failures
+    accepted by `is_retryable` are retried with full-jitter exponential backoff,
+    waiting at least as long as `retry_after` asks. With `hedge_percentile`
+    set, an attempt still running after that percentile of recent latencies
+    gets a duplicate request and the first one to succeed wins, so only use it
+    for requests that are safe to send twice.
+
+    With a `breaker`, calls are rejected while it is open, and each call whose
+    last error is retryable (or a deadline miss) counts as one failure. Calls
+    that time out waiting for a local concurrency slot (`SlotTimeoutError`) do
+    not count, as they never reached the deployment.
+
+    Retries, hedges, hedge wins and deadline misses are counted in
+    `runtime_metrics` under `<name>.retries` etc. A deadline miss is counted
+    both when the next retry would not fit and when the last attempt fails
+    after the deadline has passed.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        is_retryable: Callable[[Exception], bool],
+        deadline: float,
+        max_attempts: int = 3,
+        base_delay: float = 0.5,
+        max_delay: float = 10.0,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        retry_after: Optional[Callable[[Exception], Optional[float]]] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.name = name
+        self.is_retryable = is_retryable
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.retry_after = retry_after
+        self.breaker = breaker
+        self.latencies = LatencyWindow()
+
+    def call(
+        self, attempt: Callable[[float], T], deadline: Optional[float] = None
+    ) -> T:
+        """Run `attempt` under the policy, with `deadline` seconds instead of the
+        policy's own deadline if given"""
+        if self.breaker is None:
+            return self._call(attempt, deadline)
+        self.breaker.before_call()
+        try:
+            result = self._call(attempt, deadline)
+        except Exception as e:
+            if isinstance(e, SlotTimeoutError):
+                self.breaker.on_not_sent()
+            elif isinstance(e, DeadlineExceededError) or self.is_retryable(e):
+                self.breaker.on_failure()
+            else:
+                # The deployment answered, e.g. a bad request
+                self.breaker.on_success()
+            raise
+        self.breaker.on_success()
+        return result
+
+    def _call(self, attempt: Callable[[float], T], deadline: Optional[float]) -> T:
+        budget = self.deadline if deadline is None else deadline
+        deadline_at = time.monotonic() + budget
+        attempt_number = 1
+        while True:
+            try:
+                return self._attempt(attempt, deadline_at)
+            except Exception as e:
+                if attempt_number >= self.max_attempts or not self.is_retryable(e):
+                    if time.monotonic() >= deadline_at:
+                        runtime_metrics.increment(f"{self.name}.deadline_exceeded")
+                    raise
+                delay = random.uniform(
+                    0, min(self.max_delay, self.base_delay * 2 ** (attempt_number - 1))
+                )
+                requested = self.retry_after(e) if self.retry_after else None
+                if requested is not None:
+                    delay = max(delay, requested)
+                if time.monotonic() + delay >= deadline_at:
+                    runtime_metrics.increment(f"{self.name}.deadline_exceeded")
+                    raise DeadlineExceededError(
+                        f"{self.name} call did not succeed within its "
+                        f"{budget:g}s deadline"
+                    ) from e
+                runtime_metrics.increment(f"{self.name}.retries")
+                logger.warning(
+                    f"{self.name} attempt {attempt_number} failed ({e!r}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+                attempt_number += 1
+
+    def _timed(self, attempt: Callable[[float], T], deadline: float) -> T:
+        start = time.monotonic()
+        result = attempt(deadline - start)
+        self.latencies.record(time.monotonic() - start)
+        return result
+
+    def _attempt(self, attempt: Callable[[float], T], deadline: float) -> T:
+        hedge_after = (
+            self.latencies.percentile(self.hedge_percentile, self.hedge_min_samples)
+            if self.hedge_percentile is not None
+            else None
+        )
+        if hedge_after is None or time.monotonic() + hedge_after >= deadline:
+            return self._timed(attempt, deadline)
+
+        primary = _hedge_executor.submit(self._timed, attempt, deadline)
+        pending: set[Future[T]] = {primary}
+        done, _ = wait(pending, timeout=hedge_after)
+        if not done:
+            runtime_metrics.increment(f"{self.name}.hedges")
+            pending.add(_hedge_executor.submit(self._timed, attempt, deadline))
+
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is None:
+                    if future is not primary:
+                        runtime_metrics.increment(f"{self.name}.hedge_wins")
+                    return future.result()
+        assert error is not None
+        raise error
@@ -14,39 +14,424 @@
 
 from __future__ import annotations
 
+import json
 import logging
+import re
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Any, Dict, Optional, cast
 
 import datarobot as dr
+import httpx
 import pandas as pd
+import requests
+from datarobot.errors import AppPlatformError
 from datarobot.models.deployment.deployment import Deployment
-from datarobot_predict.deployment import (
-    PredictionResult,
+from openai import (
+    NOT_GIVEN,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    DefaultHttpxClient,
+    OpenAI,
 )
-from openai import OpenAI
 from openai.types.chat.chat_completion import ChatCompletion
-from pydantic import ValidationError
+from pydantic import AliasChoices, Field, TypeAdapter, ValidationError
+from pydantic_settings import BaseSettings
 
+from nbo.cache import (
+    ResultCache,
+    SingleFlight,
+    cache_key,
+    get_shared_cache,
+)
+from nbo.concurrency import AdaptiveConcurrencyLimiter, parse_retry_after
+from nbo.policy import (
+    CallPolicy,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    SlotTimeoutError,
+)
 from nbo.resources import GenerativeDeployment, PredAIDeployment
 from nbo.schema import Generation, LLMRequest, Prediction  # noqa: E402
+from nbo.telemetry import runtime_metrics
+from nbo.transport import (
+    ScoringPayloadSettings,
+    encode_scoring_payload,
+    read_prediction_csv,
+    trim_scoring_frame,
+)
 
 logger = logging.getLogger(__name__)
 
-try:
-    pred_ai_deployment_id = PredAIDeployment().id
-    generative_deployment_id = GenerativeDeployment().id
-    logger.info(f"Pred AI deployment: {pred_ai_deployment_id}")
-    logger.info(f"Email LLM deployment: {generative_deployment_id}")
-except ValidationError as e:
-    raise ValueError(
-        (
-            "Unable to load DataRobot deployment ids. If running locally, verify you have selected "
-            "the correct stack and that it is active using `pulumi stack output`. "
-            "If running in DataRobot, verify your runtime parameters have been set correctly."
-        )
-    ) from e
+# Resolved on first use (reading them may shell out to Pulumi) and cached
+_deployment_ids: Dict[str, str] = {}
+_deployment_ids_lock = threading.Lock()
+
+
+def _resolve_deployment_id(
+    name: str, settings_cls: type[PredAIDeployment] | type[GenerativeDeployment]
+) -> str:
+    with _deployment_ids_lock:
+        if name not in _deployment_ids:
+            try:
+                _deployment_ids[name] = settings_cls().id
+            except ValidationError as e:
+                raise ValueError(
+                    (
+                        "Unable to load DataRobot deployment ids. If running locally, verify you have selected "
+                        "the correct stack and that it is active using `pulumi stack output`. "
+                        "If running in DataRobot, verify your runtime parameters have been set correctly."
+                    )
+                ) from e
+            logger.info(f"{name} deployment: {_deployment_ids[name]}")
+        return _deployment_ids[name]
+
+
+def get_pred_ai_deployment_id() -> str:
+    return _resolve_deployment_id("Pred AI", PredAIDeployment)
+
+
+def get_generative_deployment_id() -> str:
+    return _resolve_deployment_id("Email LLM", GenerativeDeployment)
+
+
+def override_deployment_ids(
+    pred_ai_deployment_id: Optional[str] = None,
+    generative_deployment_id: Optional[str] = None,
+) -> None:
+    """Use the given deployment ids instead of resolving them from the stack.
+
+    Useful to point tooling or benchmarks at stand-in deployments.
+    """
+    with _deployment_ids_lock:
+        if pred_ai_deployment_id is not None:
+            _deployment_ids["Pred AI"] = pred_ai_deployment_id
+        if generative_deployment_id is not None:
+            _deployment_ids["Email LLM"] = generative_deployment_id
+
+
+llm_max_concurrency_env_name: str = "NBO_LLM_MAX_CONCURRENCY"
+
+
+class LLMConcurrencySettings(BaseSettings):
+    """Process-wide ceiling on in-flight chat completion requests.
+
+    The adaptive limiter starts below this ceiling and grows towards it while
+    the generative deployment keeps up.
+    """
+
+    max_concurrency: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_max_concurrency_env_name,
+            llm_max_concurrency_env_name,
+        ),
+        default=8,
+        gt=0,
+    )
+
+
+llm_max_connections_env_name: str = "NBO_LLM_MAX_CONNECTIONS"
+llm_max_keepalive_connections_env_name: str = "NBO_LLM_MAX_KEEPALIVE_CONNECTIONS"
+llm_keepalive_expiry_env_name: str = "NBO_LLM_KEEPALIVE_EXPIRY_SECONDS"
+
+
+class OpenAIClientSettings(BaseSettings):
+    """Connection pool of the shared OpenAI clients"""
+
+    max_connections: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_max_connections_env_name,
+            llm_max_connections_env_name,
+        ),
+        default=100,
+        gt=0,
+    )
+    max_keepalive_connections: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_max_keepalive_connections_env_name,
+            llm_max_keepalive_connections_env_name,
+        ),
+        default=20,
+        ge=0,
+    )
+    keepalive_expiry: float = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_keepalive_expiry_env_name,
+            llm_keepalive_expiry_env_name,
+        ),
+        default=30,
+        ge=0,
+    )
+
+
+validate_predictions_env_name: str = "NBO_VALIDATE_PREDICTIONS"
+max_ngram_explanations_env_name: str = "NBO_MAX_NGRAM_EXPLANATIONS"
+
+
+class PredictionParsingSettings(BaseSettings):
+    """N-gram detail requested from the PredAI deployment and parsing options.
+
+    `validate_predictions` is a debug switch that validates every parsed
+    prediction with pydantic.
+    """
+
+    max_ngram_explanations: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + max_ngram_explanations_env_name,
+            max_ngram_explanations_env_name,
+        ),
+        default=20,
+        gt=0,
+    )
+
+    validate_predictions: bool = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + validate_predictions_env_name,
+            validate_predictions_env_name,
+        ),
+        default=False,
+    )
+
+
+prediction_deadline_env_name: str = "NBO_PREDICTION_DEADLINE_SECONDS"
+llm_deadline_env_name: str = "NBO_LLM_DEADLINE_SECONDS"
+call_max_attempts_env_name: str = "NBO_CALL_MAX_ATTEMPTS"
+prediction_hedge_percentile_env_name: str = "NBO_PREDICTION_HEDGE_PERCENTILE"
+llm_hedge_percentile_env_name: str = "NBO_LLM_HEDGE_PERCENTILE"
+breaker_failure_threshold_env_name: str = "NBO_BREAKER_FAILURE_THRESHOLD"
+breaker_reset_env_name: str = "NBO_BREAKER_RESET_SECONDS"
+
+
+class CallPolicySettings(BaseSettings):
+    """Deadlines, retries and hedging of calls to the two deployments.
+
+    Hedging is off unless a percentile is set; a hedged LLM call may be billed
+    twice.
+    """
+
+    prediction_deadline: float = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + prediction_deadline_env_name,
+            prediction_deadline_env_name,
+        ),
+        default=600,
+        gt=0,
+    )
+    llm_deadline: float = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_deadline_env_name, llm_deadline_env_name
+        ),
+        default=120,
+        gt=0,
+    )
+    max_attempts: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + call_max_attempts_env_name,
+            call_max_attempts_env_name,
+        ),
+        default=3,
+        gt=0,
+    )
+    prediction_hedge_percentile: Optional[float] = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + prediction_hedge_percentile_env_name,
+            prediction_hedge_percentile_env_name,
+        ),
+        default=None,
+        gt=0,
+        lt=100,
+    )
+    llm_hedge_percentile: Optional[float] = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + llm_hedge_percentile_env_name,
+            llm_hedge_percentile_env_name,
+        ),
+        default=None,
+        gt=0,
+        lt=100,
+    )
+    breaker_failure_threshold: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + breaker_failure_threshold_env_name,
+            breaker_failure_threshold_env_name,
+        ),
+        default=5,
+        ge=1,
+    )
+    breaker_reset_seconds: float = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + breaker_reset_env_name,
+            breaker_reset_env_name,
+        ),
+        default=30.0,
+        gt=0,
+    )
+
+
+# Shared by every session and background job in the process so that concurrent
+# batch jobs split one LLM concurrency budget instead of each getting their own
+llm_concurrency = AdaptiveConcurrencyLimiter(LLMConcurrencySettings().max_concurrency)
+runtime_metrics.register_gauge("llm.concurrency.window", lambda: llm_concurrency.window)
+runtime_metrics.register_gauge(
+    "llm.concurrency.in_flight", lambda: llm_concurrency.in_flight
+)
+
+
+def configure_llm_concurrency(max_concurrency: int) -> None:
+    """Resize the shared LLM concurrency budget, e.g. from a command line option"""
+    global llm_concurrency
+    llm_concurrency = AdaptiveConcurrencyLimiter(max_concurrency)
+
+
+def _is_throttling(error: Exception) -> bool:
+    if isinstance(error, APITimeoutError):
+        return True
+    return isinstance(error, APIStatusError) and (
+        error.status_code == 429 or error.status_code >= 500
+    )
+
+
+def _is_retryable_llm_error(error: Exception) -> bool:
+    return isinstance(error, APIConnectionError) or _is_throttling(error)
+
+
+def _llm_retry_after(error: Exception) -> Optional[float]:
+    if isinstance(error, APIStatusError):
+        return parse_retry_after(error.response.headers)
+    return None
+
+
+def _is_retryable_prediction_error(error: Exception) -> bool:
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    return isinstance(error, AppPlatformError) and (
+        error.status_code == 429 or error.status_code >= 500
+    )
+
+
+template_fallback_env_name: str = "NBO_TEMPLATE_FALLBACK"
+
+
+class TemplateFallbackSettings(BaseSettings):
+    """Whether emails fall back to the template when the LLM is unavailable"""
+
+    template_fallback: bool = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + template_fallback_env_name,
+            template_fallback_env_name,
+        ),
+        default=True,
+    )
+
+
+call_policy_settings = CallPolicySettings()
+prediction_call_policy = CallPolicy(
+    "predictions",
+    is_retryable=_is_retryable_prediction_error,
+    deadline=call_policy_settings.prediction_deadline,
+    max_attempts=call_policy_settings.max_attempts,
+    hedge_percentile=call_policy_settings.prediction_hedge_percentile,
+    breaker=CircuitBreaker(
+        "predictions",
+        failure_threshold=call_policy_settings.breaker_failure_threshold,
+        reset_timeout=call_policy_settings.breaker_reset_seconds,
+    ),
+)
+llm_call_policy = CallPolicy(
+    "llm",
+    is_retryable=_is_retryable_llm_error,
+    deadline=call_policy_settings.llm_deadline,
+    max_attempts=call_policy_settings.max_attempts,
+    hedge_percentile=call_policy_settings.llm_hedge_percentile,
+    retry_after=_llm_retry_after,
+    breaker=CircuitBreaker(
+        "llm",
+        failure_threshold=call_policy_settings.breaker_failure_threshold,
+        reset_timeout=call_policy_settings.breaker_reset_seconds,
+    ),
+)
+
+
+def _encode_prediction(prediction: Prediction) -> bytes:
+    return prediction.model_dump_json().encode()
+
+
+def _decode_prediction(value: bytes) -> Prediction:
+    return Prediction.model_validate_json(value)
+
+
+_generations_adapter = TypeAdapter(list[Generation])
+
+# Last successful results. They are served while a deployment is unavailable
+# and, if NBO_SHARED_CACHE_URL sets up a cache shared by the app replicas,
+# instead of calling the deployment at all.
+_prediction_cache: ResultCache[Prediction] = ResultCache(
+    "predictions",
+    max_entries=10_000,
+    encode=_encode_prediction,
+    decode=_decode_prediction,
+    open_shared=get_shared_cache,
+)
+_generation_cache: ResultCache[list[Generation]] = ResultCache(
+    "llm",
+    max_entries=1_000,
+    encode=_generations_adapter.dump_json,
+    decode=_generations_adapter.validate_json,
+    open_shared=get_shared_cache,
+)
+# Identical requests from concurrent sessions share one call
+_prediction_flights: SingleFlight[list[Prediction]] = SingleFlight("predictions")
+_generation_flights: SingleFlight[list[Generation]] = SingleFlight("llm")
+
+
+def is_prediction_unavailable(error: Exception) -> bool:
+    """Whether a failure, after retries, means the PredAI deployment is down"""
+    return isinstance(
+        error, (CircuitOpenError, DeadlineExceededError)
+    ) or _is_retryable_prediction_error(error)
+
+
+def _create_chat_completion(
+    openai_client: OpenAI, llm_request: LLMRequest, timeout: float, n: int = 1
+) -> ChatCompletion:
+    """Send one chat completion attempt through the adaptive concurrency limiter.
+
+    Waiting for a slot counts against `timeout`; the request gets what is left.
+    """
+    # Only send `n` when asking for several choices, not every deployment accepts it
+    n_choices: Any = n if n > 1 else NOT_GIVEN
+    max_tokens: Any = (
+        llm_request.max_tokens if llm_request.max_tokens is not None else NOT_GIVEN
+    )
+    limiter = llm_concurrency
+    deadline_at = time.monotonic() + timeout
+    with limiter.slot(timeout=timeout):
+        start = time.monotonic()
+        if start >= deadline_at:
+            raise SlotTimeoutError(f"No time left after waiting {timeout:g}s")
+        try:
+            response = openai_client.chat.completions.create(
+                model="datarobot-deployed-llm",
+                messages=[
+                    {"role": "system", "content": llm_request.system_prompt},
+                    {"role": "user", "content": llm_request.prompt},
+                ],
+                n=n_choices,
+                max_tokens=max_tokens,
+                timeout=deadline_at - start,
+            )
+        except Exception as e:
+            if _is_throttling(e):
+                runtime_metrics.increment("llm.throttle_events")
+                limiter.on_throttle(start, _llm_retry_after(e))
+            raise
+        limiter.on_success(time.monotonic() - start)
+    return response
 
 
 @dataclass
@@ -61,46 +446,189 @@ def _get_deployment_info(deployment_id: str) -> DeploymentInfo:
     return DeploymentInfo(deployment, str(target_name))
 
 
+_scoring_columns: Dict[str, Optional[list[str]]] = {}
+_scoring_columns_lock = threading.Lock()
+
+
+def _get_scoring_columns(deployment: Deployment) -> Optional[list[str]]:
+    """Model features of a deployment plus its association id column(s).
+
+    Cached per deployment. Returns None, i.e. send every column, if the
+    deployment's features cannot be read.
+    """
+    deployment_id = str(deployment.id)
+    with _scoring_columns_lock:
+        if deployment_id in _scoring_columns:
+            return _scoring_columns[deployment_id]
+    try:
+        columns = [str(feature["name"]) for feature in deployment.get_features()]
+        association_id = cast(Any, deployment.get_association_id_settings())
+        if isinstance(association_id, dict):
+            columns += association_id.get("column_names") or []
+        elif association_id:
+            columns.append(str(association_id))
+    except (AppPlatformError, requests.exceptions.RequestException) as e:
+        logger.warning(f"Could not read features of deployment {deployment_id}: {e}")
+        return None
+    with _scoring_columns_lock:
+        _scoring_columns[deployment_id] = columns
+    return columns
+
+
+_client_retries_lock = threading.Lock()
+
+
+def _disable_client_retries(deployment: Deployment) -> None:
+    """Leave retries of scoring requests to `prediction_call_policy`.
+
+    The DataRobot client retries 413/429/502/503/504 responses up to 10 times
+    with exponential backoff, about 100s in all, whatever the deadline. Its
+    session gets an adapter without retries for the deployment's scoring URL.
+    """
+    client = dr.client.get_client()
+    server = deployment.default_prediction_server
+    base_url = f"{server['url']}/predApi/v1.0" if server else client.endpoint
+    prefix = f"{base_url}/deployments/{deployment.id}/predictions"
+    with _client_retries_lock:
+        if prefix not in client.adapters:
+            client.mount(prefix, requests.adapters.HTTPAdapter())
+
+
+def _prediction_row_keys(
+    df: pd.DataFrame,
+    max_explanations: Optional[int],
+    text_explanation_feature: Optional[str],
+) -> list[str]:
+    """Cache key of every row: its values plus what else shapes its prediction"""
+    prefix = cache_key(
+        get_pred_ai_deployment_id(),
+        [str(column) for column in df.columns],
+        max_explanations,
+        text_explanation_feature,
+    )[:32]
+    row_hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    return [f"{prefix}:{row_hash:016x}" for row_hash in row_hashes]
+
+
 def make_pred_ai_deployment_predictions(
-    df: pd.DataFrame, max_explanations: Optional[int] = None
+    df: pd.DataFrame,
+    max_explanations: Optional[int] = None,
+    text_explanation_feature: Optional[str] = None,
+) -> list[Prediction]:
+    """Score records with the PredAI deployment.
+
+    With a shared cache (`NBO_SHARED_CACHE_URL`), rows scored before by any
+    replica are read from the cache and only the other rows are sent. If the
+    deployment is unavailable (circuit open, deadline missed or transient
+    errors after retries) and every row was scored successfully before, the
+    earlier predictions are returned instead, counted as
+    `predictions.degraded_rows`. Concurrent calls for the same rows share one
+    scoring request. See `_score_pred_ai_deployment`.
+    """
+    row_keys = _prediction_row_keys(df, max_explanations, text_explanation_feature)
+    read_through = _prediction_cache.shared is not None
+    predictions = (
+        _prediction_cache.get_many(row_keys) if read_through else [None] * len(row_keys)
+    )
+    missing = [
+        index for index, prediction in enumerate(predictions) if prediction is None
+    ]
+    if not missing:
+        return cast(list[Prediction], predictions)
+    missing_keys = [row_keys[index] for index in missing]
+    try:
+        scored = _prediction_flights.do(
+            cache_key(missing_keys),
+            lambda: _score_pred_ai_deployment(
+                df.iloc[missing] if read_through else df,
+                max_explanations,
+                text_explanation_feature,
+            ),
+        )
+    except Exception as e:
+        if read_through or not is_prediction_unavailable(e):
+            raise
+        cached = _prediction_cache.get_many(missing_keys)
+        if any(prediction is None for prediction in cached):
+            raise
+        runtime_metrics.increment("predictions.degraded_rows", len(cached))
+        logger.warning(
+            f"PredAI deployment unavailable ({e}); serving {len(cached)} cached "
+            "prediction(s)"
+        )
+        scored = cast(list[Prediction], cached)
+    else:
+        _prediction_cache.set_many(dict(zip(missing_keys, scored)))
+    for index, prediction in zip(missing, scored):
+        predictions[index] = prediction
+    return cast(list[Prediction], predictions)
+
+
+def _score_pred_ai_deployment(
+    df: pd.DataFrame,
+    max_explanations: Optional[int] = None,
+    text_explanation_feature: Optional[str] = None,
 ) -> list[Prediction]:
-    deployment_info = _get_deployment_info(pred_ai_deployment_id)
+    """Send one scoring request to the PredAI deployment.
+
+    N-gram detail for text features is only requested when
+    `text_explanation_feature` is given, i.e. when the caller will highlight
+    that feature's text, and then only for the top `NBO_MAX_NGRAM_EXPLANATIONS`
+    n-grams. The API cannot restrict n-grams to one feature, so other text
+    features in the explanations get them too but they are never parsed.
+
+    Only the deployment's features and association id are sent, and request
+    bodies of at least `NBO_PREDICTION_GZIP_MIN_BYTES` are gzip-compressed.
+    """
+    deployment_info = _get_deployment_info(get_pred_ai_deployment_id())
     deployment = deployment_info.deployment
     target_name = deployment_info.target_name
+    _disable_client_retries(deployment)
     # TODO: remove once datarobot-predict supports maxNgramExplanations
-    from datarobot_predict.deployment import _deployment_predict, _read_response_csv
+    from datarobot_predict.deployment import _deployment_predict
 
-    params: Dict[str, Any] = (
-        {
-            "maxExplanations": max_explanations,
-            "maxNgramExplanations": "all",
-        }
-        if max_explanations
-        else {}
+    # Skip the library's own retries of 502/503/504 (sleeping up to 60s each),
+    # as for the client's above; prediction_call_policy retries within its
+    # deadline instead
+    deployment_predict = getattr(
+        _deployment_predict, "__wrapped__", _deployment_predict
     )
 
-    headers: Dict[str, str] = {}
+    params: Dict[str, Any] = {}
+    if max_explanations:
+        params["maxExplanations"] = max_explanations
+        if text_explanation_feature:
+            params["maxNgramExplanations"] = (
+                PredictionParsingSettings().max_ngram_explanations
+            )
 
-    response = _deployment_predict(
-        deployment=deployment,
-        endpoint="predictions",
-        headers=headers,
-        params=params,
-        data=df,
-        stream=False,
-        timeout=600,
-        prediction_endpoint=None,
+    scoring_columns = _get_scoring_columns(deployment)
+    if scoring_columns is not None:
+        df = trim_scoring_frame(df, scoring_columns)
+    body, headers = encode_scoring_payload(df, ScoringPayloadSettings().gzip_min_bytes)
+
+    response = prediction_call_policy.call(
+        lambda timeout: deployment_predict(
+            deployment=deployment,
+            endpoint="predictions",
+            headers=headers,
+            params=params,
+            data=body,
+            stream=False,
+            timeout=max(1, int(timeout)),
+            prediction_endpoint=None,
+        )
     )
-    prediction_result = PredictionResult(_read_response_csv(response), response.headers)
-    prediction = prediction_result.dataframe
+    prediction = read_prediction_csv(response.content, target_name)
     prediction = prediction.rename(columns={f"{target_name}_PREDICTION": "prediction"})
     prediction.columns = prediction.columns.str.replace(
         "_(PREDICTION|OUTPUT)$", "", regex=True
     )
-    return [
-        Prediction.parse_dict(p, target_name)
-        for p in prediction.to_dict(orient="records")
-    ]
+    return Prediction.parse_frame(
+        prediction,
+        target_name,
+        validate=PredictionParsingSettings().validate_predictions,
+    )
 
 
 def extract_association_id_from_completion(response: ChatCompletion) -> str:
@@ -133,34 +661,369 @@ def extract_association_id_from_completion(response: ChatCompletion) -> str:
     return str(uuid.uuid4())
 
 
-def make_generative_deployment_predictions(
-    requests: list[LLMRequest],
-) -> list[Generation]:
-    deployment_info = _get_deployment_info(generative_deployment_id)
-    deployment = deployment_info.deployment
-    dr_client = dr.client.get_client()
+def create_openai_client(deployment_id: str) -> OpenAI:
+    """Create an OpenAI client for the chat completion API of a DataRobot deployment.
 
-    openai_client = OpenAI(
-        base_url=f"{dr_client.endpoint.rstrip('/')}/deployments/{deployment.id}",
+    Prefer `get_openai_client`, which shares one client and its connection
+    pool per deployment.
+    """
+    dr_client = dr.client.get_client()
+    pool_settings = OpenAIClientSettings()
+    return OpenAI(
+        base_url=f"{dr_client.endpoint.rstrip('/')}/deployments/{deployment_id}",
         api_key=dr_client.token,
+        # Retries are handled by `llm_call_policy`
+        max_retries=0,
+        http_client=DefaultHttpxClient(
+            limits=httpx.Limits(
+                max_connections=pool_settings.max_connections,
+                max_keepalive_connections=pool_settings.max_keepalive_connections,
+                keepalive_expiry=pool_settings.keepalive_expiry,
+            )
+        ),
     )
-    result = []
 
-    for llm_request in requests:
-        response = openai_client.chat.completions.create(
-            model="datarobot-deployed-llm",
-            messages=[
-                {"role": "system", "content": llm_request.system_prompt},
-                {"role": "user", "content": llm_request.prompt},
-            ],
+
+_openai_clients: Dict[tuple[str, str, str], OpenAI] = {}
+_openai_clients_lock = threading.Lock()
+
+
+def get_openai_client(deployment_id: str) -> OpenAI:
+    """Return the process-wide OpenAI client of a deployment.
+
+    Clients are keyed by (endpoint, deployment id, token) and shared by every
+    session and thread. When the DataRobot token changes, the next call
+    creates a new client and closes the old one, releasing its connection
+    pool.
+    """
+    dr_client = dr.client.get_client()
+    key = (dr_client.endpoint, deployment_id, dr_client.token)
+    stale_clients = []
+    with _openai_clients_lock:
+        client = _openai_clients.get(key)
+        if client is None:
+            for stale_key in [k for k in _openai_clients if k[:2] == key[:2]]:
+                logger.info(f"Refreshing OpenAI client of deployment {deployment_id}")
+                stale_clients.append(_openai_clients.pop(stale_key))
+            client = _openai_clients[key] = create_openai_client(deployment_id)
+    for stale_client in stale_clients:
+        stale_client.close()
+    return client
+
+
+# Base URLs of generative deployments that rejected or ignored the `n` parameter
+_n_unsupported: set[str] = set()
+# `n` as a word of an error message, e.g. "Unsupported parameter: 'n'"
+_N_PARAMETER = re.compile(r"(?<![\w\\-])n(?![\w-])")
+
+
+def _rejects_n(error: APIStatusError) -> bool:
+    """Whether a deployment's error response is about the `n` parameter"""
+    return error.status_code in (400, 422) and bool(
+        _N_PARAMETER.search(str(error.message))
+    )
+
+
+def _completion_generations(
+    response: ChatCompletion, llm_request: LLMRequest
+) -> list[Generation]:
+    """One generation per choice of a completion.
+
+    A choice carrying its own `datarobot_association_id` keeps it. Otherwise
+    every choice gets the completion's association id, the one DataRobot
+    tracks, and is told apart by `Generation.completion_position`.
+    """
+    association_id = extract_association_id_from_completion(response)
+    generations = []
+    for position, choice in enumerate(response.choices):
+        if choice.finish_reason == "length":
+            runtime_metrics.increment("llm.truncations")
+            logger.warning(
+                f"Completion truncated at max_tokens={llm_request.max_tokens} "
+                f"({llm_request.verbosity} verbosity)"
+            )
+        choice_association_id = (choice.model_extra or {}).get(
+            "datarobot_association_id", association_id
         )
-        association_id = extract_association_id_from_completion(response)
-        generation = Generation(
-            content=response.choices[0].message.content,
-            prompt_used=llm_request.prompt,
-            association_id=association_id,
+        generations.append(
+            Generation(
+                content=choice.message.content,
+                prompt_used=llm_request.prompt,
+                association_id=str(choice_association_id),
+                completion_position=position,
+            )
         )
+    return generations
+
+
+def _generate(
+    openai_client: OpenAI, llm_request: LLMRequest, n: int = 1
+) -> list[Generation]:
+    response = llm_call_policy.call(
+        lambda timeout: _create_chat_completion(
+            openai_client, llm_request, timeout, n=n
+        ),
+        deadline=llm_request.deadline,
+    )
+    return _completion_generations(response, llm_request)
+
+
+def _generate_variants(
+    openai_client: OpenAI, llm_request: LLMRequest
+) -> list[Generation]:
+    """Generate `llm_request.variants` drafts, in one call where possible.
+
+    The drafts are requested with `n` in a single completion. A deployment
+    that rejects `n` (a 400/422 response naming it) or returns fewer choices
+    is remembered, and the missing drafts are generated with parallel single
+    calls instead. Other errors are raised.
+    """
+    variants = llm_request.variants
+    deployment = str(openai_client.base_url)
+    generations: list[Generation] = []
+    if variants > 1 and deployment not in _n_unsupported:
+        try:
+            generations = _generate(openai_client, llm_request, n=variants)[:variants]
+        except APIStatusError as e:
+            if not _rejects_n(e):
+                raise
+            logger.info(f"Generative deployment rejected n={variants}: {e}")
+        if len(generations) < variants:
+            _n_unsupported.add(deployment)
+    missing = variants - len(generations)
+    if missing == 1:
+        generations += _generate(openai_client, llm_request)
+    elif missing:
+        runtime_metrics.increment("llm.variant_fallback_calls", missing)
+        with ThreadPoolExecutor(max_workers=missing) as pool:
+            for single in pool.map(
+                lambda _: _generate(openai_client, llm_request), range(missing)
+            ):
+                generations += single
+    return generations
+
+
+def template_generation(llm_request: LLMRequest) -> Generation:
+    """Generation holding the request's template email instead of an LLM answer.
+
+    `prompt_used` is empty so a checkpointed job retries the LLM for the row
+    when it is resumed.
+    """
+    runtime_metrics.increment("emails.template")
+    return Generation(
+        content=llm_request.fallback_content or "",
+        prompt_used="",
+        association_id=str(uuid.uuid4()),
+        source="template",
+    )
+
+
+def is_llm_unavailable(error: Exception) -> bool:
+    """Whether a failure, after retries, means the LLM is down or too slow"""
+    return isinstance(
+        error, (CircuitOpenError, DeadlineExceededError)
+    ) or _is_retryable_llm_error(error)
+
+
+def _template_fallback(
+    llm_requests: list[LLMRequest], error: Exception
+) -> list[Generation]:
+    """Answer `llm_requests` with their template emails after `error`, or
+    re-raise it if the LLM is not unavailable or a request has no template"""
+    if (
+        not is_llm_unavailable(error)
+        or any(r.fallback_content is None for r in llm_requests)
+        or not TemplateFallbackSettings().template_fallback
+    ):
+        raise error
+    runtime_metrics.increment("llm.template_fallbacks", len(llm_requests))
+    logger.warning(
+        f"Generative deployment unavailable ({error!r}); using the template email "
+        f"for {len(llm_requests)} record(s)"
+    )
+    return [
+        template_generation(llm_request)
+        for llm_request in llm_requests
+        for _ in range(llm_request.variants)
+    ]
 
-        result.append(generation)
 
+def make_generative_deployment_predictions(
+    requests: list[LLMRequest],
+    openai_client: Optional[OpenAI] = None,
+) -> list[Generation]:
+    """Generate a completion for each request.
+
+    Uses the shared client of the generative deployment unless `openai_client`
+    is given. A request with `variants` > 1 yields that many consecutive
+    generations, see `_generate_variants`. If the deployment is unavailable or
+    misses the request's deadline, the last email generated for the same
+    prompt is served (`Generation.source == "cache"`), or else a request with
+    `fallback_content` gets its template email (`source == "template"`)
+    unless `NBO_TEMPLATE_FALLBACK` is false.
+
+    Concurrent requests with the same prompt to the same deployment share one
+    completion, and so its association id. With a shared cache
+    (`NBO_SHARED_CACHE_URL`), an email generated before by any replica for the
+    same prompt is reused without calling the deployment (`source == "cache"`).
+    """
+    if openai_client is None:
+        openai_client = get_openai_client(get_generative_deployment_id())
+    read_through = _generation_cache.shared is not None
+    result = []
+    for llm_request in requests:
+        key = cache_key(
+            llm_request.system_prompt,
+            llm_request.prompt,
+            llm_request.variants,
+            llm_request.max_tokens,
+            str(openai_client.base_url),
+        )
+        cached = _generation_cache.get_many([key])[0] if read_through else None
+        if cached is not None:
+            result += [
+                generation.model_copy(update={"source": "cache"})
+                for generation in cached
+            ]
+            continue
+        try:
+            generations = _generation_flights.do(
+                key, lambda: _generate_variants(openai_client, llm_request)
+            )
+        except Exception as e:
+            if not read_through and is_llm_unavailable(e):
+                cached = _generation_cache.get_many([key])[0]
+            if cached is None:
+                result += _template_fallback([llm_request], e)
+                continue
+            runtime_metrics.increment("llm.degraded_hits")
+            logger.warning(
+                f"Generative deployment unavailable ({e}); serving a cached email"
+            )
+            result += [
+                generation.model_copy(update={"source": "cache"})
+                for generation in cached
+            ]
+            continue
+        _generation_cache.set_many({key: generations})
+        result += generations
     return result
+
+
+PACKED_PROMPT_TEMPLATE = (
+    "Complete each of the {count} tasks below independently; they concern "
+    "different records.\n"
+    "Respond with only a JSON object whose keys are the record ids below and "
+    "whose values are the full response to that record's task, as a string.\n"
+    "{tasks}"
+)
+PACKED_TASK_TEMPLATE = "\n### Record id: {key}\n{prompt}\n"
+
+_JSON_OBJECT = re.compile(r"\{.*\}", re.DOTALL)
+
+
+def _sum_or_none(values: list[Any]) -> Any:
+    return None if None in values else sum(values)
+
+
+def _packed_keys(requests: list[LLMRequest]) -> list[str]:
+    """Record ids of the requests, or their positions if the ids are not unique"""
+    record_ids = [llm_request.record_id for llm_request in requests]
+    if None in record_ids or len(set(record_ids)) < len(record_ids):
+        return [str(position + 1) for position in range(len(requests))]
+    return [str(record_id) for record_id in record_ids]
+
+
+def _split_packed_content(content: Optional[str], keys: list[str]) -> Dict[str, str]:
+    """Responses per record id in a packed completion, leaving out unusable ones"""
+    match = _JSON_OBJECT.search(content or "")
+    if match is None:
+        return {}
+    try:
+        parsed = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(parsed, dict):
+        return {}
+    return {
+        key: parsed[key].strip()
+        for key in keys
+        if isinstance(parsed.get(key), str) and parsed[key].strip()
+    }
+
+
+def packed_prompt(requests: list[LLMRequest]) -> str:
+    """User message of one completion answering all of `requests`"""
+    return PACKED_PROMPT_TEMPLATE.format(
+        count=len(requests),
+        tasks="".join(
+            PACKED_TASK_TEMPLATE.format(key=key, prompt=llm_request.prompt)
+            for key, llm_request in zip(_packed_keys(requests), requests)
+        ),
+    )
+
+
+def make_packed_generative_deployment_predictions(
+    requests: list[LLMRequest],
+    openai_client: Optional[OpenAI] = None,
+) -> list[Generation]:
+    """Generate the responses of several requests with one completion.
+
+    The prompts are packed into one user message, keyed by `record_id`, that
+    asks for a JSON object mapping each record id to its response. Requests
+    must share their system prompt; `variants` is ignored. Records missing from
+    the JSON (or the whole pack, if it is not valid JSON) are generated with
+    one call each, counted as `llm.packed_fallbacks`.
+
+    Each `Generation` keeps its own request's prompt as `prompt_used`. They all
+    carry the packed completion's association id, with the record's position
+    in the pack as `completion_position`.
+    """
+    if openai_client is None:
+        openai_client = get_openai_client(get_generative_deployment_id())
+    if len(requests) == 1:
+        return make_generative_deployment_predictions(requests, openai_client)
+    if len({llm_request.system_prompt for llm_request in requests}) > 1:
+        raise ValueError("Packed requests must share their system prompt")
+
+    keys = _packed_keys(requests)
+    packed_request = requests[0].model_copy(
+        update={
+            "prompt": packed_prompt(requests),
+            "variants": 1,
+            "record_id": None,
+            "fallback_content": None,
+            # The packed answer holds every record's email
+            "max_tokens": _sum_or_none([r.max_tokens for r in requests]),
+            "deadline": _sum_or_none([r.deadline for r in requests]),
+        }
+    )
+    runtime_metrics.increment("llm.packed_calls")
+    try:
+        (packed,) = _generate(openai_client, packed_request)
+    except Exception as e:
+        return _template_fallback(requests, e)
+    contents = _split_packed_content(packed.content, keys)
+
+    generations = []
+    for position, (key, llm_request) in enumerate(zip(keys, requests)):
+        if key not in contents:
+            runtime_metrics.increment("llm.packed_fallbacks")
+            generations += make_generative_deployment_predictions(
+                [llm_request], openai_client
+            )
+            continue
+        generations.append(
+            Generation(
+                content=contents[key],
+                prompt_used=llm_request.prompt,
+                association_id=packed.association_id,
+                completion_position=position,
+            )
+        )
+    if len(contents) < len(keys):
+        logger.warning(
+            f"Packed completion answered {len(contents)} of {len(keys)} records; "
+            "generated the rest one by one"
+        )
+    return generations
@@ -15,10 +15,24 @@
 from __future__ import annotations
 
 import json
+import re
 import sys
-from typing import Any, ClassVar, Optional
-
-from pydantic import BaseModel, ConfigDict, Field, ValidationInfo, field_validator
+from dataclasses import dataclass
+from typing import Any, Iterable, Literal, Optional, TypeVar, Union, cast
+
+import numpy as np
+import pandas as pd
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    Field,
+    PrivateAttr,
+    ValidationInfo,
+    ValidatorFunctionWrapHandler,
+    computed_field,
+    field_validator,
+    model_validator,
+)
 
 sys.path.append("..")
 from nbo.i18n import gettext
@@ -42,6 +56,15 @@ class OutcomeDetail(BaseModel):
     description: str
 
 
+class VerbosityProfile(BaseModel):
+    # Defaults to the baseline of the response tokens custom metric
+    expected_output_tokens: int = 225
+    # Cap on the completion length (`max_tokens`), none by default
+    max_output_tokens: Optional[int] = Field(default=None, gt=0)
+    # Deadline of one email, retries included; NBO_LLM_DEADLINE_SECONDS by default
+    timeout_seconds: Optional[float] = Field(default=None, gt=0)
+
+
 class AppDataScienceSettings(BaseModel):
     model_config = ConfigDict(protected_namespaces=())
 
@@ -51,7 +74,7 @@ class AppDataScienceSettings(BaseModel):
     record_identifier: dict[str, str]
     custom_metric_baselines: dict[str, float]
     default_number_of_explanations: int
-    text_explanation_feature: str
+    text_explanation_feature: Optional[str] = None
     no_text_gen_label: Optional[str]
     tones: list[str]
     verbosity: list[str]
@@ -60,6 +83,10 @@ class AppDataScienceSettings(BaseModel):
     outcome_details: list[OutcomeDetail]
     system_prompt: str
     model_spec: LLMModelSpec
+    verbosity_profiles: dict[str, VerbosityProfile] = Field(default_factory=dict)
+
+    def get_verbosity_profile(self, verbosity: str) -> VerbosityProfile:
+        return self.verbosity_profiles.get(verbosity, VerbosityProfile())
 
 
 class AppInfraSettings(BaseModel):
@@ -80,12 +107,27 @@ class LLMRequest(BaseModel):
     tone: str
     verbosity: str
     system_prompt: str
+    # Number of drafts to generate from this prompt
+    variants: int = Field(default=1, ge=1, exclude=True)
+    # Key of the record in packed prompts, see make_packed_generative_deployment_predictions
+    record_id: Optional[str] = Field(default=None, exclude=True)
+    # Output token cap and deadline in seconds, from the verbosity profile
+    max_tokens: Optional[int] = Field(default=None, exclude=True)
+    deadline: Optional[float] = Field(default=None, exclude=True)
+    # Template email used if the LLM is unavailable, see render_template_email
+    fallback_content: Optional[str] = Field(default=None, exclude=True)
 
 
 class Generation(BaseModel):
     content: str
     prompt_used: str
     association_id: str
+    # "template" for emails rendered without the LLM, "cache" for an earlier
+    # email served while the LLM is unavailable
+    source: Literal["llm", "template", "cache"] = "llm"
+    # Position among the generations of one completion (its choices or the
+    # records of a packed prompt), which share its tracked association id
+    completion_position: int = 0
 
 
 # Dictionary to map quantitative strength symbols to descriptive text
@@ -104,7 +146,33 @@ class Explanation(BaseModel):
     strength: float
     qualitative_strength: str
     feature_value: Any
-    per_n_gram_text_explanation: Optional[list[dict[str, Any]]] = Field(default=None)
+
+    # TEXT_NGRAMS JSON of the response, replaced by its parsed value on first access
+    _text_ngrams: Union[str, list[dict[str, Any]], None] = PrivateAttr(default=None)
+
+    @computed_field  # type: ignore[prop-decorator]
+    @property
+    def per_n_gram_text_explanation(self) -> Optional[list[dict[str, Any]]]:
+        """N-gram explanations of a text feature, parsed only when first read"""
+        if isinstance(self._text_ngrams, str):
+            self._text_ngrams = _parse_text_ngrams(self._text_ngrams)
+        return self._text_ngrams
+
+    @model_validator(mode="wrap")
+    @classmethod
+    def keep_text_ngrams(
+        cls, data: Any, handler: ValidatorFunctionWrapHandler
+    ) -> Explanation:
+        """Accept `per_n_gram_text_explanation` (parsed or as the response's
+        JSON) as a keyword, as validation ignores computed fields"""
+        text_ngrams = None
+        if isinstance(data, dict) and "per_n_gram_text_explanation" in data:
+            data = dict(data)
+            text_ngrams = data.pop("per_n_gram_text_explanation")
+        explanation = cast(Explanation, handler(data))
+        if text_ngrams is not None:
+            explanation._text_ngrams = text_ngrams
+        return explanation
 
     @field_validator("qualitative_strength", mode="before")
     @classmethod
@@ -120,6 +188,27 @@ class Explanation(BaseModel):
             strength = info.data["strength"]
             return cls.create_qualitative_strength(strength)
 
+    @staticmethod
+    def create_qualitative_strengths(
+        strengths: pd.Series, qualitative_strengths: pd.Series
+    ) -> pd.Series:
+        """Vectorized `convert_qualitative_strength` over a response column"""
+        computed = np.select(
+            [
+                strengths > 0.5,
+                strengths > 0.3,
+                strengths > 0,
+                strengths > -0.3,
+                strengths > -0.5,
+            ],
+            ["+++", "++", "+", "-", "--"],
+            "---",
+        )
+        return qualitative_strengths.where(
+            qualitative_strengths.isin(list(QUALITATIVE_STRENGTHS)),
+            pd.Series(computed, index=qualitative_strengths.index),
+        )
+
     @staticmethod
     def create_qualitative_strength(strength: float) -> str:
         if strength > 0.5:
@@ -136,61 +225,280 @@ class Explanation(BaseModel):
             return "---"
 
 
+@dataclass(frozen=True)
+class ExplanationColumns:
+    """Response columns of the i-th prediction explanation"""
+
+    feature_name: str
+    strength: str
+    qualitative_strength: str
+    actual_value: str
+    text_ngrams: Optional[str]
+
+
+@dataclass(frozen=True)
+class PredictionColumnPlan:
+    """Mapping of prediction server response columns to `Prediction` fields.
+
+    Derived once from the columns of a response and reused for all its rows,
+    for any number of explanations.
+    """
+
+    # Probability column -> class name
+    probabilities: dict[str, str]
+    explanations: tuple[ExplanationColumns, ...]
+
+    @classmethod
+    def from_columns(
+        cls, columns: Iterable[str], offers_prefix: str
+    ) -> "PredictionColumnPlan":
+        columns = list(columns)
+        column_set = set(columns)
+        # Multiclass responses explain the predicted class as CLASS_1
+        multiclass = "CLASS_1_EXPLANATION_1_FEATURE_NAME" in column_set
+        pattern = re.compile(
+            r"CLASS_1_EXPLANATION_(\d+)_FEATURE_NAME"
+            if multiclass
+            else r"EXPLANATION_(\d+)_FEATURE_NAME"
+        )
+        numbers = sorted(
+            int(match.group(1))
+            for match in map(pattern.fullmatch, columns)
+            if match is not None
+        )
+        explanations = []
+        for i in numbers:
+            i_prefix = f"{'CLASS_1_' if multiclass else ''}EXPLANATION_{i}_"
+            explanations.append(
+                ExplanationColumns(
+                    feature_name=f"{i_prefix}FEATURE_NAME",
+                    strength=f"{i_prefix}STRENGTH",
+                    qualitative_strength=f"{i_prefix}QUALITATIVE_STRENGTH",
+                    actual_value=f"{i_prefix}ACTUAL_VALUE",
+                    text_ngrams=(
+                        f"{i_prefix}TEXT_NGRAMS"
+                        if f"{i_prefix}TEXT_NGRAMS" in column_set
+                        else None
+                    ),
+                )
+            )
+        return cls(
+            probabilities={
+                column: column.replace(f"{offers_prefix}_", "")
+                for column in columns
+                if column.startswith(f"{offers_prefix}_")
+            },
+            explanations=tuple(explanations),
+        )
+
+
+def _parse_text_ngrams(value: str) -> Optional[list[dict[str, Any]]]:
+    if value == "[]":
+        return None
+    return cast(list[dict[str, Any]], json.loads(value))
+
+
+def _text_ngrams(value: Any) -> Optional[str]:
+    # Missing n-grams come back as NaN
+    return value if isinstance(value, str) else None
+
+
+def _is_empty_value(value: Any) -> bool:
+    # NaN is the only value not equal to itself; NA (Arrow-backed nulls) is neither
+    return value is None or value is pd.NA or value != value or value in ("", "[]")
+
+
+def _column_values(column: pd.Series) -> list[Any]:
+    """Python values of a column, nulls of Arrow-backed columns as None.
+
+    `Series.tolist` converts Arrow-backed columns one element at a time.
+    """
+    if isinstance(column.dtype, pd.ArrowDtype):
+        return cast(list[Any], column.array.__arrow_array__().to_pylist())
+    return column.tolist()
+
+
+def _raw_row(
+    data: dict[str, Any], keep_raw: Optional[Literal["full", "compact"]]
+) -> Optional[dict[str, Any]]:
+    if keep_raw == "compact":
+        return {k: v for k, v in data.items() if not _is_empty_value(v)}
+    return data if keep_raw == "full" else None
+
+
+_Model = TypeVar("_Model", bound=BaseModel)
+
+
+def _construct(
+    model_cls: type[_Model],
+    values: dict[str, Any],
+    private: Optional[dict[str, Any]] = None,
+) -> _Model:
+    """`model_cls.model_construct(**values)` for trusted values that set every field.
+
+    Skips the alias and default lookups `model_construct` does for each field,
+    which dominate the cost of building many small objects. `private` sets
+    every private attribute of the model.
+    """
+    model = model_cls.__new__(model_cls)
+    object.__setattr__(model, "__dict__", values)
+    object.__setattr__(model, "__pydantic_fields_set__", set(values))
+    object.__setattr__(model, "__pydantic_extra__", None)
+    private_attributes = model_cls.__private_attributes__
+    if private is None and private_attributes:
+        private = {
+            name: attr.get_default() for name, attr in private_attributes.items()
+        }
+    object.__setattr__(model, "__pydantic_private__", private)
+    return model
+
+
+def _records(df: pd.DataFrame) -> list[dict[str, Any]]:
+    return cast(list[dict[str, Any]], df.to_dict(orient="records"))
+
+
 class Prediction(BaseModel):
     predicted_label: Any
     class_probabilities: dict[str, float]
     explanations: list[Explanation]
 
-    # Class variables
-    _original_dict: ClassVar[dict[str, Any]] = {}
-    _offers_prefix: ClassVar[str] = ""
+    # Per instance and excluded from serialization; only set when requested
+    _raw: Optional[dict[str, Any]] = PrivateAttr(default=None)
+
+    @property
+    def raw(self) -> Optional[dict[str, Any]]:
+        """The prediction server row this prediction was parsed from, if kept"""
+        return self._raw
 
     @classmethod
-    def parse_dict(cls, data: dict[str, Any], offers_prefix: str) -> "Prediction":
-        # Store the original dictionary and offers prefix
-        cls._original_dict = data
-        cls._offers_prefix = offers_prefix
-
-        # Extract predicted label
-        predicted_label = data["prediction"]
-
-        # Extract class probabilities
-        class_probabilities = {
-            k.replace(f"{offers_prefix}_", ""): v
-            for k, v in data.items()
-            if k.startswith(f"{offers_prefix}_")
-        }
+    def parse_dict(
+        cls,
+        data: dict[str, Any],
+        offers_prefix: str,
+        keep_raw: Optional[Literal["full", "compact"]] = None,
+        plan: Optional[PredictionColumnPlan] = None,
+    ) -> "Prediction":
+        """Parse one row of a prediction server response.
+
+        Parsing reads only its arguments, so rows can be parsed from any number
+        of threads at once. `keep_raw` keeps the row on the instance, either
+        as is or, with "compact", without its empty columns. Pass the `plan` of
+        the response when parsing many of its rows.
+        """
+        if plan is None:
+            plan = PredictionColumnPlan.from_columns(data, offers_prefix)
 
-        # Extract explanations
         explanations = []
-
-        # multiclass case
-        prefix = "CLASS_1_EXPLANATION_{}_"
-
-        # binary case
-        if prefix.format(1) + "FEATURE_NAME" not in data:
-            prefix = prefix.replace("CLASS_1_", "")
-
-        for i in range(1, 11):  # Assuming there are 10 explanations
-            i_prefix = prefix.format(i)
-
-            if f"{i_prefix}FEATURE_NAME" in data:
-                explanation = Explanation(
-                    feature_name=data[f"{i_prefix}FEATURE_NAME"],
-                    strength=float(data[f"{i_prefix}STRENGTH"]),
-                    qualitative_strength=data[f"{i_prefix}QUALITATIVE_STRENGTH"],
-                    feature_value=data[f"{i_prefix}ACTUAL_VALUE"],
-                    per_n_gram_text_explanation=(
-                        json.loads(data[f"{i_prefix}TEXT_NGRAMS"])
-                        if data[f"{i_prefix}TEXT_NGRAMS"] != "[]"
-                        else None
-                    ),
-                )
-                explanations.append(explanation)
+        for columns in plan.explanations:
+            if _is_empty_value(data[columns.feature_name]):
+                continue
+            explanation = Explanation(
+                feature_name=data[columns.feature_name],
+                strength=float(data[columns.strength]),
+                qualitative_strength=data[columns.qualitative_strength],
+                feature_value=data[columns.actual_value],
+            )
+            if columns.text_ngrams is not None:
+                explanation._text_ngrams = _text_ngrams(data[columns.text_ngrams])
+            explanations.append(explanation)
 
         # Create and return the Prediction object
-        return cls(
-            predicted_label=predicted_label,
-            class_probabilities=class_probabilities,
+        prediction = cls(
+            predicted_label=data["prediction"],
+            class_probabilities={
+                name: data[column] for column, name in plan.probabilities.items()
+            },
             explanations=explanations,
         )
+        prediction._raw = _raw_row(data, keep_raw)
+        return prediction
+
+    @classmethod
+    def parse_frame(
+        cls,
+        df: pd.DataFrame,
+        offers_prefix: str,
+        validate: bool = False,
+        keep_raw: Optional[Literal["full", "compact"]] = None,
+    ) -> list["Prediction"]:
+        """Parse every row of a prediction server response.
+
+        The server has already typed the response, so by default the objects
+        are built without validation (as `model_construct` would) after fixing
+        up the qualitative strengths a whole column at a time. `validate=True`
+        runs every row through `parse_dict` and full pydantic validation
+        instead.
+        """
+        plan = PredictionColumnPlan.from_columns(df.columns, offers_prefix)
+        if validate or df.empty:
+            return [
+                cls.parse_dict(row, offers_prefix, keep_raw, plan)
+                for row in _records(df)
+            ]
+
+        # Build each explanation column by column, then regroup them by row
+        explanation_columns = []
+        for columns in plan.explanations:
+            strengths = df[columns.strength].astype(float)
+            qualitative_strengths = Explanation.create_qualitative_strengths(
+                strengths, df[columns.qualitative_strength]
+            )
+            text_ngrams = (
+                _column_values(df[columns.text_ngrams])
+                if columns.text_ngrams is not None
+                else [None] * len(df)
+            )
+            explanation_columns.append(
+                [
+                    None
+                    if _is_empty_value(feature_name)
+                    else _construct(
+                        Explanation,
+                        {
+                            "feature_name": feature_name,
+                            "strength": strength,
+                            "qualitative_strength": qualitative_strength,
+                            "feature_value": feature_value,
+                        },
+                        {"_text_ngrams": _text_ngrams(ngrams)},
+                    )
+                    for feature_name, strength, qualitative_strength, feature_value, ngrams in zip(
+                        _column_values(df[columns.feature_name]),
+                        strengths.tolist(),
+                        _column_values(qualitative_strengths),
+                        _column_values(df[columns.actual_value]),
+                        text_ngrams,
+                    )
+                ]
+            )
+        explanations_by_row = (
+            zip(*explanation_columns) if explanation_columns else [()] * len(df)
+        )
+        probability_rows = (
+            df[list(plan.probabilities)]
+            .astype(float)
+            .rename(columns=plan.probabilities)
+            .to_dict(orient="records")
+        )
+        rows = _records(df) if keep_raw else None
+
+        predictions = []
+        for row, (label, probabilities, explanations) in enumerate(
+            zip(_column_values(df["prediction"]), probability_rows, explanations_by_row)
+        ):
+            prediction = _construct(
+                cls,
+                {
+                    "predicted_label": label,
+                    "class_probabilities": probabilities,
+                    "explanations": [
+                        explanation
+                        for explanation in explanations
+                        if explanation is not None
+                    ],
+                },
+            )
+            if rows is not None:
+                prediction._raw = _raw_row(rows[row], keep_raw)
+            predictions.append(prediction)
+        return predictions
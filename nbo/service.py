@@ -0,0 +1,295 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Async HTTP service that scores records and drafts emails.
+
+Run with:
+    uvicorn nbo.service:app --host 0.0.0.0 --port 8080
+
+The DataRobot and OpenAI clients are blocking, so calls to the deployments run
+on worker threads while the event loop handles admission control and streaming.
+Chat completions use the process-wide pooled OpenAI client of the deployment.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Literal, Optional
+
+import pandas as pd
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from pydantic import AliasChoices, BaseModel, Field
+from pydantic_settings import BaseSettings
+
+from nbo.pipeline import (
+    create_llm_request,
+    create_prompt,
+    load_app_settings,
+    no_action_message,
+    render_template_email,
+    set_outcome_details,
+)
+from nbo.predict import (
+    LLMConcurrencySettings,
+    make_generative_deployment_predictions,
+    make_pred_ai_deployment_predictions,
+)
+from nbo.schema import AppDataScienceSettings, Prediction
+from nbo.telemetry import runtime_metrics
+
+logger = logging.getLogger(__name__)
+
+service_max_concurrency_env_name: str = "NBO_SERVICE_MAX_CONCURRENCY"
+app_settings_path_env_name: str = "NBO_APP_SETTINGS_PATH"
+
+
+class ServiceSettings(BaseSettings):
+    """Admission limit and app settings location of the HTTP service"""
+
+    max_concurrent_requests: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + service_max_concurrency_env_name,
+            service_max_concurrency_env_name,
+        ),
+        default=32,
+        gt=0,
+    )
+    app_settings_path: Optional[Path] = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + app_settings_path_env_name,
+            app_settings_path_env_name,
+        ),
+        default=None,
+    )
+
+
+class EmailOptions(BaseModel):
+    number_of_explanations: Optional[int] = Field(default=None, ge=0)
+    tone: Optional[str] = None
+    verbosity: Optional[str] = None
+
+
+class RecordRequest(EmailOptions):
+    record: dict[str, Any]
+
+
+class RecordsRequest(EmailOptions):
+    records: list[dict[str, Any]] = Field(min_length=1)
+
+
+class EmailResponse(BaseModel):
+    index: int = 0
+    record_id: str
+    label: str
+    email: str
+    association_id: Optional[str] = None
+    # "template" or "cache" if the LLM was unavailable, see Generation.source
+    source: Literal["llm", "template", "cache", "no_action"] = "llm"
+    prediction: Prediction
+
+
+class EmailError(BaseModel):
+    index: int
+    record_id: str
+    error: str
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    settings = ServiceSettings()
+    # Enough threads for every admitted request plus every LLM call in flight
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(
+            max_workers=settings.max_concurrent_requests
+            + LLMConcurrencySettings().max_concurrency,
+            thread_name_prefix="nbo-service",
+        )
+    )
+    app.state.app_settings = load_app_settings(settings.app_settings_path)
+    app.state.limiter = asyncio.Semaphore(settings.max_concurrent_requests)
+    yield
+
+
+app = FastAPI(title="Predictive Content Generator", lifespan=lifespan)
+
+
+def _resolve_options(
+    options: EmailOptions, app_settings: AppDataScienceSettings
+) -> tuple[int, str, str]:
+    tone = options.tone or app_settings.tones[0]
+    verbosity = options.verbosity or app_settings.verbosity[0]
+    if tone not in app_settings.tones:
+        raise HTTPException(422, f"tone must be one of {app_settings.tones}")
+    if verbosity not in app_settings.verbosity:
+        raise HTTPException(422, f"verbosity must be one of {app_settings.verbosity}")
+    number_of_explanations = (
+        options.number_of_explanations
+        if options.number_of_explanations is not None
+        else app_settings.default_number_of_explanations
+    )
+    return number_of_explanations, tone, verbosity
+
+
+async def _predict(
+    records: list[dict[str, Any]], number_of_explanations: int
+) -> list[Prediction]:
+    return await asyncio.to_thread(
+        make_pred_ai_deployment_predictions,
+        pd.DataFrame.from_records(records),
+        number_of_explanations,
+    )
+
+
+async def _draft_email(
+    index: int,
+    record_id: str,
+    prediction: Prediction,
+    number_of_explanations: int,
+    tone: str,
+    verbosity: str,
+    app_settings: AppDataScienceSettings,
+) -> EmailResponse:
+    label = set_outcome_details(app_settings.outcome_details)[
+        prediction.predicted_label
+    ].label
+    if prediction.predicted_label == app_settings.no_text_gen_label:
+        return EmailResponse(
+            index=index,
+            record_id=record_id,
+            label=label,
+            email=no_action_message(record_id),
+            source="no_action",
+            prediction=prediction,
+        )
+    llm_request = create_llm_request(
+        prompt=create_prompt(
+            prediction_data=prediction,
+            selected_record=record_id,
+            number_of_explanations=number_of_explanations,
+            tone=tone,
+            verbosity=verbosity,
+            app_settings=app_settings,
+        ),
+        number_of_explanations=number_of_explanations,
+        tone=tone,
+        verbosity=verbosity,
+        app_settings=app_settings,
+        fallback_content=render_template_email(
+            prediction, record_id, number_of_explanations, app_settings
+        ),
+    )
+    generations = await asyncio.to_thread(
+        make_generative_deployment_predictions, [llm_request]
+    )
+    return EmailResponse(
+        index=index,
+        record_id=record_id,
+        label=label,
+        email=generations[0].content,
+        association_id=generations[0].association_id,
+        source=generations[0].source,
+        prediction=prediction,
+    )
+
+
+def _record_id(record: dict[str, Any], app_settings: AppDataScienceSettings) -> str:
+    return str(record.get(app_settings.record_identifier["column_name"], ""))
+
+
+@app.get("/health")
+async def health() -> dict[str, str]:
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+async def metrics() -> dict[str, float]:
+    """Runtime metrics of the process, e.g. the adaptive LLM concurrency window"""
+    return runtime_metrics.snapshot()
+
+
+@app.post("/predict")
+async def predict(body: RecordsRequest, request: Request) -> list[Prediction]:
+    app_settings: AppDataScienceSettings = request.app.state.app_settings
+    number_of_explanations, _, _ = _resolve_options(body, app_settings)
+    async with request.app.state.limiter:
+        return await _predict(body.records, number_of_explanations)
+
+
+@app.post("/emails")
+async def email(body: RecordRequest, request: Request) -> EmailResponse:
+    app_settings: AppDataScienceSettings = request.app.state.app_settings
+    number_of_explanations, tone, verbosity = _resolve_options(body, app_settings)
+    async with request.app.state.limiter:
+        predictions = await _predict([body.record], number_of_explanations)
+        return await _draft_email(
+            0,
+            _record_id(body.record, app_settings),
+            predictions[0],
+            number_of_explanations,
+            tone,
+            verbosity,
+            app_settings,
+        )
+
+
+@app.post("/emails/batch")
+async def emails_batch(body: RecordsRequest, request: Request) -> StreamingResponse:
+    """Score all records in one request and stream each email as NDJSON once drafted.
+
+    Lines arrive in completion order and carry the record's `index` in the
+    request. A record whose generation fails yields an error line instead of
+    failing the whole stream.
+    """
+    app_settings: AppDataScienceSettings = request.app.state.app_settings
+    number_of_explanations, tone, verbosity = _resolve_options(body, app_settings)
+    limiter: asyncio.Semaphore = request.app.state.limiter
+    await limiter.acquire()
+    try:
+        predictions = await _predict(body.records, number_of_explanations)
+    except BaseException:
+        limiter.release()
+        raise
+
+    record_ids = [_record_id(record, app_settings) for record in body.records]
+
+    async def draft(index: int) -> EmailResponse | EmailError:
+        try:
+            return await _draft_email(
+                index,
+                record_ids[index],
+                predictions[index],
+                number_of_explanations,
+                tone,
+                verbosity,
+                app_settings,
+            )
+        except Exception as e:
+            logger.exception(f"Email generation failed for record {record_ids[index]}")
+            return EmailError(index=index, record_id=record_ids[index], error=str(e))
+
+    async def stream() -> AsyncIterator[str]:
+        tasks = [asyncio.create_task(draft(index)) for index in range(len(predictions))]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield (await next_done).model_dump_json() + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+            limiter.release()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
@@ -0,0 +1,51 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import threading
+from typing import Callable, Dict
+
+
+class RuntimeMetrics:
+    """Process-wide counters and gauges about calls to the deployments.
+
+    Counters accumulate events (e.g. throttled requests); gauges are read from a
+    callback when a snapshot is taken (e.g. the current concurrency window).
+    These are operational metrics of the app process, unlike the per-generation
+    custom metrics reported to DataRobot.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def increment(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        with self._lock:
+            self._gauges[name] = read
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values = dict(self._counters)
+            gauges = dict(self._gauges)
+        values.update({name: read() for name, read in gauges.items()})
+        return dict(sorted(values.items()))
+
+
+runtime_metrics = RuntimeMetrics()
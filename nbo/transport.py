@@ -0,0 +1,150 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import csv
+import gzip
+import io
+import logging
+import re
+from typing import Iterable, cast
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from pydantic import AliasChoices, Field
+from pydantic_settings import BaseSettings
+
+logger = logging.getLogger(__name__)
+
+# Largest request body the prediction API accepts
+REQUEST_LIMIT_BYTES = 50 * 1024 * 1024
+
+gzip_min_bytes_env_name: str = "NBO_PREDICTION_GZIP_MIN_BYTES"
+
+
+class ScoringPayloadSettings(BaseSettings):
+    """Encoding of prediction request bodies"""
+
+    gzip_min_bytes: int = Field(
+        validation_alias=AliasChoices(
+            "MLOPS_RUNTIME_PARAM_" + gzip_min_bytes_env_name,
+            gzip_min_bytes_env_name,
+        ),
+        default=64 * 1024,
+    )
+
+
+_EXPLANATION_STRING_COLUMN = re.compile(
+    r"(CLASS_\d+_)?EXPLANATION_\d+_(FEATURE_NAME|QUALITATIVE_STRENGTH|TEXT_NGRAMS)"
+)
+_EXPLANATION_STRENGTH_COLUMN = re.compile(r"(CLASS_\d+_)?EXPLANATION_\d+_STRENGTH")
+
+
+def prediction_column_types(
+    columns: list[str], target_name: str
+) -> dict[str, pa.DataType]:
+    """Arrow types of the columns of a prediction server response.
+
+    Explanation and probability columns have a known type. Every other column
+    (predicted label, actual values, passthrough columns) is read as text and
+    converted afterwards, because a column such as `EXPLANATION_1_ACTUAL_VALUE`
+    holds the values of different features in different rows.
+    """
+    column_types: dict[str, pa.DataType] = {}
+    for column in columns:
+        if _EXPLANATION_STRENGTH_COLUMN.fullmatch(column) or (
+            column.startswith(f"{target_name}_")
+            and column.endswith("_PREDICTION")
+            and column != f"{target_name}_PREDICTION"
+        ):
+            column_types[column] = pa.float64()
+        else:
+            column_types[column] = pa.string()
+    return column_types
+
+
+def _infer_numeric(array: pa.ChunkedArray) -> pa.ChunkedArray:
+    """Convert a text column to integers or floats if every value is a number"""
+    for numeric_type in (pa.int64(), pa.float64()):
+        try:
+            return pc.cast(array, numeric_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            continue
+    return array
+
+
+def read_prediction_csv(content: bytes, target_name: str) -> pd.DataFrame:
+    """Read a CSV prediction response into an Arrow-backed DataFrame.
+
+    The columns stay Arrow arrays (`pd.ArrowDtype`) so `Prediction.parse_frame`
+    reads them without an intermediate object-dtype frame.
+    """
+    header_line = content.split(b"\n", 1)[0].rstrip(b"\r").decode()
+    columns = next(csv.reader([header_line]))
+    column_types = prediction_column_types(columns, target_name)
+    table = pa_csv.read_csv(
+        io.BytesIO(content),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types, strings_can_be_null=True
+        ),
+    )
+    for index, name in enumerate(table.column_names):
+        inferred = column_types[name] == pa.string()
+        if inferred and not _EXPLANATION_STRING_COLUMN.fullmatch(name):
+            table = table.set_column(index, name, _infer_numeric(table.column(index)))
+    return cast(pd.DataFrame, table.to_pandas(types_mapper=pd.ArrowDtype))
+
+
+def trim_scoring_frame(df: pd.DataFrame, columns: Iterable[str]) -> pd.DataFrame:
+    """Keep only the columns the deployment reads, in upload order.
+
+    The frame is returned unchanged if none of `columns` are present, so a
+    deployment that reports no features still gets the full upload.
+    """
+    wanted = set(columns)
+    kept = [column for column in df.columns if column in wanted]
+    if not kept:
+        return df
+    if len(kept) < len(df.columns):
+        logger.debug(f"Dropping {len(df.columns) - len(kept)} unused scoring columns")
+    return df[kept]
+
+
+def encode_scoring_payload(
+    df: pd.DataFrame, gzip_min_bytes: int
+) -> tuple[bytes, dict[str, str]]:
+    """Serialize a scoring frame to a CSV request body and its headers.
+
+    Bodies of at least `gzip_min_bytes` are gzip-compressed. The number of
+    bytes sent per row is logged.
+    """
+    headers = {"Content-Type": "text/csv", "Accept": "text/csv"}
+    body = df.to_csv(index=False).encode()
+    raw_size = len(body)
+    if raw_size >= gzip_min_bytes:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    if len(body) > REQUEST_LIMIT_BYTES:
+        raise ValueError(
+            f"Scoring request exceeds the 50MB request limit: {len(body)} bytes"
+        )
+    logger.info(
+        f"Scoring {len(df)} rows x {len(df.columns)} columns: {len(body)} bytes sent "
+        f"({len(body) / max(1, len(df)):.0f} bytes/row"
+        + (f", gzip from {raw_size} bytes)" if "Content-Encoding" in headers else ")")
+    )
+    return body, headers
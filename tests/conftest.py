@@ -0,0 +1,70 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import uuid
+from typing import Iterator
+
+import pytest
+from datarobot.client import RESTClientObject, set_client
+from fastapi import FastAPI
+from openai import OpenAI
+
+import nbo.predict
+from nbo.policy import CircuitBreaker
+from tests.standins import (
+    STANDIN_GENERATIVE_DEPLOYMENT_ID,
+    llm_standin,
+    prediction_standin,
+    serve,
+)
+
+
+@pytest.fixture(autouse=True)
+def call_policies(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Fresh breakers and no backoff, so failures in one test do not leak"""
+    for policy in (nbo.predict.prediction_call_policy, nbo.predict.llm_call_policy):
+        monkeypatch.setattr(policy, "base_delay", 0.0)
+        monkeypatch.setattr(policy, "breaker", CircuitBreaker(policy.name))
+
+
+@pytest.fixture
+def prediction_server(llm_server: tuple[FastAPI, OpenAI]) -> Iterator[FastAPI]:
+    """PredAI deployment stand-in, used by the DataRobot client in the test.
+
+    It also serves `llm_server` as the generative deployment.
+    """
+    app = prediction_standin(generative=llm_server[0])
+    with serve(app) as url:
+        # Set globally, as scoring can run on other threads
+        previous = set_client(
+            RESTClientObject(auth="standin", endpoint=f"{url}/api/v2")
+        )
+        nbo.predict.override_deployment_ids(
+            pred_ai_deployment_id=uuid.uuid4().hex,
+            generative_deployment_id=STANDIN_GENERATIVE_DEPLOYMENT_ID,
+        )
+        try:
+            yield app
+        finally:
+            set_client(previous)
+
+
+@pytest.fixture
+def llm_server() -> Iterator[tuple[FastAPI, OpenAI]]:
+    """Generative deployment stand-in and a client without retries"""
+    app = llm_standin(drop_packed_record=True)
+    with serve(app) as url:
+        yield app, OpenAI(base_url=url, api_key="standin", max_retries=0)
@@ -0,0 +1,459 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for the deployments, for tests and benchmarks.
+
+`prediction_standin` answers the DataRobot API and prediction server calls
+made to score records with the PredAI deployment, `llm_standin` answers the
+OpenAI-compatible chat completions API of the generative deployment, including
+`n` choices and packed prompts, and `serve_resp` runs a minimal Redis-protocol
+server for the shared cache. They all run in-process on a free local port.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import gzip
+import io
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Iterator, Optional
+
+import numpy as np
+import pandas as pd
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
+
+from nbo.transport import read_prediction_csv
+
+_PACKED_KEY = re.compile(r"### Record id: (\S+)")
+
+STANDIN_TARGET = "offer"
+STANDIN_CLASSES = ("Upgrade", "Retention call", "No action")
+STANDIN_FEATURES = ("age", "plan", "notes")
+STANDIN_GENERATIVE_DEPLOYMENT_ID = "standin-llm"
+
+# N-grams of the notes text, strongest first
+_NGRAMS = [
+    {"ngrams": [{"starting_index": 0, "ending_index": 4}], "strength": 0.3},
+    {"ngrams": [{"starting_index": 5, "ending_index": 6}], "strength": 0.2},
+    {"ngrams": [{"starting_index": 7, "ending_index": 15}], "strength": 0.1},
+]
+
+# App settings for the stand-in deployments, as written by the training notebook
+STANDIN_APP_SETTINGS: dict[str, Any] = {
+    "association_id_column_name": "association_id",
+    "page_title": "Offers",
+    "page_subtitle": "",
+    "record_identifier": {"column_name": "customer_id", "display_name": "Customer"},
+    "custom_metric_baselines": {},
+    "default_number_of_explanations": 3,
+    "no_text_gen_label": "No action",
+    "tones": ["friendly", "formal"],
+    "verbosity": ["short"],
+    "target_probability_description": "likelihood to accept",
+    "email_prompt": "Write a {tone}, {verbosity} email to {selected_record} "
+    "about {prediction_label}. {rsp}",
+    "outcome_details": [
+        {"prediction": name, "label": name, "description": name}
+        for name in STANDIN_CLASSES
+    ],
+    "system_prompt": "You write emails.",
+    "model_spec": {
+        "input_price_per_1k_tokens": 0.001,
+        "output_price_per_1k_tokens": 0.002,
+    },
+}
+
+
+def _blank(
+    values: np.ndarray[Any, Any], empty: np.ndarray[Any, Any]
+) -> np.ndarray[Any, Any]:
+    column = values.astype(object)
+    column[empty] = None
+    return column
+
+
+def prediction_frame(
+    n_rows: int,
+    explanations: int = 3,
+    seed: int = 0,
+    ngram_explanations: Optional[int] = 1,
+) -> pd.DataFrame:
+    """Multiclass prediction server response for `n_rows` records.
+
+    Each row explains `explanations` features of different types (an integer,
+    a category and a text); about a fifth of the rows have one explanation
+    less. Explanations of the text get its top `ngram_explanations` n-grams,
+    and there are no TEXT_NGRAMS columns if it is None, as when
+    `maxNgramExplanations` is not requested.
+    """
+    rng = np.random.default_rng(seed)
+    probabilities = rng.dirichlet(np.ones(len(STANDIN_CLASSES)), n_rows)
+    frame: dict[str, Any] = {
+        f"{STANDIN_TARGET}_PREDICTION": np.array(STANDIN_CLASSES)[
+            probabilities.argmax(axis=1)
+        ]
+    }
+    for index, name in enumerate(STANDIN_CLASSES):
+        frame[f"{STANDIN_TARGET}_{name}_PREDICTION"] = probabilities[:, index]
+    frame["DEPLOYMENT_APPROVAL_STATUS"] = "APPROVED"
+
+    ngrams = json.dumps(_NGRAMS[:ngram_explanations])
+    values = {
+        "age": rng.integers(18, 90, n_rows).astype(str),
+        "plan": rng.choice(["basic", "family plan", "premium"], n_rows),
+        "notes": rng.choice(["wants a discount", "asked about 5G"], n_rows),
+    }
+    short_rows = rng.random(n_rows) < 0.2
+    for i in range(1, explanations + 1):
+        features = rng.choice(STANDIN_FEATURES, n_rows)
+        strengths = rng.uniform(-1, 1, n_rows)
+        empty = short_rows & (i == explanations)
+        prefix = f"CLASS_1_EXPLANATION_{i}_"
+        frame[prefix + "FEATURE_NAME"] = _blank(features, empty)
+        frame[prefix + "STRENGTH"] = np.where(empty, np.nan, strengths)
+        frame[prefix + "ACTUAL_VALUE"] = _blank(
+            np.select(
+                [features == name for name in STANDIN_FEATURES],
+                [values[name] for name in STANDIN_FEATURES],
+                "",
+            ),
+            empty,
+        )
+        frame[prefix + "QUALITATIVE_STRENGTH"] = _blank(
+            np.where(strengths > 0, "++", "-"), empty
+        )
+        if ngram_explanations is not None:
+            frame[prefix + "TEXT_NGRAMS"] = _blank(
+                np.where(features == "notes", ngrams, "[]"), empty
+            )
+    return pd.DataFrame(frame)
+
+
+def parser_frame(n_rows: int, explanations: int = 3) -> pd.DataFrame:
+    """A `prediction_frame` as `_score_pred_ai_deployment` hands it to
+    `Prediction.parse_frame`: read with Arrow and with the suffixes stripped"""
+    csv = prediction_frame(n_rows, explanations).to_csv(index=False).encode()
+    return strip_response_suffixes(read_prediction_csv(csv, STANDIN_TARGET))
+
+
+def strip_response_suffixes(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.rename(columns={f"{STANDIN_TARGET}_PREDICTION": "prediction"})
+    df.columns = df.columns.str.replace("_(PREDICTION|OUTPUT)$", "", regex=True)
+    return df
+
+
+def prediction_standin(
+    delay: float = 0.0, generative: Optional[FastAPI] = None
+) -> FastAPI:
+    """PredAI deployment stand-in serving the DataRobot API and prediction server.
+
+    It answers the version check of `datarobot.Client`, `Deployment.get`, the
+    deployment's features and association id settings, and scoring requests
+    with a `prediction_frame` per request, after `app.state.delay` seconds.
+    Responses have as many explanations and n-grams as the `maxExplanations`
+    and `maxNgramExplanations` query parameters ask for. Set
+    `app.state.unavailable` to answer scoring requests with 503;
+    `app.state.requests` holds the frames received and `app.state.params`
+    their query parameters.
+
+    A `generative` stand-in is served as the deployment
+    `STANDIN_GENERATIVE_DEPLOYMENT_ID`, where `create_openai_client` expects
+    it, so both deployments are reached through the DataRobot client.
+    """
+    app = FastAPI()
+    if generative is not None:
+        app.mount(f"/api/v2/deployments/{STANDIN_GENERATIVE_DEPLOYMENT_ID}", generative)
+    app.state.requests = []
+    app.state.params = []
+    app.state.delay = delay
+    app.state.unavailable = False
+
+    @app.get("/api/v2/version/")
+    async def version() -> dict[str, Any]:
+        return {"major": 2, "minor": 49, "versionString": "2.49.0"}
+
+    @app.get("/api/v2/deployments/{deployment_id}/")
+    async def deployment(deployment_id: str, request: Request) -> dict[str, Any]:
+        return {
+            "id": deployment_id,
+            "label": "Stand-in PredAI deployment",
+            "defaultPredictionServer": {
+                "id": "standin",
+                "url": str(request.base_url).rstrip("/"),
+                "datarobot-key": "standin-key",
+            },
+            "model": {"id": "model", "type": "Stand-in", "targetName": STANDIN_TARGET},
+        }
+
+    @app.get("/api/v2/deployments/{deployment_id}/features/")
+    async def features(deployment_id: str) -> dict[str, Any]:
+        return {
+            "count": len(STANDIN_FEATURES),
+            "next": None,
+            "previous": None,
+            "data": [{"name": name} for name in STANDIN_FEATURES],
+        }
+
+    @app.get("/api/v2/deployments/{deployment_id}/settings/")
+    async def settings(deployment_id: str) -> dict[str, Any]:
+        return {
+            "associationId": {
+                "columnNames": ["association_id"],
+                "requiredInPredictionRequests": False,
+            }
+        }
+
+    @app.post("/predApi/v1.0/deployments/{deployment_id}/predictions")
+    async def predictions(request: Request) -> Response:
+        body = await request.body()
+        if request.headers.get("content-encoding") == "gzip":
+            body = gzip.decompress(body)
+        df = pd.read_csv(io.BytesIO(body))
+        params = dict(request.query_params)
+        app.state.requests.append(df)
+        app.state.params.append(params)
+        if app.state.unavailable:
+            raise HTTPException(503, "Stand-in deployment unavailable")
+        await asyncio.sleep(app.state.delay)
+        ngram_explanations = params.get("maxNgramExplanations")
+        response = prediction_frame(
+            len(df),
+            explanations=int(params.get("maxExplanations", 0)),
+            seed=len(app.state.requests),
+            ngram_explanations=(
+                None
+                if ngram_explanations is None
+                else len(_NGRAMS)
+                if ngram_explanations == "all"
+                else int(ngram_explanations)
+            ),
+        )
+        return Response(response.to_csv(index=False), media_type="text/csv")
+
+    return app
+
+
+def llm_standin(delay: float = 0.0, drop_packed_record: bool = False) -> FastAPI:
+    """Chat completions stand-in that answers after `app.state.delay` seconds.
+
+    Packed prompts get a JSON object with one response per record id, without
+    the last one if `drop_packed_record` is set. Set `app.state.unavailable`
+    to answer 503, `app.state.bad_request` to answer 400 with that message,
+    and `app.state.supports_n` to False to reject `n` > 1 like deployments
+    that do not support it. Choices end with `app.state.finish_reason`.
+    Read the number of completions from `app.state.calls` and the
+    `max_tokens` of each request (None if not sent) from
+    `app.state.max_tokens`.
+    """
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.delay = delay
+    app.state.unavailable = False
+    app.state.bad_request = None
+    app.state.supports_n = True
+    app.state.finish_reason = "stop"
+    app.state.max_tokens = []
+
+    @app.post("/chat/completions")
+    async def chat_completions(request: Request) -> dict[str, Any]:
+        body = await request.json()
+        app.state.calls += 1
+        app.state.max_tokens.append(body.get("max_tokens"))
+        if app.state.unavailable:
+            raise HTTPException(503, "Stand-in deployment unavailable")
+        if app.state.bad_request is not None:
+            raise HTTPException(400, app.state.bad_request)
+        if not app.state.supports_n and body.get("n", 1) > 1:
+            raise HTTPException(400, "Unsupported parameter: 'n'")
+        await asyncio.sleep(app.state.delay)
+        prompt = body["messages"][-1]["content"]
+        keys = _PACKED_KEY.findall(prompt)
+        if keys:
+            answered = keys[:-1] if drop_packed_record else keys
+            contents = [
+                "```json\n"
+                + "{"
+                + ", ".join(f'"{key}": "Email for record {key}"' for key in answered)
+                + "}\n```"
+            ]
+        else:
+            contents = [
+                f"Draft {index + 1}: {prompt[:40]}" for index in range(body.get("n", 1))
+            ]
+        return {
+            "id": str(uuid.uuid4()),
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "standin"),
+            "choices": [
+                {
+                    "index": index,
+                    "finish_reason": app.state.finish_reason,
+                    "message": {"role": "assistant", "content": content},
+                }
+                for index, content in enumerate(contents)
+            ],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+            "datarobot_association_id": str(uuid.uuid4()),
+        }
+
+    return app
+
+
+def _free_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Accepted connections inherit this; without it small responses wait for
+    # delayed ACKs (about 40ms per request)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+@contextmanager
+def serve(app: FastAPI) -> Iterator[str]:
+    """Serve `app` on a free local port and yield its base URL"""
+    sock = _free_socket()
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(
+        target=server.run, kwargs={"sockets": [sock]}, daemon=True
+    )
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Stand-in server failed to start")
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
+
+
+def _bulk(value: Optional[bytes]) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+class _RespStore:
+    """Values and expiry times of the Redis-protocol stand-in"""
+
+    def __init__(self) -> None:
+        self.values: dict[bytes, tuple[bytes, Optional[float]]] = {}
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        entry = self.values.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.values[key]
+            return None
+        return value
+
+    def execute(self, command: list[bytes]) -> bytes:
+        name = command[0].upper()
+        if name == b"PING":
+            return b"+PONG\r\n"
+        if name in (b"SELECT", b"CLIENT"):
+            return b"+OK\r\n"
+        if name == b"GET":
+            return _bulk(self.get(command[1]))
+        if name == b"MGET":
+            return b"*%d\r\n" % (len(command) - 1) + b"".join(
+                _bulk(self.get(key)) for key in command[1:]
+            )
+        if name == b"SET":
+            options = [option.upper() for option in command[3:]]
+            expires_at = None
+            for unit, scale in ((b"EX", 1.0), (b"PX", 0.001)):
+                if unit in options:
+                    ttl = float(command[3 + options.index(unit) + 1]) * scale
+                    expires_at = time.monotonic() + ttl
+            self.values[command[1]] = (command[2], expires_at)
+            return b"+OK\r\n"
+        if name == b"DEL":
+            deleted = sum(self.values.pop(key, None) is not None for key in command[1:])
+            return b":%d\r\n" % deleted
+        if name == b"DBSIZE":
+            return b":%d\r\n" % len(self.values)
+        return b"-ERR unknown command '%s'\r\n" % name
+
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[list[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    command = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+@contextmanager
+def serve_resp() -> Iterator[str]:
+    """Run a Redis-protocol (RESP2) stand-in and yield its `redis://` URL.
+
+    It supports the commands `RedisCache` and redis-py's connection setup use:
+    PING, SELECT, CLIENT, GET, MGET, SET with EX or PX, DEL and DBSIZE.
+    """
+    store = _RespStore()
+    connections: set[asyncio.Task[Any]] = set()
+
+    async def handle(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        task = asyncio.current_task()
+        assert task is not None
+        connections.add(task)
+        try:
+            while (command := await _read_command(reader)) is not None:
+                writer.write(store.execute(command))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            connections.discard(task)
+            writer.close()
+
+    async def shutdown() -> None:
+        server.close()
+        for task in list(connections):
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+
+    loop = asyncio.new_event_loop()
+    sock = _free_socket()
+    port = sock.getsockname()[1]
+    server = loop.run_until_complete(asyncio.start_server(handle, sock=sock))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"redis://127.0.0.1:{port}/0"
+    finally:
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
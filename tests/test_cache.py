@@ -0,0 +1,266 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pytest
+
+import nbo.cache
+from nbo.cache import (
+    LRUCache,
+    RedisCache,
+    ResultCache,
+    SharedCache,
+    SingleFlight,
+    SQLiteCache,
+    cache_key,
+    get_shared_cache,
+)
+from nbo.telemetry import runtime_metrics
+from tests.standins import serve_resp
+
+
+def encode(value: str) -> bytes:
+    return value.encode()
+
+
+def decode(value: bytes) -> str:
+    if value.startswith(b"\xff"):
+        raise ValueError("corrupt entry")
+    return value.decode()
+
+
+class BrokenCache(SharedCache):
+    tier = "broken"
+    ttl_seconds = 60
+
+    def get_many(self, keys: list[str]) -> list[Optional[bytes]]:
+        raise sqlite3.OperationalError("disk I/O error")
+
+    def set_many(self, items: dict[str, bytes]) -> None:
+        raise sqlite3.OperationalError("disk I/O error")
+
+
+@pytest.fixture
+def sqlite_cache(tmp_path: Path) -> SQLiteCache:
+    return SQLiteCache(
+        tmp_path / "cache" / "nbo.db", ttl_seconds=60, max_entries=3, prune_every=1
+    )
+
+
+@pytest.fixture
+def redis_cache() -> Iterator[RedisCache]:
+    with serve_resp() as url:
+        yield RedisCache(url, ttl_seconds=60)
+
+
+def test_cache_key_is_stable_and_distinguishes_parts() -> None:
+    assert cache_key("a", {"x": 1, "y": 2}) == cache_key("a", {"y": 2, "x": 1})
+    assert cache_key("ab", "c") != cache_key("a", "bc")
+    assert cache_key(b"raw") == cache_key(b"raw")
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    cache: LRUCache[int] = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c"), len(cache)) == (1, 3, 2)
+
+
+def test_lru_cache_expires_entries() -> None:
+    cache: LRUCache[int] = LRUCache(max_entries=2)
+    cache.set("short", 1, ttl_seconds=0.05)
+    cache.set("forever", 2)
+    time.sleep(0.06)
+    assert cache.get("short") is None
+    assert cache.get("forever") == 2
+    assert len(cache) == 1
+
+
+def test_single_flight_shares_one_call() -> None:
+    flights: SingleFlight[int] = SingleFlight("test_flight")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def call() -> int:
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 42
+
+    def follow() -> None:
+        results.append(flights.do("key", call))
+
+    leader = threading.Thread(target=follow)
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=follow) for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    while runtime_metrics.snapshot().get("test_flight.coalesced", 0) < 4:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert results == [42] * 5
+    assert len(calls) == 1
+    # The key is released once the call is done
+    assert flights.do("key", lambda: 7) == 7
+
+
+def test_single_flight_shares_errors() -> None:
+    flights: SingleFlight[int] = SingleFlight("test_flight_errors")
+    started = threading.Event()
+    release = threading.Event()
+    errors = []
+
+    def call() -> int:
+        started.set()
+        release.wait()
+        raise ConnectionError("down")
+
+    def follow() -> None:
+        try:
+            flights.do("key", call)
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=follow) for _ in range(3)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    while runtime_metrics.snapshot().get("test_flight_errors.coalesced", 0) < 2:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3
+    assert errors[0] is errors[1] is errors[2]
+
+
+def test_sqlite_cache_round_trip_and_bound(sqlite_cache: SQLiteCache) -> None:
+    sqlite_cache.set_many({"a": b"1", "b": b"2"})
+    assert sqlite_cache.get_many(["a", "missing", "b"]) == [b"1", None, b"2"]
+    time.sleep(0.01)
+    sqlite_cache.set_many({"c": b"3", "d": b"4"})
+    assert sqlite_cache.get_many(["a", "b", "c", "d"]) == [None, b"2", b"3", b"4"]
+
+
+def test_sqlite_cache_prunes_every_few_writes(tmp_path: Path) -> None:
+    cache = SQLiteCache(
+        tmp_path / "nbo.db", ttl_seconds=60, max_entries=2, prune_every=3
+    )
+    for key in "abcd":
+        cache.set_many({key: b"1"})
+        time.sleep(0.01)
+    # Pruned on the third write only
+    assert cache.get_many(["a", "b", "c", "d"]) == [None, b"1", b"1", b"1"]
+
+
+def test_sqlite_cache_expires_entries(tmp_path: Path) -> None:
+    cache = SQLiteCache(tmp_path / "nbo.db", ttl_seconds=0.05, max_entries=10)
+    cache.set_many({"a": b"1"})
+    time.sleep(0.06)
+    assert cache.get_many(["a"]) == [None]
+
+
+def test_sqlite_cache_reads_in_batches(sqlite_cache: SQLiteCache) -> None:
+    keys = [str(i) for i in range(1200)]
+    assert sqlite_cache.get_many(keys) == [None] * 1200
+
+
+def test_redis_cache_round_trip(redis_cache: RedisCache) -> None:
+    redis_cache.set_many({"a": b"1", "b": b"2"})
+    assert redis_cache.get_many(["a", "missing", "b"]) == [b"1", None, b"2"]
+    assert redis_cache.get_many([]) == []
+
+
+def test_redis_cache_expires_entries_and_uses_its_prefix() -> None:
+    with serve_resp() as url:
+        cache = RedisCache(url, ttl_seconds=0.05)
+        other = RedisCache(url, ttl_seconds=60, prefix="other:")
+        cache.set_many({"a": b"1"})
+        assert other.get_many(["a"]) == [None]
+        time.sleep(0.06)
+        assert cache.get_many(["a"]) == [None]
+
+
+def test_result_cache_reads_through_tiers(sqlite_cache: SQLiteCache) -> None:
+    writer = ResultCache("test_tiers", 10, encode, decode, lambda: sqlite_cache)
+    reader = ResultCache("test_tiers", 10, encode, decode, lambda: sqlite_cache)
+    writer.set_many({"a": "1"})
+
+    assert reader.get_many(["a", "b"]) == ["1", None]
+    assert reader.memory.get("a") == "1"
+    assert reader.get_many(["a"]) == ["1"]
+    metrics = runtime_metrics.snapshot()
+    assert metrics["test_tiers.cache.memory.hits"] == 1
+    assert metrics["test_tiers.cache.memory.misses"] == 2
+    assert metrics["test_tiers.cache.sqlite.hits"] == 1
+    assert metrics["test_tiers.cache.sqlite.misses"] == 1
+
+
+def test_result_cache_memory_follows_shared_ttl(tmp_path: Path) -> None:
+    shared = SQLiteCache(tmp_path / "nbo.db", ttl_seconds=0.05, max_entries=10)
+    cache = ResultCache("test_ttl", 10, encode, decode, lambda: shared)
+    cache.set_many({"a": "1"})
+    assert cache.memory.get("a") == "1"
+    time.sleep(0.06)
+    assert cache.get_many(["a"]) == [None]
+
+
+def test_result_cache_skips_undecodable_entries(sqlite_cache: SQLiteCache) -> None:
+    sqlite_cache.set_many({"bad": b"\xff\x00", "good": b"1"})
+    cache = ResultCache("test_decode", 10, encode, decode, lambda: sqlite_cache)
+    assert cache.get_many(["bad", "good"]) == [None, "1"]
+    metrics = runtime_metrics.snapshot()
+    assert metrics["test_decode.cache.sqlite.decode_errors"] == 1
+    assert metrics["test_decode.cache.sqlite.misses"] == 1
+
+
+def test_result_cache_survives_shared_errors() -> None:
+    cache = ResultCache("test_broken", 10, encode, decode, BrokenCache)
+    cache.set_many({"a": "1"})
+    assert cache.get_many(["a", "b"]) == ["1", None]
+    assert runtime_metrics.snapshot()["test_broken.cache.broken.errors"] == 2
+
+
+def test_result_cache_without_shared_tier() -> None:
+    cache = ResultCache("test_memory", 10, encode, decode)
+    cache.set_many({"a": "1"})
+    assert cache.shared is None
+    assert cache.get_many(["a", "b"]) == ["1", None]
+
+
+def test_unusable_shared_cache_is_skipped(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("NBO_SHARED_CACHE_URL", "memcached://localhost")
+    monkeypatch.setattr(nbo.cache, "_shared_cache", None)
+    monkeypatch.setattr(nbo.cache, "_shared_cache_opened", False)
+    errors = runtime_metrics.snapshot().get("cache.shared.open_errors", 0)
+    assert get_shared_cache() is None
+    assert get_shared_cache() is None
+    assert runtime_metrics.snapshot()["cache.shared.open_errors"] == errors + 1
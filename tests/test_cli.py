@@ -0,0 +1,125 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import uuid
+from pathlib import Path
+
+import pandas as pd
+import pytest
+import yaml
+from fastapi import FastAPI
+from openai import OpenAI
+
+import nbo.costs
+from nbo.cli import main, parse_args
+from tests.standins import STANDIN_APP_SETTINGS
+
+
+@pytest.fixture
+def scoring_file(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, prediction_server: FastAPI
+) -> Path:
+    """Eight customers to score, next to the stand-in settings, with a fresh job
+    directory"""
+    (tmp_path / "app_settings.yaml").write_text(yaml.safe_dump(STANDIN_APP_SETTINGS))
+    monkeypatch.setenv("NBO_JOB_DIR", str(tmp_path / "jobs"))
+    # The tokenizer cannot be downloaded here
+    monkeypatch.setattr(
+        nbo.costs,
+        "count_tokens",
+        lambda texts, encoding_name=None: [len(text.split()) for text in texts],
+    )
+    path = tmp_path / "customers.csv"
+    # Unique ids, so no email comes from the cache of an earlier test
+    run_id = uuid.uuid4().hex[:8]
+    pd.DataFrame(
+        {
+            "customer_id": [f"{run_id}-{i}" for i in range(8)],
+            "age": [30 + i for i in range(8)],
+            "plan": ["basic"] * 8,
+            "notes": ["asked about 5G"] * 8,
+        }
+    ).to_csv(path, index=False)
+    return path
+
+
+def run_cli(scoring_file: Path, output: Path, *options: str) -> int:
+    settings = scoring_file.with_name("app_settings.yaml")
+    return main([str(scoring_file), str(output), f"--settings={settings}", *options])
+
+
+@pytest.mark.parametrize(
+    "option", ["--chunk-size=0", "--concurrency=-1", "--records-per-call=0"]
+)
+def test_non_positive_sizes_are_rejected(option: str) -> None:
+    with pytest.raises(SystemExit) as exit_info:
+        parse_args(["in.csv", "out.csv", option])
+    assert exit_info.value.code == 2
+
+
+def test_output_format_is_inferred_from_the_extension() -> None:
+    assert parse_args(["in.csv", "out.parquet"]).output_format == "parquet"
+    assert parse_args(["in.csv", "out.txt"]).output_format == "csv"
+    assert parse_args(["in.csv", "out.txt", "--format=jsonl"]).output_format == (
+        "jsonl"
+    )
+
+
+@pytest.mark.parametrize(
+    "options", [["--tone=sarcastic"], ["--sweep", "--tone=formal"]]
+)
+def test_invalid_prompt_settings_exit_with_2(
+    scoring_file: Path, prediction_server: FastAPI, options: list[str]
+) -> None:
+    output = scoring_file.with_name("emails.csv")
+    assert run_cli(scoring_file, output, *options) == 2
+    assert not output.exists()
+    assert prediction_server.state.requests == []
+
+
+def test_records_are_scored_in_chunks(
+    scoring_file: Path,
+    prediction_server: FastAPI,
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    output = scoring_file.with_name("emails.jsonl")
+    assert run_cli(scoring_file, output, "--chunk-size=3") == 0
+
+    assert [len(sent) for sent in prediction_server.state.requests] == [3, 3, 2]
+    emails = pd.read_json(output, lines=True)
+    customers = pd.read_csv(scoring_file)
+    assert emails["record_id"].tolist() == customers["customer_id"].tolist()
+    drafted = emails[emails["source"] == "llm"]
+    assert 0 < len(drafted) == llm_server[0].state.calls
+    assert (emails.loc[emails["source"] != "llm", "label"] == "No action").all()
+
+
+def test_budget_below_the_estimate_exits_with_3(
+    scoring_file: Path, llm_server: tuple[FastAPI, OpenAI]
+) -> None:
+    output = scoring_file.with_name("emails.csv")
+    assert run_cli(scoring_file, output, "--budget=0.0000001") == 3
+    assert llm_server[0].state.calls == 0
+    assert not output.exists()
+
+
+def test_estimate_only_generates_nothing(
+    scoring_file: Path, llm_server: tuple[FastAPI, OpenAI]
+) -> None:
+    output = scoring_file.with_name("emails.csv")
+    assert run_cli(scoring_file, output, "--estimate-only") == 0
+    assert llm_server[0].state.calls == 0
+    assert not output.exists()
@@ -0,0 +1,92 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import threading
+import time
+
+import pytest
+
+from nbo.concurrency import AdaptiveConcurrencyLimiter, parse_retry_after
+from nbo.policy import SlotTimeoutError
+
+
+def test_parse_retry_after() -> None:
+    assert parse_retry_after({"retry-after": "2.5"}) == 2.5
+    assert parse_retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({"retry-after": "soon"}) is None
+
+
+def test_window_grows_by_one_per_window_of_successes() -> None:
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8, initial_limit=2)
+    # +1/window each: 2 -> 2.5 -> 2.9 -> 3.24
+    for _ in range(3):
+        limiter.on_success(0.1)
+    assert int(limiter.window) == 3
+    for _ in range(100):
+        limiter.on_success(0.1)
+    assert limiter.window == 8
+
+
+def test_slow_completions_do_not_grow_the_window() -> None:
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8, initial_limit=2)
+    limiter.on_success(0.1)
+    window = limiter.window
+    for _ in range(10):
+        limiter.on_success(1.0)
+    assert limiter.window == window
+
+
+def test_one_throttling_episode_cuts_the_window_once() -> None:
+    limiter = AdaptiveConcurrencyLimiter(max_limit=16, initial_limit=16)
+    started = time.monotonic()
+    limiter.on_throttle(started)
+    limiter.on_throttle(started)
+    assert limiter.window == 8
+    limiter.on_throttle(time.monotonic())
+    assert limiter.window == 4
+
+
+def test_slot_waits_for_retry_after() -> None:
+    limiter = AdaptiveConcurrencyLimiter(max_limit=4)
+    limiter.on_throttle(time.monotonic(), retry_after=0.2)
+    start = time.monotonic()
+    with limiter.slot():
+        assert time.monotonic() - start >= 0.2
+
+
+def test_slot_gives_up_after_timeout() -> None:
+    limiter = AdaptiveConcurrencyLimiter(max_limit=1, initial_limit=1)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold() -> None:
+        with limiter.slot():
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    start = time.monotonic()
+    with pytest.raises(SlotTimeoutError):
+        with limiter.slot(timeout=0.1):
+            pass
+    assert 0.1 <= time.monotonic() - start < 0.5
+    release.set()
+    holder.join()
+    with limiter.slot(timeout=0.1):
+        assert limiter.in_flight == 1
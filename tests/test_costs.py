@@ -0,0 +1,183 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import uuid
+from pathlib import Path
+
+import pytest
+from fastapi import FastAPI
+from openai import OpenAI
+
+import nbo.costs
+from nbo.costs import (
+    BudgetExceededError,
+    CostEstimate,
+    SpendTracker,
+    check_budget,
+    estimate_cost,
+)
+from nbo.jobs import BatchCheckpoint, run_generation_job
+from nbo.pipeline import batch_email_responses
+from nbo.predict import packed_prompt
+from nbo.schema import (
+    AppDataScienceSettings,
+    Explanation,
+    Generation,
+    LLMRequest,
+    Prediction,
+)
+from tests.standins import STANDIN_APP_SETTINGS
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch: pytest.MonkeyPatch) -> None:
+    """One token per word, as the tokenizer cannot be downloaded here"""
+    monkeypatch.setattr(
+        nbo.costs,
+        "count_tokens",
+        lambda texts, encoding_name=None: [len(text.split()) for text in texts],
+    )
+
+
+@pytest.fixture
+def app_settings() -> AppDataScienceSettings:
+    return AppDataScienceSettings(
+        **STANDIN_APP_SETTINGS,
+        verbosity_profiles={"short": {"expected_output_tokens": 100}},
+    )
+
+
+def llm_request(prompt: str = "Write an email", **kwargs: object) -> LLMRequest:
+    return LLMRequest(
+        prompt=f"{prompt} {uuid.uuid4()}",
+        system_prompt="You write emails.",
+        number_of_explanations=3,
+        tone="friendly",
+        verbosity="short",
+        **kwargs,
+    )
+
+
+def test_estimate_counts_every_call_and_variant(
+    app_settings: AppDataScienceSettings,
+) -> None:
+    requests = [llm_request(), llm_request(variants=3), llm_request(max_tokens=40)]
+
+    estimate = estimate_cost(requests, app_settings)
+
+    # Three words of system prompt and four of prompt per call
+    assert (estimate.llm_calls, estimate.input_tokens) == (3, 21)
+    assert estimate.output_tokens == 100 + 3 * 100 + 40
+    assert estimate.input_cost == pytest.approx(21 / 1000 * 0.001)
+    assert estimate.output_cost == pytest.approx(440 / 1000 * 0.002)
+
+
+def test_estimate_of_packed_calls_counts_one_system_prompt_per_call(
+    app_settings: AppDataScienceSettings,
+) -> None:
+    requests = [llm_request(record_id=str(i), variants=2) for i in range(5)]
+
+    estimate = estimate_cost(requests, app_settings, records_per_call=2)
+
+    assert estimate.llm_calls == 3
+    assert estimate.input_tokens == 3 * 3 + sum(
+        len(packed_prompt(requests[start : start + 2]).split()) for start in (0, 2)
+    ) + len(requests[4].prompt.split())
+    # Packed calls answer each record once, whatever its variants
+    assert estimate.output_tokens == 2 * 100 + 2 * 100 + 2 * 100
+
+
+def test_check_budget() -> None:
+    estimate = CostEstimate(
+        llm_calls=2, input_tokens=10, output_tokens=10, input_cost=0.5, output_cost=0.5
+    )
+    check_budget(estimate, None)
+    check_budget(estimate, 1.0)
+    with pytest.raises(BudgetExceededError, match="exceeds the budget of \\$0.9000"):
+        check_budget(estimate, 0.9)
+
+
+def test_spend_counts_only_llm_emails(app_settings: AppDataScienceSettings) -> None:
+    spend = SpendTracker(app_settings.model_spec, budget=0.000015)
+    request = llm_request()
+    for source in ("template", "cache"):
+        spend.record(
+            request,
+            Generation(
+                content="Hi there", prompt_used="", association_id="", source=source
+            ),
+        )
+    assert spend.spent == 0 and not spend.exceeded
+
+    spend.record(
+        request, Generation(content="Hi there", prompt_used="", association_id="")
+    )
+    assert spend.spent == pytest.approx((6 * 0.001 + 2 * 0.002) / 1000)
+    assert not spend.exceeded
+    spend.record(
+        request, Generation(content="Hi there", prompt_used="", association_id="")
+    )
+    assert spend.exceeded
+
+
+def test_batch_over_budget_is_refused_up_front(
+    llm_server: tuple[FastAPI, OpenAI], app_settings: AppDataScienceSettings
+) -> None:
+    prediction = Prediction(
+        predicted_label="Upgrade",
+        class_probabilities={"Upgrade": 1.0},
+        explanations=[
+            Explanation(
+                feature_name="plan",
+                strength=0.4,
+                qualitative_strength="++",
+                feature_value="basic",
+            )
+        ],
+    )
+    with pytest.raises(BudgetExceededError):
+        batch_email_responses(
+            ["C0", "C1"],
+            [prediction, prediction],
+            1,
+            "friendly",
+            "short",
+            app_settings,
+            budget=0.0001,
+        )
+    assert llm_server[0].state.calls == 0
+
+
+def test_job_stops_once_its_spend_reaches_the_budget(
+    prediction_server: FastAPI,
+    llm_server: tuple[FastAPI, OpenAI],
+    app_settings: AppDataScienceSettings,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("NBO_JOB_DIR", str(tmp_path))
+    requests = [llm_request() for _ in range(5)]
+    spend = SpendTracker(app_settings.model_spec, budget=0.000001)
+
+    with pytest.raises(BudgetExceededError, match="of 5 rows generated"):
+        run_generation_job("job", requests, spend=spend)
+
+    # The first email uses up the budget; only a row already in flight follows
+    calls = llm_server[0].state.calls
+    assert calls <= 2
+    assert spend.exceeded
+    # The emails paid for are kept for the rerun
+    assert len(BatchCheckpoint("job").load_completed(requests)) == calls
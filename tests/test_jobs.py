@@ -0,0 +1,240 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Callable
+
+import pandas as pd
+import pytest
+from fastapi import FastAPI
+from openai import OpenAI
+
+from nbo.jobs import (
+    BatchCheckpoint,
+    JobExecutor,
+    JobRecord,
+    JobStatus,
+    run_generation_job,
+)
+from nbo.schema import Generation, LLMRequest
+
+
+def llm_request(prompt: str) -> LLMRequest:
+    return LLMRequest(
+        prompt=f"{prompt} {uuid.uuid4()}",
+        system_prompt="You write emails.",
+        number_of_explanations=3,
+        tone="friendly",
+        verbosity="short",
+    )
+
+
+def generation(llm_request: LLMRequest, content: str) -> Generation:
+    return Generation(
+        content=content,
+        prompt_used=llm_request.prompt,
+        association_id=str(uuid.uuid4()),
+    )
+
+
+def table_job(rows: int) -> Callable[[Callable[[int, int], None]], pd.DataFrame]:
+    def fn(on_progress: Callable[[int, int], None]) -> pd.DataFrame:
+        on_progress(rows, rows)
+        return pd.DataFrame({"row": range(rows)})
+
+    return fn
+
+
+def wait_finished(executor: JobExecutor, job_id: str) -> JobRecord:
+    for _ in range(500):
+        record = executor.get(job_id)
+        assert record is not None
+        if record.status in (JobStatus.SUCCEEDED, JobStatus.FAILED):
+            return record
+        time.sleep(0.01)
+    raise AssertionError(f"job {job_id} did not finish")
+
+
+def test_checkpoint_skips_a_torn_last_line(tmp_path: Path) -> None:
+    checkpoint = BatchCheckpoint("job", tmp_path)
+    requests = [llm_request("Email") for _ in range(3)]
+    checkpoint.save(0, generation(requests[0], "first"))
+    checkpoint.save(2, generation(requests[2], "third"))
+    with checkpoint.path.open("a", encoding="utf-8") as f:
+        f.write('{"index": 1, "generation": {"content": "sec')
+
+    assert {index: g.content for index, g in checkpoint.load().items()} == {
+        0: "first",
+        2: "third",
+    }
+    checkpoint.delete()
+    assert checkpoint.load() == {}
+
+
+def test_checkpoint_drops_rows_whose_prompt_changed(tmp_path: Path) -> None:
+    checkpoint = BatchCheckpoint("job", tmp_path)
+    requests = [llm_request("Email") for _ in range(2)]
+    checkpoint.save(0, generation(requests[0], "first"))
+    checkpoint.save(1, generation(requests[1], "second"))
+    checkpoint.save(5, generation(requests[1], "out of range"))
+
+    changed = [requests[0], llm_request("Edited email")]
+    assert list(checkpoint.load_completed(changed)) == [0]
+
+
+def test_generation_job_only_generates_missing_rows(
+    prediction_server: FastAPI,
+    llm_server: tuple[FastAPI, OpenAI],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setenv("NBO_JOB_DIR", str(tmp_path))
+    app = llm_server[0]
+    requests = [llm_request("Email") for _ in range(3)]
+    BatchCheckpoint("job").save(1, generation(requests[1], "checkpointed"))
+    progress: list[tuple[int, int]] = []
+
+    generations = run_generation_job(
+        "job", requests, on_progress=lambda *p: progress.append(p)
+    )
+
+    assert app.state.calls == 2
+    assert generations[1].content == "checkpointed"
+    assert [g.prompt_used for g in generations] == [r.prompt for r in requests]
+    assert progress[0] == (1, 3) and progress[-1] == (3, 3)
+    # Every row is checkpointed now, so a rerun calls nothing
+    run_generation_job("job", requests)
+    assert app.state.calls == 2
+
+
+def test_executor_stores_results_and_failures(tmp_path: Path) -> None:
+    executor = JobExecutor(tmp_path)
+    executor.submit("ok", "ok.csv", table_job(3))
+    record = wait_finished(executor, "ok")
+    assert (record.status, record.completed, record.total) == (
+        JobStatus.SUCCEEDED,
+        3,
+        3,
+    )
+    assert executor.result("ok")["row"].tolist() == [0, 1, 2]
+
+    def fail(on_progress: Callable[[int, int], None]) -> pd.DataFrame:
+        on_progress(1, 2)
+        raise RuntimeError("LLM down")
+
+    executor.submit("broken", "broken.csv", fail)
+    record = wait_finished(executor, "broken")
+    assert (record.status, record.error, record.completed) == (
+        JobStatus.FAILED,
+        "LLM down",
+        1,
+    )
+    assert executor.get("missing") is None
+
+
+def test_running_jobs_are_not_submitted_twice_but_finished_ones_rerun(
+    tmp_path: Path,
+) -> None:
+    executor = JobExecutor(tmp_path)
+    release = threading.Event()
+    runs = 0
+
+    def job(on_progress: Callable[[int, int], None]) -> pd.DataFrame:
+        nonlocal runs
+        runs += 1
+        release.wait(5)
+        return pd.DataFrame({"run": [runs]})
+
+    first = executor.submit("job", "job.csv", job)
+    second = executor.submit("job", "job.csv", job)
+    assert second.created_at == first.created_at
+    release.set()
+    wait_finished(executor, "job")
+    assert runs == 1
+
+    executor.submit("job", "job.csv", job)
+    assert wait_finished(executor, "job").status == JobStatus.SUCCEEDED
+    assert runs == 2
+    assert executor.result("job")["run"].tolist() == [2]
+
+
+def test_restart_marks_interrupted_jobs_failed(tmp_path: Path) -> None:
+    executor = JobExecutor(tmp_path)
+    release = threading.Event()
+
+    def job(on_progress: Callable[[int, int], None]) -> pd.DataFrame:
+        release.wait(5)
+        return pd.DataFrame()
+
+    executor.submit("job", "job.csv", job)
+    try:
+        # A new process opening the same job directory
+        restarted = JobExecutor(tmp_path).get("job")
+        assert restarted is not None
+        assert restarted.status == JobStatus.FAILED
+        assert restarted.error == "Interrupted by an application restart"
+    finally:
+        release.set()
+
+
+def test_jobs_are_listed_only_for_their_owner(tmp_path: Path) -> None:
+    executor = JobExecutor(tmp_path)
+    executor.submit("a", "a.csv", table_job(1), owner="session:a")
+    executor.submit("b", "b.csv", table_job(1), owner="session:b")
+    wait_finished(executor, "a")
+    wait_finished(executor, "b")
+
+    assert [job.id for job in executor.list_jobs(owner="session:a")] == ["a"]
+    assert [job.id for job in executor.list_jobs(owner="session:b")] == ["b"]
+    assert executor.list_jobs(owner="session:c") == []
+    assert {job.id for job in executor.list_jobs()} == {"a", "b"}
+
+
+def test_job_tables_without_owners_are_migrated(tmp_path: Path) -> None:
+    conn = sqlite3.connect(tmp_path / "jobs.sqlite")
+    with conn:
+        conn.execute(
+            """
+            CREATE TABLE jobs (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                status TEXT NOT NULL,
+                completed INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+            """
+        )
+        conn.execute(
+            "INSERT INTO jobs VALUES ('old', 'old.csv', 'succeeded', 1, 1, NULL, "
+            "'2024-01-01T00:00:00', '2024-01-01T00:00:00')"
+        )
+    conn.close()
+
+    executor = JobExecutor(tmp_path)
+    old = executor.get("old")
+    assert old is not None and old.owner is None
+    # Jobs from before owners were recorded are not shown to anyone
+    assert executor.list_jobs(owner="session:a") == []
+
+    executor.submit("new", "new.csv", table_job(1), owner="session:a")
+    assert wait_finished(executor, "new").owner == "session:a"
@@ -0,0 +1,129 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from openai import OpenAI
+
+from nbo.pipeline import (
+    batch_email_responses,
+    create_llm_request,
+    no_action_message,
+    sweep_email_responses,
+    sweep_variants,
+    variant_column,
+)
+from nbo.schema import AppDataScienceSettings, Explanation, Prediction
+from tests.standins import STANDIN_APP_SETTINGS, STANDIN_CLASSES
+
+
+@pytest.fixture
+def app_settings() -> AppDataScienceSettings:
+    return AppDataScienceSettings(**STANDIN_APP_SETTINGS)
+
+
+def prediction(label: str) -> Prediction:
+    return Prediction(
+        predicted_label=label,
+        class_probabilities={
+            name: 0.8 if name == label else 0.1 for name in STANDIN_CLASSES
+        },
+        explanations=[
+            Explanation(
+                feature_name="plan",
+                strength=0.4,
+                qualitative_strength="++",
+                feature_value="basic",
+            )
+        ],
+    )
+
+
+def record_ids(n: int) -> list[str]:
+    """Unique ids, so no email comes from the cache of an earlier test"""
+    run_id = uuid.uuid4().hex[:8]
+    return [f"{run_id}-{i}" for i in range(n)]
+
+
+def test_verbosity_profile_sets_max_tokens_and_deadline() -> None:
+    app_settings = AppDataScienceSettings(
+        **STANDIN_APP_SETTINGS,
+        verbosity_profiles={
+            "short": {"max_output_tokens": 120, "timeout_seconds": 4.5}
+        },
+    )
+    capped = create_llm_request("Email", 1, "friendly", "short", app_settings)
+    assert (capped.max_tokens, capped.deadline) == (120, 4.5)
+    uncapped = create_llm_request("Email", 1, "friendly", "long", app_settings)
+    assert (uncapped.max_tokens, uncapped.deadline) == (None, None)
+
+
+def test_no_action_records_skip_the_llm(
+    prediction_server: FastAPI,
+    llm_server: tuple[FastAPI, OpenAI],
+    app_settings: AppDataScienceSettings,
+) -> None:
+    ids = record_ids(4)
+    labels = ["Upgrade", "No action", "Retention call", "No action"]
+
+    result = batch_email_responses(
+        ids,
+        [prediction(label) for label in labels],
+        1,
+        "friendly",
+        "short",
+        app_settings,
+    )
+
+    assert llm_server[0].state.calls == 2
+    assert result.attrs["skipped_llm_calls"] == 2
+    assert result["source"].tolist() == ["llm", "no_action", "llm", "no_action"]
+    assert result.at[1, "email"] == no_action_message(ids[1])
+    assert str(result.at[0, "email"]).startswith(
+        "Draft 1: Write a friendly, short email"
+    )
+
+
+def test_sweep_drafts_every_variant_from_one_set_of_predictions(
+    prediction_server: FastAPI,
+    llm_server: tuple[FastAPI, OpenAI],
+    app_settings: AppDataScienceSettings,
+) -> None:
+    ids = record_ids(3)
+    predictions = [prediction(label) for label in ["Upgrade", "No action", "Upgrade"]]
+    variants = sweep_variants(app_settings)
+    assert variants == [("friendly", "short"), ("formal", "short")]
+
+    result = sweep_email_responses(ids, predictions, 1, app_settings)
+
+    assert list(result.columns) == [
+        "record_id",
+        "label",
+        "email (friendly, short)",
+        "email (formal, short)",
+    ]
+    assert [variant_column(*variant) for variant in variants] == list(
+        result.columns[2:]
+    )
+    assert llm_server[0].state.calls == 4
+    assert result.attrs["skipped_llm_calls"] == 2
+    assert prediction_server.state.requests == []
+    for tone, verbosity in variants:
+        emails = result[variant_column(tone, verbosity)]
+        assert str(emails[0]).startswith(f"Draft 1: Write a {tone}, {verbosity}")
+        assert emails[1] == no_action_message(ids[1])
@@ -0,0 +1,197 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import itertools
+import time
+
+import pytest
+
+from nbo.policy import (
+    CallPolicy,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceededError,
+    SlotTimeoutError,
+)
+from nbo.telemetry import runtime_metrics
+
+
+class Flaky:
+    """Attempt that fails `failures` times with `error`, then returns "ok" """
+
+    def __init__(self, failures: int, error: Exception = ConnectionError("down")):
+        self.failures = failures
+        self.error = error
+        self.timeouts: list[float] = []
+
+    def __call__(self, timeout: float) -> str:
+        self.timeouts.append(timeout)
+        if len(self.timeouts) <= self.failures:
+            raise self.error
+        return "ok"
+
+
+def is_connection_error(error: Exception) -> bool:
+    return isinstance(error, ConnectionError)
+
+
+def test_breaker_opens_after_consecutive_failures() -> None:
+    breaker = CircuitBreaker("test_opens", failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.on_failure()
+    breaker.on_success()
+    for _ in range(2):
+        breaker.on_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    metrics = runtime_metrics.snapshot()
+    assert metrics["test_opens.breaker.opened"] == 1
+    assert metrics["test_opens.breaker.rejected"] == 1
+    assert metrics["test_opens.breaker.state"] == 2
+
+
+def test_breaker_probe_closes_or_reopens() -> None:
+    breaker = CircuitBreaker("test_probe", failure_threshold=1, reset_timeout=0.05)
+    breaker.on_failure()
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.before_call()
+
+
+def test_policy_retries_retryable_errors() -> None:
+    policy = CallPolicy("test_retries", is_connection_error, deadline=5, base_delay=0)
+    attempt = Flaky(failures=2)
+    assert policy.call(attempt) == "ok"
+    assert len(attempt.timeouts) == 3
+    assert all(0 < timeout <= 5 for timeout in attempt.timeouts)
+    assert runtime_metrics.snapshot()["test_retries.retries"] == 2
+
+
+def test_policy_does_not_retry_other_errors() -> None:
+    policy = CallPolicy("test_no_retry", is_connection_error, deadline=5)
+    attempt = Flaky(failures=1, error=ValueError("bad request"))
+    with pytest.raises(ValueError):
+        policy.call(attempt)
+    assert len(attempt.timeouts) == 1
+
+
+def test_policy_gives_up_when_retry_would_miss_deadline() -> None:
+    policy = CallPolicy(
+        "test_deadline",
+        is_connection_error,
+        deadline=0.1,
+        retry_after=lambda error: 1.0,
+    )
+    attempt = Flaky(failures=1)
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceededError):
+        policy.call(attempt)
+    assert time.monotonic() - start < 0.5
+    assert len(attempt.timeouts) == 1
+    assert runtime_metrics.snapshot()["test_deadline.deadline_exceeded"] == 1
+
+
+def test_slow_attempts_are_hedged_and_the_first_answer_wins() -> None:
+    policy = CallPolicy(
+        "test_hedging",
+        is_connection_error,
+        deadline=5,
+        hedge_percentile=0.9,
+        hedge_min_samples=5,
+    )
+    attempts = itertools.count()
+
+    def attempt(timeout: float) -> str:
+        if next(attempts) == 0:
+            time.sleep(1)
+            return "slow"
+        return "fast"
+
+    # Not hedged until enough latencies are known
+    assert policy.call(lambda timeout: "ok") == "ok"
+    assert "test_hedging.hedges" not in runtime_metrics.snapshot()
+    for _ in range(5):
+        policy.latencies.record(0.02)
+
+    start = time.monotonic()
+    assert policy.call(attempt) == "fast"
+    assert time.monotonic() - start < 0.5
+    metrics = runtime_metrics.snapshot()
+    assert metrics["test_hedging.hedges"] == 1
+    assert metrics["test_hedging.hedge_wins"] == 1
+
+
+def test_policy_counts_calls_on_its_breaker() -> None:
+    breaker = CircuitBreaker("test_policy_breaker", failure_threshold=2)
+    policy = CallPolicy(
+        "test_policy_breaker",
+        is_connection_error,
+        deadline=5,
+        max_attempts=1,
+        breaker=breaker,
+    )
+    # A deployment that answers with a client error is not failing
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            policy.call(Flaky(failures=1, error=ValueError("bad request")))
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            policy.call(Flaky(failures=1))
+    attempt = Flaky(failures=0)
+    with pytest.raises(CircuitOpenError):
+        policy.call(attempt)
+    assert attempt.timeouts == []
+
+
+def test_slot_timeouts_do_not_count_on_the_breaker() -> None:
+    breaker = CircuitBreaker("test_slot_breaker", failure_threshold=1)
+    policy = CallPolicy(
+        "test_slot_breaker",
+        is_connection_error,
+        deadline=5,
+        max_attempts=1,
+        breaker=breaker,
+    )
+    for _ in range(3):
+        with pytest.raises(SlotTimeoutError):
+            policy.call(Flaky(failures=1, error=SlotTimeoutError("no slot")))
+    assert breaker.state == CircuitBreaker.CLOSED
+
+    # A probe that never got a slot lets the next call probe
+    breaker.reset_timeout = 0
+    breaker.on_failure()
+    with pytest.raises(SlotTimeoutError):
+        policy.call(Flaky(failures=1, error=SlotTimeoutError("no slot")))
+    assert breaker.state == CircuitBreaker.OPEN
+    assert policy.call(Flaky(failures=0)) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,351 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+
+import pandas as pd
+import pytest
+from datarobot.client import RESTClientObject, set_client
+from fastapi import FastAPI
+from openai import BadRequestError, OpenAI
+
+import nbo.predict
+from nbo.policy import CircuitOpenError
+from nbo.predict import (
+    _packed_keys,
+    _split_packed_content,
+    get_openai_client,
+    make_generative_deployment_predictions,
+    make_packed_generative_deployment_predictions,
+    make_pred_ai_deployment_predictions,
+)
+from nbo.schema import LLMRequest
+from nbo.telemetry import runtime_metrics
+from tests.standins import STANDIN_CLASSES
+
+
+def llm_request(prompt: str, **kwargs: object) -> LLMRequest:
+    return LLMRequest(
+        prompt=f"{prompt} {uuid.uuid4()}",
+        system_prompt="You write emails.",
+        number_of_explanations=3,
+        tone="friendly",
+        verbosity="short",
+        **kwargs,
+    )
+
+
+def records(n: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "customer_id": [str(i) for i in range(n)],
+            "age": [30 + i for i in range(n)],
+            "plan": ["basic"] * n,
+            "notes": ["asked about 5G"] * n,
+            "association_id": [f"a{i}" for i in range(n)],
+        }
+    )
+
+
+def test_openai_client_is_replaced_and_closed_when_the_token_changes() -> None:
+    endpoint = "http://127.0.0.1:9/api/v2"
+    previous = set_client(RESTClientObject(auth="old-token", endpoint=endpoint))
+    try:
+        client = get_openai_client("refreshed")
+        assert get_openai_client("refreshed") is client
+        assert client.api_key == "old-token"
+
+        set_client(RESTClientObject(auth="new-token", endpoint=endpoint))
+        refreshed = get_openai_client("refreshed")
+        assert refreshed is not client
+        assert refreshed.api_key == "new-token"
+        assert client.is_closed()
+        assert not refreshed.is_closed()
+    finally:
+        set_client(previous)
+
+
+@pytest.mark.parametrize(
+    "content, expected",
+    [
+        ('{"1": "Hi Ann", "2": "Hi Bob"}', {"1": "Hi Ann", "2": "Hi Bob"}),
+        (
+            'Here you go:\n```json\n{"1": " Hi Ann\\n", "2": "Hi Bob"}\n```\nThanks',
+            {"1": "Hi Ann", "2": "Hi Bob"},
+        ),
+        ('{"1": "Hi Ann", "2": "", "3": 7, "4": null}', {"1": "Hi Ann"}),
+        ('{"1": "Hi Ann", "extra": "ignored"}', {"1": "Hi Ann"}),
+        ('{"1": "Hi Ann",', {}),
+        ("[1, 2]", {}),
+        ("I cannot help with that.", {}),
+        (None, {}),
+    ],
+)
+def test_split_packed_content(content: str | None, expected: dict[str, str]) -> None:
+    assert _split_packed_content(content, ["1", "2", "3", "4"]) == expected
+
+
+def test_packed_keys_fall_back_to_positions() -> None:
+    assert _packed_keys([llm_request("a", record_id="x"), llm_request("b")]) == [
+        "1",
+        "2",
+    ]
+    duplicates = [llm_request("a", record_id="x"), llm_request("b", record_id="x")]
+    assert _packed_keys(duplicates) == ["1", "2"]
+    unique = [llm_request("a", record_id="x"), llm_request("b", record_id="y")]
+    assert _packed_keys(unique) == ["x", "y"]
+
+
+def test_packed_completion_splits_and_falls_back(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    requests = [llm_request("Email", record_id=str(i)) for i in range(3)]
+    fallbacks = runtime_metrics.snapshot().get("llm.packed_fallbacks", 0)
+
+    generations = make_packed_generative_deployment_predictions(requests, client)
+
+    # The stand-in leaves out the last record, which gets its own call
+    assert app.state.calls == 2
+    assert runtime_metrics.snapshot()["llm.packed_fallbacks"] == fallbacks + 1
+    assert [g.content for g in generations[:2]] == [
+        "Email for record 0",
+        "Email for record 1",
+    ]
+    assert generations[2].content.startswith("Draft 1: Email")
+    assert [g.prompt_used for g in generations] == [r.prompt for r in requests]
+    assert generations[0].association_id == generations[1].association_id
+    assert generations[2].association_id != generations[0].association_id
+    assert [g.completion_position for g in generations] == [0, 1, 0]
+
+
+def test_packed_requests_must_share_system_prompt(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    _, client = llm_server
+    other = llm_request("b").model_copy(update={"system_prompt": "Other"})
+    with pytest.raises(ValueError):
+        make_packed_generative_deployment_predictions([llm_request("a"), other], client)
+
+
+def test_variants_share_the_tracked_association_id(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    generations = make_generative_deployment_predictions(
+        [llm_request("Email", variants=3)], client
+    )
+    assert app.state.calls == 1
+    assert [g.content[:8] for g in generations] == ["Draft 1:", "Draft 2:", "Draft 3:"]
+    assert len({g.association_id for g in generations}) == 1
+    assert [g.completion_position for g in generations] == [0, 1, 2]
+
+
+def test_variants_fall_back_to_single_calls_without_n(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    app.state.supports_n = False
+    generations = make_generative_deployment_predictions(
+        [llm_request("Email", variants=2)], client
+    )
+    assert len(generations) == 2
+    assert app.state.calls == 3
+
+    # The deployment is not asked for `n` again
+    make_generative_deployment_predictions([llm_request("Email", variants=2)], client)
+    assert app.state.calls == 5
+
+
+def test_unrelated_bad_requests_do_not_disable_n(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    app.state.bad_request = "This model's maximum context length is 8192 tokens"
+    with pytest.raises(BadRequestError):
+        make_generative_deployment_predictions(
+            [llm_request("Email", variants=2)], client
+        )
+    app.state.bad_request = None
+    generations = make_generative_deployment_predictions(
+        [llm_request("Email", variants=2)], client
+    )
+    assert [g.completion_position for g in generations] == [0, 1]
+    assert app.state.calls == 2
+
+
+def test_max_tokens_cap_is_sent_and_truncations_are_counted(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    make_generative_deployment_predictions([llm_request("Email")], client)
+    truncations = runtime_metrics.snapshot().get("llm.truncations", 0)
+    app.state.finish_reason = "length"
+
+    (generation,) = make_generative_deployment_predictions(
+        [llm_request("Email", max_tokens=50)], client
+    )
+
+    assert app.state.max_tokens == [None, 50]
+    assert generation.content.startswith("Draft 1: Email")
+    assert runtime_metrics.snapshot()["llm.truncations"] == truncations + 1
+
+
+def test_request_deadline_bounds_generation(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    app.state.delay = 1.0
+    start = time.monotonic()
+
+    (generation,) = make_generative_deployment_predictions(
+        [llm_request("Email", deadline=0.2, fallback_content="Template email")],
+        client,
+    )
+
+    assert time.monotonic() - start < 0.8
+    assert (generation.source, generation.content) == ("template", "Template email")
+
+
+def test_concurrent_identical_prompts_share_one_completion(
+    llm_server: tuple[FastAPI, OpenAI],
+) -> None:
+    app, client = llm_server
+    app.state.delay = 0.2
+    request = llm_request("Email")
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                make_generative_deployment_predictions([request], client)[0]
+            )
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert app.state.calls == 1
+    assert len({generation.association_id for generation in results}) == 1
+
+
+def test_unavailable_llm_serves_cached_then_template_emails(
+    llm_server: tuple[FastAPI, OpenAI], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    app, client = llm_server
+    monkeypatch.setattr(nbo.predict.llm_call_policy, "max_attempts", 1)
+    seen = llm_request("Email", fallback_content="Template email")
+    first = make_generative_deployment_predictions([seen], client)[0]
+
+    app.state.unavailable = True
+    unseen = llm_request("Email", fallback_content="Template email")
+    cached, template = make_generative_deployment_predictions([seen, unseen], client)
+    assert (cached.source, cached.content) == ("cache", first.content)
+    assert (template.source, template.content) == ("template", "Template email")
+
+    with pytest.raises(Exception):
+        make_generative_deployment_predictions([llm_request("Email")], client)
+
+
+def test_open_breaker_fails_fast(
+    llm_server: tuple[FastAPI, OpenAI], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    app, client = llm_server
+    monkeypatch.setattr(nbo.predict.llm_call_policy, "max_attempts", 1)
+    monkeypatch.setenv("NBO_TEMPLATE_FALLBACK", "false")
+    app.state.unavailable = True
+    breaker = nbo.predict.llm_call_policy.breaker
+    assert breaker is not None
+    for _ in range(breaker.failure_threshold):
+        with pytest.raises(Exception):
+            make_generative_deployment_predictions([llm_request("Email")], client)
+    calls = app.state.calls
+    with pytest.raises(CircuitOpenError):
+        make_generative_deployment_predictions([llm_request("Email")], client)
+    assert app.state.calls == calls
+
+
+def test_scoring_sends_deployment_columns_and_parses_response(
+    prediction_server: FastAPI,
+) -> None:
+    predictions = make_pred_ai_deployment_predictions(records(5), max_explanations=3)
+
+    (sent,) = prediction_server.state.requests
+    assert list(sent.columns) == ["age", "plan", "notes", "association_id"]
+    (params,) = prediction_server.state.params
+    assert params["maxExplanations"] == "3"
+    assert "maxNgramExplanations" not in params
+    assert len(predictions) == 5
+    for prediction in predictions:
+        assert prediction.predicted_label in STANDIN_CLASSES
+        assert set(prediction.class_probabilities) == set(STANDIN_CLASSES)
+        assert 2 <= len(prediction.explanations) <= 3
+        for explanation in prediction.explanations:
+            assert not explanation.per_n_gram_text_explanation
+
+
+def test_scoring_requests_top_ngrams_for_the_text_feature(
+    prediction_server: FastAPI, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("NBO_MAX_NGRAM_EXPLANATIONS", "2")
+    predictions = make_pred_ai_deployment_predictions(
+        records(20), max_explanations=3, text_explanation_feature="notes"
+    )
+
+    (params,) = prediction_server.state.params
+    assert params["maxNgramExplanations"] == "2"
+    ngrams = [
+        explanation.per_n_gram_text_explanation
+        for prediction in predictions
+        for explanation in prediction.explanations
+        if explanation.feature_name == "notes"
+    ]
+    assert ngrams and all(ngram and len(ngram) == 2 for ngram in ngrams)
+
+
+def test_concurrent_scoring_of_same_rows_is_coalesced(
+    prediction_server: FastAPI,
+) -> None:
+    prediction_server.state.delay = 0.2
+    df = records(3)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(make_pred_ai_deployment_predictions(df, 3))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(prediction_server.state.requests) == 1
+    assert all(result == results[0] for result in results)
+
+
+def test_unavailable_deployment_serves_earlier_predictions(
+    prediction_server: FastAPI, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(nbo.predict.prediction_call_policy, "max_attempts", 1)
+    df = records(4)
+    scored = make_pred_ai_deployment_predictions(df, 3)
+    prediction_server.state.unavailable = True
+    assert make_pred_ai_deployment_predictions(df, 3) == scored
+    with pytest.raises(Exception):
+        make_pred_ai_deployment_predictions(records(5), 3)
@@ -0,0 +1,109 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import pandas as pd
+import pytest
+
+from nbo.schema import Explanation, Prediction, PredictionColumnPlan
+from tests.standins import STANDIN_TARGET, parser_frame
+
+
+def test_column_plan_of_binary_response() -> None:
+    columns = ["prediction", "offer_yes", "offer_no"]
+    for i in (2, 10, 1):
+        columns += [
+            f"EXPLANATION_{i}_{suffix}"
+            for suffix in ("FEATURE_NAME", "STRENGTH", "ACTUAL_VALUE")
+        ] + [f"EXPLANATION_{i}_QUALITATIVE_STRENGTH"]
+    columns.append("EXPLANATION_2_TEXT_NGRAMS")
+
+    plan = PredictionColumnPlan.from_columns(columns, "offer")
+
+    assert plan.probabilities == {"offer_yes": "yes", "offer_no": "no"}
+    assert [e.feature_name for e in plan.explanations] == [
+        "EXPLANATION_1_FEATURE_NAME",
+        "EXPLANATION_2_FEATURE_NAME",
+        "EXPLANATION_10_FEATURE_NAME",
+    ]
+    assert [e.text_ngrams for e in plan.explanations] == [
+        None,
+        "EXPLANATION_2_TEXT_NGRAMS",
+        None,
+    ]
+
+
+def test_column_plan_of_multiclass_response() -> None:
+    plan = PredictionColumnPlan.from_columns(parser_frame(1).columns, STANDIN_TARGET)
+    assert plan.probabilities == {
+        "offer_Upgrade": "Upgrade",
+        "offer_Retention call": "Retention call",
+        "offer_No action": "No action",
+    }
+    assert len(plan.explanations) == 3
+    assert plan.explanations[0].strength == "CLASS_1_EXPLANATION_1_STRENGTH"
+    assert plan.explanations[0].text_ngrams == "CLASS_1_EXPLANATION_1_TEXT_NGRAMS"
+
+
+def test_constructed_predictions_match_validated_ones() -> None:
+    df = parser_frame(500)
+    constructed = Prediction.parse_frame(df, STANDIN_TARGET)
+    validated = Prediction.parse_frame(df, STANDIN_TARGET, validate=True)
+    assert [p.model_dump() for p in constructed] == [p.model_dump() for p in validated]
+    assert {len(p.explanations) for p in constructed} == {2, 3}
+
+
+def test_parse_frame_keeps_raw_rows() -> None:
+    df = parser_frame(3)
+    full = Prediction.parse_frame(df, STANDIN_TARGET, keep_raw="full")
+    compact = Prediction.parse_frame(df, STANDIN_TARGET, keep_raw="compact")
+    assert full[0].raw is not None and set(full[0].raw) == set(df.columns)
+    assert compact[0].raw is not None
+    assert all(value is not None for value in compact[0].raw.values())
+    assert Prediction.parse_frame(df, STANDIN_TARGET)[0].raw is None
+
+
+@pytest.mark.parametrize(
+    "strength, given, expected",
+    [(0.6, "", "+++"), (0.4, None, "++"), (0.1, "bad", "+"), (-0.6, "--", "--")],
+)
+def test_qualitative_strengths(
+    strength: float, given: str | None, expected: str
+) -> None:
+    explanation = Explanation(
+        feature_name="age",
+        strength=strength,
+        qualitative_strength=given,
+        feature_value=1,
+    )
+    assert explanation.qualitative_strength == expected
+    vectorized = Explanation.create_qualitative_strengths(
+        pd.Series([strength]), pd.Series([given])
+    )
+    assert vectorized.tolist() == [expected]
+
+
+def test_explanation_text_ngrams_keyword_and_round_trip() -> None:
+    ngrams = [{"ngrams": [{"starting_index": 0, "ending_index": 4}], "strength": 0.3}]
+    explanation = Explanation(
+        feature_name="notes",
+        strength=0.3,
+        qualitative_strength="+",
+        feature_value="wants a discount",
+        per_n_gram_text_explanation=ngrams,
+    )
+    assert explanation.per_n_gram_text_explanation == ngrams
+    restored = Explanation.model_validate_json(explanation.model_dump_json())
+    assert restored.per_n_gram_text_explanation == ngrams
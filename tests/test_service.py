@@ -0,0 +1,115 @@
+# Copyright 2024 DataRobot, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+import yaml
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from openai import OpenAI
+
+import nbo.predict
+from nbo.service import app
+from tests.standins import STANDIN_APP_SETTINGS, STANDIN_CLASSES
+
+
+@pytest.fixture
+def service(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    prediction_server: FastAPI,
+) -> Iterator[TestClient]:
+    """The HTTP service scoring with and drafting on the stand-in deployments,
+    reached through the DataRobot client like the real ones"""
+    settings_path = tmp_path / "app_settings.yaml"
+    settings_path.write_text(yaml.safe_dump(STANDIN_APP_SETTINGS))
+    monkeypatch.setenv("NBO_APP_SETTINGS_PATH", str(settings_path))
+    with TestClient(app) as client:
+        yield client
+
+
+def customers(n: int) -> list[dict[str, object]]:
+    return [
+        {"customer_id": f"C{i}", "age": 30 + i, "plan": "basic", "notes": "5G"}
+        for i in range(n)
+    ]
+
+
+def test_health(service: TestClient) -> None:
+    assert service.get("/health").json() == {"status": "ok"}
+
+
+def test_predict(service: TestClient, prediction_server: FastAPI) -> None:
+    response = service.post("/predict", json={"records": customers(4)})
+    assert response.status_code == 200
+    assert [p["predicted_label"] in STANDIN_CLASSES for p in response.json()] == [
+        True
+    ] * 4
+    (sent,) = prediction_server.state.requests
+    assert "customer_id" not in sent.columns
+
+
+def test_email(service: TestClient) -> None:
+    response = service.post("/emails", json={"record": customers(1)[0]})
+    assert response.status_code == 200
+    email = response.json()
+    assert email["record_id"] == "C0"
+    assert email["label"] == email["prediction"]["predicted_label"]
+    if email["source"] == "no_action":
+        assert email["association_id"] is None
+    else:
+        assert email["source"] == "llm"
+        assert email["email"].startswith("Draft 1: Write a friendly, short email")
+
+
+def test_email_rejects_unknown_tone(service: TestClient) -> None:
+    response = service.post(
+        "/emails", json={"record": customers(1)[0], "tone": "sarcastic"}
+    )
+    assert response.status_code == 422
+
+
+def test_batch_streams_one_line_per_record(
+    service: TestClient, llm_server: tuple[FastAPI, OpenAI]
+) -> None:
+    llm_app, _ = llm_server
+    response = service.post("/emails/batch", json={"records": customers(20)})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["index"] for line in lines) == list(range(20))
+    assert all(line["record_id"] == f"C{line['index']}" for line in lines)
+    drafted = [line for line in lines if line["source"] == "llm"]
+    assert drafted and llm_app.state.calls == len(drafted)
+
+
+def test_batch_falls_back_to_templates(
+    service: TestClient,
+    llm_server: tuple[FastAPI, OpenAI],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    llm_app, _ = llm_server
+    llm_app.state.unavailable = True
+    monkeypatch.setattr(nbo.predict.llm_call_policy, "max_attempts", 1)
+    response = service.post(
+        "/emails/batch", json={"records": customers(6), "tone": "formal"}
+    )
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 6
+    assert {line["source"] for line in lines} == {"template", "no_action"}